@@ -0,0 +1,341 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Benchmarks the sampling path of each collector against fake hardware - fixture files and
+fake ipmi-dcmi and free binaries - and flags regressions against stored baselines
+
+Only part of the source tree, not the installed package. Run from the iriscasttools
+directory with:
+    python -m benchmarks.benchmark [--save-baseline]
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import shlex
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+from unittest.mock import patch
+
+import psutil
+
+from iriscasttools import ipmi, utils
+from iriscasttools.collectors import (
+    IpmiPowerCollector,
+    OsLoadCollector,
+    RamUsageCollector,
+)
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+FIXTURES_DIR = BENCHMARKS_DIR.parent / "tests" / "test_data"
+FAKE_BIN_DIR = BENCHMARKS_DIR / "fake_bin"
+BASELINE_PATH = BENCHMARKS_DIR / "benchmark_baseline.json"
+
+# metrics compared against baseline and how far each may rise before it's a regression -
+# timings may rise by the relative tolerance plus an absolute slack to allow for noise
+TIMING_METRICS = ("p50_ms", "p99_ms", "cpu_ms")
+TIMING_SLACK_MS = 0.5
+RSS_SLACK_KB = 1024
+
+# DCMI Get Power Reading response matching raw_ipmi_test.txt
+FAKE_DCMI_RESPONSE = struct.pack(
+    "<BBHHHHIIB", 0, ipmi.DCMI_GROUP_EXTENSION_ID, 100, 20, 400, 150, 0, 1000, 0x40
+)
+
+
+class FakeDcmiPowerReader(ipmi.DcmiPowerReader):
+    """
+    A DCMI power reader which returns a fixed response instead of talking to a BMC, so the
+    in-process path can be timed without hardware
+    """
+
+    def open(self):
+        """nothing to open"""
+
+    def _request(self, netfn, cmd, data):
+        return FAKE_DCMI_RESPONSE
+
+
+@contextlib.contextmanager
+def fake_hardware(
+    fixtures_dir: Path = FIXTURES_DIR, dcmi: bool = False, fake_bin: Path = FAKE_BIN_DIR
+) -> Iterator[None]:
+    """
+    Point collectors at fixture files and fake binaries instead of real hardware
+
+    Keyword arguments:
+        fixtures_dir -- Path, directory holding fixture files
+        dcmi -- bool, flag to set if power should be read in-process with a fake DCMI reader
+            rather than with the fake ipmi-dcmi binary
+        fake_bin -- Path, directory holding fake ipmi-dcmi and free binaries
+    """
+    reader = FakeDcmiPowerReader("fake") if dcmi else None
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(
+            patch.object(utils, "find_ipmi_device", return_value="fake")
+        )
+        stack.enter_context(patch.object(ipmi, "get_power_reader", return_value=reader))
+        stack.enter_context(
+            patch.object(
+                utils, "IPMI_DCMI_CMD", shlex.quote(str(fake_bin / "ipmi-dcmi"))
+            )
+        )
+        stack.enter_context(
+            patch.object(utils, "FREE_CMD", shlex.quote(str(fake_bin / "free")))
+        )
+        stack.enter_context(
+            patch.object(utils, "MEMINFO_PATH", str(fixtures_dir / "meminfo_test.txt"))
+        )
+        yield
+
+
+def _sample_ram_free():
+    """sample RAM usage with /proc/meminfo unreadable, so free is used instead"""
+    with patch.object(utils, "MEMINFO_PATH", "/nonexistent/meminfo"):
+        return utils.get_ram_usage(*RamUsageCollector.fields)
+
+
+# scenario name to (function taking one sample, flag to read power with fake DCMI reader)
+SCENARIOS: Dict[str, tuple] = {
+    "power_dcmi": (
+        lambda: utils.get_ipmi_power_stats(*IpmiPowerCollector.fields),
+        True,
+    ),
+    "power_ipmi_dcmi_cmd": (
+        lambda: utils.get_ipmi_power_stats(*IpmiPowerCollector.fields),
+        False,
+    ),
+    "os_load": (lambda: utils.get_os_load(*OsLoadCollector.fields), False),
+    "ram_meminfo": (lambda: utils.get_ram_usage(*RamUsageCollector.fields), False),
+    "ram_free": (_sample_ram_free, False),
+}
+
+
+@contextlib.contextmanager
+def count_forks() -> Iterator[List[int]]:
+    """
+    Count child processes started with subprocess while in this context
+
+    Yields a single item list holding the count so far
+    """
+    count = [0]
+    # pylint: disable=protected-access,no-member
+    execute_child = subprocess.Popen._execute_child
+
+    def counting_execute_child(self, *args, **kwargs):
+        count[0] += 1
+        return execute_child(self, *args, **kwargs)
+
+    with patch.object(subprocess.Popen, "_execute_child", counting_execute_child):
+        yield count
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Get nearest-rank percentile of values
+
+    Keyword arguments:
+        values -- list of values
+        pct -- float, percentile between 0 and 100
+    """
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _cpu_seconds() -> float:
+    """CPU time used by this process and its finished children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def run_scenario(
+    sample: Callable[[], Dict], samples: int = 200, warmup: int = 5
+) -> Dict:
+    """
+    Time a sampling function
+
+    Returns p50/p99/mean latency and CPU time per sample in milliseconds, child processes
+    started per sample, RSS at the end of the run and how much RSS grew during it
+
+    Keyword arguments:
+        sample -- function taking a single sample
+        samples -- int, number of samples to time
+        warmup -- int, number of untimed samples taken first
+    """
+    if samples < 1:
+        raise ValueError(f"samples must be at least 1, got {samples}")
+    for _ in range(warmup):
+        sample()
+
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    latencies = []
+    with count_forks() as forks:
+        cpu_start = _cpu_seconds()
+        for _ in range(samples):
+            start = time.perf_counter()
+            sample()
+            latencies.append((time.perf_counter() - start) * 1000)
+        cpu_ms = (_cpu_seconds() - cpu_start) * 1000
+    rss_after = process.memory_info().rss
+
+    return {
+        "samples": samples,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / samples, 3),
+        "cpu_ms": round(cpu_ms / samples, 3),
+        "forks_per_sample": round(forks[0] / samples, 3),
+        "rss_kb": rss_after // 1024,
+        "rss_growth_kb": (rss_after - rss_before) // 1024,
+    }
+
+
+def run_benchmarks(
+    scenarios: Optional[List[str]] = None,
+    samples: int = 200,
+    fixtures_dir: Path = FIXTURES_DIR,
+) -> Dict[str, Dict]:
+    """
+    Run benchmark scenarios against fake hardware
+
+    Keyword arguments:
+        scenarios -- names of scenarios to run, defaults to all
+        samples -- int, number of samples to time in each scenario
+        fixtures_dir -- Path, directory holding fixture files
+    """
+    results = {}
+    for name in scenarios or SCENARIOS:
+        sample, dcmi = SCENARIOS[name]
+        with fake_hardware(fixtures_dir, dcmi=dcmi):
+            results[name] = run_scenario(sample, samples)
+    return results
+
+
+def find_regressions(
+    results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float = 0.5
+) -> List[str]:
+    """
+    Compare results against baseline, returning a description of each regression
+
+    Latency and CPU time may rise by tolerance (e.g. 0.5 for 50%) plus a small absolute
+    slack, forks per sample may not rise at all and RSS growth may rise by up to 1MiB.
+    Scenarios without a baseline are skipped
+
+    Keyword arguments:
+        results -- dict, scenario name to results from run_scenario
+        baseline -- dict, scenario name to stored results
+        tolerance -- float, fraction timings may rise above baseline
+    """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        limits = {
+            metric: base[metric] * (1 + tolerance) + TIMING_SLACK_MS
+            for metric in TIMING_METRICS
+        }
+        limits["forks_per_sample"] = base["forks_per_sample"]
+        limits["rss_growth_kb"] = base["rss_growth_kb"] + RSS_SLACK_KB
+        for metric, limit in limits.items():
+            if res[metric] > limit:
+                regressions.append(
+                    f"{name}: {metric} {res[metric]} above baseline {base[metric]}"
+                )
+    return regressions
+
+
+def parse_args(inp_args):
+    """
+    Parse commandline args
+
+    Keyword arguments:
+        inp_args -- list, command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.benchmark",
+        description="benchmark collector latency and overhead against fake hardware",
+    )
+    parser.add_argument(
+        "-n", "--samples", default=200, type=int, help="samples to time per scenario"
+    )
+    parser.add_argument(
+        "--scenario",
+        default=[],
+        action="append",
+        choices=list(SCENARIOS),
+        help="scenario to run, can be given more than once. Runs all if not given",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=str(BASELINE_PATH),
+        help="json file of baseline results to compare against",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        default=False,
+        action="store_true",
+        help="write results to --baseline instead of comparing against it",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=0.5,
+        type=float,
+        help="fraction latency and CPU time may rise above baseline, e.g. 0.5 for 50%%",
+    )
+    parser.add_argument(
+        "--fixtures",
+        default=str(FIXTURES_DIR),
+        help="directory holding fixture files",
+    )
+    args = parser.parse_args(inp_args)
+    if args.samples < 1:
+        parser.error(f"--samples must be at least 1, got {args.samples}")
+    return args
+
+
+def main(inp_args=None) -> int:
+    """
+    Run benchmarks, writing results as csv to stdout and regressions to stderr
+
+    Returns exit status - 1 if any regressions were found
+
+    Keyword arguments:
+        inp_args -- list, command line arguments. Defaults to sys.argv
+    """
+    args = parse_args(sys.argv[1:] if inp_args is None else inp_args)
+    results = run_benchmarks(args.scenario, args.samples, Path(args.fixtures))
+    for i, (name, res) in enumerate(results.items()):
+        print(utils.to_csv({"scenario": name, **res}, i == 0))
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+            baseline_file.write("\n")
+        return 0
+
+    try:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        print(f"no baseline at {args.baseline}, nothing to compare", file=sys.stderr)
+        return 0
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"regression - {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
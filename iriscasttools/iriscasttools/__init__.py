@@ -1,3 +1,35 @@
 # SPDX-License-Identifier: Apache-2.0
 # Copyright (c) 2023 United Kingdom Research and Innovation
-from iriscasttools import __main__
+"""
+Tools to collect energy usage of a node for IRISCAST
+
+Submodules are imported on first use, e.g. iriscasttools.utils, so importing the package
+itself is cheap
+"""
+
+import importlib
+
+_SUBMODULES = (
+    "cgroups",
+    "collectors",
+    "daemon",
+    "exporter",
+    "fleet",
+    "ipmi",
+    "powersources",
+    "records",
+    "ringbuffer",
+    "sinks",
+    "stats",
+    "utils",
+)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *_SUBMODULES])
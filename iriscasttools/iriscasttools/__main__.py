@@ -1,23 +1,87 @@
 # SPDX-License-Identifier: Apache-2.0
 # Copyright (c) 2023 United Kingdom Research and Innovation
 import logging
-import logging.handlers
 import os
 import sys
-from iriscasttools.stats import get_iriscast_stats, parse_args
+from iriscasttools.stats import (
+    build_registry,
+    build_sink,
+    format_self_stats,
+    get_iriscast_stats,
+    parse_args,
+)
 
 
-def _prep_logging():
+def _prep_logging(stream=sys.stdout):
     logger = logging.getLogger("iriscasttools")
     logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
-    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.addHandler(logging.StreamHandler(stream))
+
+
+def _log_stream(cmd_args):
+    """
+    Stream to log to - stderr when rows are written to stdout, so logs don't end up
+    between rows. Only the exporter and daemon or fleet mode with --output log to stdout
+
+    Keyword arguments:
+        cmd_args -- argparse.Namespace, parsed command line args
+    """
+    if cmd_args.serve is not None:
+        return sys.stdout
+    if cmd_args.output and (cmd_args.daemon or cmd_args.fleet):
+        return sys.stdout
+    return sys.stderr
 
 
 def main():
     """main function to get iriscast stats"""
-    _prep_logging()
     cmd_args = parse_args(sys.argv[1:])
-    print(get_iriscast_stats(cmd_args.as_csv, cmd_args.include_header))
+    _prep_logging(_log_stream(cmd_args))
+    # modes other than a single sample are imported when used, so a one-off run from cron
+    # starts as quickly as possible
+    # pylint: disable=import-outside-toplevel
+    if cmd_args.fleet:
+        from iriscasttools.fleet import read_inventory, remote_command, run_fleet
+
+        sys.exit(
+            run_fleet(
+                read_inventory(cmd_args.fleet),
+                remote_command(cmd_args),
+                parallel=cmd_args.parallel,
+                timeout=cmd_args.host_timeout,
+                output=cmd_args.output,
+            )
+        )
+
+    with build_registry(cmd_args) as registry:
+        if cmd_args.serve is not None:
+            from iriscasttools.exporter import run_exporter
+
+            run_exporter(
+                cmd_args.interval,
+                cmd_args.serve,
+                bind=cmd_args.bind,
+                registry=registry,
+            )
+        elif cmd_args.daemon:
+            from iriscasttools.daemon import run_daemon
+
+            run_daemon(
+                cmd_args.interval,
+                as_csv=cmd_args.as_csv,
+                include_header=cmd_args.include_header,
+                output=cmd_args.output,
+                registry=registry,
+                aggregate_every=cmd_args.aggregate_every,
+                sink=build_sink(cmd_args),
+            )
+        else:
+            print(
+                get_iriscast_stats(cmd_args.as_csv, cmd_args.include_header, registry)
+            )
+
+    if cmd_args.self_stats:
+        print(format_self_stats(registry), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Reads CPU time used by each libvirt guest from its cgroup, used to split node power
+between VMs
+"""
+
+import logging
+import math
+import os
+import re
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MACHINE_SLICE = "machine.slice"
+
+# libvirt scopes look like machine-qemu\x2d12\x2dinstance\x2d0000abcd.scope
+_SCOPE_RE = re.compile(r"^machine-(?:qemu|kvm)-\d+-(?P<name>.+)\.scope$")
+_ESCAPE_RE = re.compile(r"\\x([0-9a-fA-F]{2})")
+
+
+def vm_name_from_scope(scope: str) -> Optional[str]:
+    """
+    Get libvirt domain name from its systemd scope name, None if not a libvirt guest
+
+    Keyword arguments:
+        scope -- str, name of scope directory e.g. machine-qemu\\x2d1\\x2dinstance\\x2d00000001.scope
+    """
+    unescaped = _ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), scope)
+    match = _SCOPE_RE.match(unescaped)
+    return match.group("name") if match else None
+
+
+def find_machine_slice(root: str = CGROUP_ROOT) -> Optional[Tuple[str, str, int]]:
+    """
+    Find machine.slice cgroup and the file holding each scope's CPU usage
+
+    Returns path to slice, name of usage file and nanoseconds per unit of usage, or None
+    if there is no machine.slice - e.g. no VMs have been started on this host
+
+    Keyword arguments:
+        root -- str, path cgroup filesystem is mounted on
+    """
+    # cgroup v2 - unified hierarchy, usage_usec in cpu.stat
+    slice_path = os.path.join(root, MACHINE_SLICE)
+    if os.path.exists(os.path.join(slice_path, "cpu.stat")):
+        return slice_path, "cpu.stat", 1000
+    # cgroup v1 - cpuacct controller, usage in nanoseconds
+    for controller in ("cpuacct", "cpu,cpuacct"):
+        slice_path = os.path.join(root, controller, MACHINE_SLICE)
+        if os.path.exists(os.path.join(slice_path, "cpuacct.usage")):
+            return slice_path, "cpuacct.usage", 1
+    return None
+
+
+def parse_cpu_usage(data: bytes, ns_per_unit: int) -> int:
+    """
+    Parse CPU usage read from cpu.stat or cpuacct.usage, returning nanoseconds
+
+    Keyword arguments:
+        data -- bytes, contents of usage file
+        ns_per_unit -- int, nanoseconds per unit of usage in file
+    """
+    if ns_per_unit == 1:
+        return int(data)
+    for line in data.splitlines():
+        key, _, val = line.partition(b" ")
+        if key == b"usage_usec":
+            return int(val) * ns_per_unit
+    raise ValueError("no usage_usec in cpu.stat")
+
+
+class CgroupCpuTracker:
+    """
+    Tracks CPU time used by each libvirt guest between samples
+
+    Usage files are kept open and re-read from the start each sample, so a sample costs a
+    directory listing plus one read per guest. Files are opened when a guest appears and
+    closed when it goes away.
+    """
+
+    def __init__(self, root: str = CGROUP_ROOT):
+        """
+        Keyword arguments:
+            root -- str, path cgroup filesystem is mounted on
+        """
+        self.root = root
+        # scope name to (vm name, open usage file descriptor)
+        self._files: Dict[str, Tuple[str, int]] = {}
+        # vm name to cpu nanoseconds used at last sample
+        self._last: Dict[str, int] = {}
+
+    def close(self):
+        """close all open usage files"""
+        for _, fd in self._files.values():
+            os.close(fd)
+        self._files = {}
+
+    def _scan(self, slice_path: str, usage_file: str):
+        """
+        Open usage files of new guests and close those of guests which have gone
+
+        Keyword arguments:
+            slice_path -- str, path to machine.slice cgroup
+            usage_file -- str, name of file holding each scope's CPU usage
+        """
+        with os.scandir(slice_path) as entries:
+            scopes = {e.name for e in entries if e.is_dir(follow_symlinks=False)}
+
+        for scope in set(self._files) - scopes:
+            os.close(self._files.pop(scope)[1])
+
+        for scope in scopes - set(self._files):
+            name = vm_name_from_scope(scope)
+            if name is None:
+                continue
+            try:
+                fd = os.open(
+                    os.path.join(slice_path, scope, usage_file),
+                    os.O_RDONLY | os.O_CLOEXEC,
+                )
+            except OSError as open_err:
+                # guest went away while scanning
+                logger.debug("cannot open usage of %s: %s", scope, repr(open_err))
+                continue
+            self._files[scope] = (name, fd)
+
+    def sample(self) -> Dict[str, Optional[int]]:
+        """
+        Get nanoseconds of CPU time used by each guest since the last sample
+
+        Guests seen for the first time, or whose usage went backwards because they were
+        restarted, have None as there is nothing to compare against
+        """
+        found = find_machine_slice(self.root)
+        if found is None:
+            self.close()
+            self._last = {}
+            return {}
+        slice_path, usage_file, ns_per_unit = found
+        self._scan(slice_path, usage_file)
+
+        usage = {}
+        for scope, (name, fd) in list(self._files.items()):
+            try:
+                usage[name] = parse_cpu_usage(os.pread(fd, 4096, 0), ns_per_unit)
+            except (OSError, ValueError) as read_err:
+                logger.debug("cannot read usage of %s: %s", scope, repr(read_err))
+                os.close(fd)
+                del self._files[scope]
+
+        deltas = {}
+        for name, used in usage.items():
+            last = self._last.get(name)
+            deltas[name] = used - last if last is not None and used >= last else None
+        self._last = usage
+        return deltas
+
+
+def split_power(power, cpu_deltas: Dict[str, Optional[int]]) -> Dict[str, float]:
+    """
+    Split power between guests in proportion to CPU time each used
+
+    Guests without a CPU time delta are left out. Returns an empty dict if power isn't
+    known or no guest used any CPU time
+
+    Keyword arguments:
+        power -- power in Watts to split, e.g. current_power
+        cpu_deltas -- dict, guest name to CPU time used since last sample
+    """
+    try:
+        power = float(power)
+    except (TypeError, ValueError):
+        return {}
+    if math.isnan(power):
+        return {}
+    deltas = {name: d for name, d in cpu_deltas.items() if d is not None}
+    total = sum(deltas.values())
+    if total <= 0:
+        return {}
+    return {name: round(power * d / total, 3) for name, d in deltas.items()}
+
+
+def format_vm_values(values: Dict[str, float]) -> str:
+    """
+    Format per-guest values as a single csv-safe field, e.g. instance-1=12.5;instance-2=3.0
+
+    Keyword arguments:
+        values -- dict, guest name to value
+    """
+    return ";".join(f"{name}={val}" for name, val in sorted(values.items()))
+
+
+def parse_vm_values(field: str) -> Dict[str, float]:
+    """
+    Parse a field written by format_vm_values
+
+    Keyword arguments:
+        field -- str, per-guest values e.g. instance-1=12.5;instance-2=3.0
+    """
+    res = {}
+    for item in field.split(";"):
+        name, sep, val = item.rpartition("=")
+        if sep:
+            res[name] = float(val)
+    return res
@@ -0,0 +1,506 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Registry of stat collectors. Each collector declares the fields it provides and its
+typical sampling cost, and the registry records how long each one actually takes
+"""
+
+import contextlib
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from iriscasttools import utils
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    from iriscasttools.powersources import PowerSource
+
+# cgroups and powersources are only needed by optional collectors, and concurrent.futures
+# only once collectors are run, so are imported when used to keep startup quick
+# pylint: disable=import-outside-toplevel
+
+logger = logging.getLogger(__name__)
+
+
+class Collector:
+    """
+    Base class for a source of iriscast stats
+
+    Subclasses set the class attributes below and implement sample()
+        name -- str, unique name used to refer to collector on the command line
+        fields -- all fields this collector can provide
+        default_fields -- fields collected if none are given
+        cost_ms -- float, declared typical time in milliseconds to take one sample
+        timeout_s -- float, seconds to wait for a sample. Uses registry timeout if None
+        requires -- fields from other collectors needed by combine()
+    """
+
+    name: str = ""
+    fields: Tuple[str, ...] = ()
+    default_fields: Tuple[str, ...] = ()
+    cost_ms: float = 0.0
+    timeout_s: Optional[float] = None
+    requires: Tuple[str, ...] = ()
+
+    def __init__(self, fields: Optional[Iterable[str]] = None):
+        """
+        Keyword arguments:
+            fields -- fields to collect, defaults to default_fields
+        """
+        self.selected_fields = tuple(fields) if fields else self.default_fields
+        invalid = set(self.selected_fields) - set(self.fields)
+        if invalid:
+            raise ValueError(f"collector {self.name} cannot provide fields {invalid}")
+
+    def sample(self, *fields) -> Dict:
+        """
+        Collect given fields, returning a dictionary of field to value
+
+        Keyword arguments:
+            *fields -- fields to collect
+        """
+        raise NotImplementedError
+
+    # pylint: disable=unused-argument
+    def combine(self, res: Dict, stats: Dict) -> Dict:
+        """
+        Finish a sample using fields from other collectors, called once all collectors in
+        the registry have run. Only called for collectors which set requires
+
+        Keyword arguments:
+            res -- dict, stats returned by sample()
+            stats -- dict, combined stats of all collectors
+        """
+        return res
+
+    def empty(self) -> Dict:
+        """Get selected fields with no values, used when sampling fails"""
+        return {x: "" for x in self.selected_fields}
+
+
+class IpmiPowerCollector(Collector):
+    """Power usage from BMC using IPMI DCMI"""
+
+    name = "power"
+    fields = (
+        "current_power",
+        "minimum_power_over_sampling_duration",
+        "maximum_power_over_sampling_duration",
+        "average_power_over_sampling_duration",
+        "statistics_reporting_time_period",
+        "time_stamp",
+        "power_measurement",
+    )
+    default_fields = ("current_power",)
+    cost_ms = 50.0
+
+    def sample(self, *fields):
+        return utils.get_ipmi_power_stats(*fields)
+
+
+class OsLoadCollector(Collector):
+    """OS load averages"""
+
+    name = "os_load"
+    fields = ("os_load_1", "os_load_5", "os_load_15")
+    default_fields = ("os_load_5",)
+    cost_ms = 0.01
+
+    def sample(self, *fields):
+        return utils.get_os_load(*fields)
+
+
+class RamUsageCollector(Collector):
+    """RAM and swap usage"""
+
+    name = "ram"
+    fields = (
+        "max_ram_kb",
+        "used_ram_kb",
+        "available_ram_kb",
+        "free_ram_kb",
+        "buffers_ram_kb",
+        "cached_ram_kb",
+        "swap_total_kb",
+        "swap_used_kb",
+        "ram_usage_percentage",
+    )
+    default_fields = ("ram_usage_percentage",)
+    cost_ms = 0.1
+
+    def sample(self, *fields):
+        return utils.get_ram_usage(*fields)
+
+
+class VmPowerCollector(Collector):
+    """
+    Per-VM power estimated by splitting current_power between libvirt guests in proportion
+    to the CPU time each used since the last sample
+
+    Per-VM fields hold a value per guest e.g. instance-00000001=12.5;instance-00000002=3.0
+    and are empty on the first sample, as CPU time is measured between samples
+    """
+
+    name = "vm_power"
+    fields = ("vm_count", "vm_cpu_seconds", "vm_power")
+    default_fields = ("vm_count", "vm_power")
+    cost_ms = 1.0
+    requires = ("current_power",)
+
+    def __init__(
+        self, fields: Optional[Iterable[str]] = None, cgroup_root: Optional[str] = None
+    ):
+        """
+        Keyword arguments:
+            fields -- fields to collect, defaults to default_fields
+            cgroup_root -- str, path cgroup filesystem is mounted on. Defaults to
+                cgroups.CGROUP_ROOT
+        """
+        from iriscasttools import cgroups
+
+        super().__init__(fields)
+        self.tracker = cgroups.CgroupCpuTracker(cgroup_root or cgroups.CGROUP_ROOT)
+        self._deltas: Dict[str, Optional[int]] = {}
+
+    def sample(self, *fields):
+        from iriscasttools import cgroups
+
+        self._deltas = self.tracker.sample()
+        res = {
+            "vm_count": len(self._deltas),
+            "vm_cpu_seconds": cgroups.format_vm_values(
+                {k: v / 1e9 for k, v in self._deltas.items() if v is not None}
+            ),
+            # filled in by combine once current_power is known
+            "vm_power": "",
+        }
+        return {f: res[f] for f in fields}
+
+    def combine(self, res, stats):
+        from iriscasttools import cgroups
+
+        if "vm_power" in res:
+            res["vm_power"] = cgroups.format_vm_values(
+                cgroups.split_power(stats.get("current_power"), self._deltas)
+            )
+        return res
+
+
+class SourcePowerCollector(Collector):
+    """
+    Power from the cheapest power source available on the host - RAPL, hwmon or IPMI
+
+    The source is picked on first sample. IPMI current_power from the power collector
+    stays the reference reading for the whole node - RAPL only covers CPU packages
+    """
+
+    name = "source_power"
+    fields = ("power_source", "source_power")
+    default_fields = ("power_source", "source_power")
+    cost_ms = 0.1
+
+    def __init__(
+        self,
+        fields: Optional[Iterable[str]] = None,
+        sources: Optional[Iterable["PowerSource"]] = None,
+    ):
+        """
+        Keyword arguments:
+            fields -- fields to collect, defaults to default_fields
+            sources -- power sources to pick from. Defaults to RAPL, hwmon and IPMI
+        """
+        from iriscasttools import powersources
+
+        super().__init__(fields)
+        if sources is None:
+            sources = [source() for source in powersources.SOURCES.values()]
+        self.sources = list(sources)
+        self.source: Optional["PowerSource"] = None
+
+    def sample(self, *fields):
+        from iriscasttools import powersources
+
+        if self.source is None:
+            self.source = powersources.select_source(self.sources)
+            if self.source is None:
+                raise RuntimeError(
+                    f"no power source available out of {[s.name for s in self.sources]}"
+                )
+        res = {
+            "power_source": self.source.name,
+            "source_power": round(self.source.read(), 3),
+        }
+        return {f: res[f] for f in fields}
+
+
+class CollectorTimings:
+    """
+    Wall time and failure counts recorded for a single collector
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.last_s = 0.0
+
+    def record(self, duration_s: float, failed: bool = False):
+        """
+        Record a single sample
+
+        Keyword arguments:
+            duration_s -- float, seconds taken to sample
+            failed -- bool, flag to set if sample failed
+        """
+        self.calls += 1
+        self.failures += int(failed)
+        self.total_s += duration_s
+        self.max_s = max(self.max_s, duration_s)
+        self.last_s = duration_s
+
+    @property
+    def mean_s(self) -> float:
+        """mean seconds taken per sample"""
+        return self.total_s / self.calls if self.calls else 0.0
+
+
+class CollectorRegistry:
+    """
+    An ordered set of collectors. Output fields follow the order collectors were registered
+
+    Collectors are run at the same time on a thread pool, so a sample takes as long as the
+    slowest collector rather than the sum of all of them. A collector which doesn't finish
+    within its timeout has its fields left empty.
+    """
+
+    def __init__(
+        self,
+        collectors: Optional[Iterable[Collector]] = None,
+        timeout_s: Optional[float] = None,
+    ):
+        """
+        Keyword arguments:
+            collectors -- collectors to register
+            timeout_s -- float, default seconds to wait for each collector. Waits forever if None
+        """
+        self._collectors: Dict[str, Collector] = {}
+        self._disabled = set()
+        self.timeout_s = timeout_s
+        self.timings: Dict[str, CollectorTimings] = {}
+        self._executor: Optional["ThreadPoolExecutor"] = None
+        # samples which timed out but are still running, keyed by collector name
+        self._inflight: Dict[str, "Future"] = {}
+        # collectors whose last sample failed, so a collector failing every sample only
+        # logs an error the first time
+        self._failing = set()
+        for collector in collectors or ():
+            self.register(collector)
+
+    def register(self, collector: Collector):
+        """
+        Add a collector, replacing any existing collector with same name
+
+        Keyword arguments:
+            collector -- collector to add
+        """
+        self._collectors[collector.name] = collector
+        self.timings[collector.name] = CollectorTimings()
+        # resize pool on next collect
+        self.close()
+
+    def disable(self, name: str):
+        """
+        Stop running a collector - its fields are left out of output
+
+        Keyword arguments:
+            name -- str, name of collector to disable
+        """
+        if name not in self._collectors:
+            raise ValueError(
+                f"unknown collector {name}, must be one of {list(self._collectors)}"
+            )
+        self._disabled.add(name)
+
+    def disable_above_cost(self, max_cost_ms: float):
+        """
+        Disable all collectors which declare a sampling cost above given value
+
+        Keyword arguments:
+            max_cost_ms -- float, maximum declared cost in milliseconds
+        """
+        for collector in self._collectors.values():
+            if collector.cost_ms > max_cost_ms:
+                self.disable(collector.name)
+
+    @property
+    def collectors(self) -> List[Collector]:
+        """enabled collectors in registration order"""
+        return [c for name, c in self._collectors.items() if name not in self._disabled]
+
+    def close(self):
+        """
+        Shut down thread pool without waiting for running collectors. A new pool is
+        created on next collect
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(
+        self, collector: Collector, timeout: Optional[float]
+    ) -> Tuple[Dict, float, bool]:
+        """
+        Run a single collector
+
+        Returns stats, time taken in seconds and whether collector failed. The first failure
+        is logged as an error and repeated failures at debug, until the collector succeeds
+        again
+
+        Keyword arguments:
+            collector -- collector to run
+            timeout -- float, seconds collector has to finish. Retries inside the collector
+                stop once this runs out
+        """
+        start = time.perf_counter()
+        try:
+            with (
+                utils.retry_budget(timeout)
+                if timeout is not None
+                else contextlib.nullcontext()
+            ):
+                res = collector.sample(*collector.selected_fields)
+            failed = False
+            self._failing.discard(collector.name)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            level = logging.DEBUG if collector.name in self._failing else logging.ERROR
+            logger.log(level, "collector %s failed: %s", collector.name, repr(exc))
+            self._failing.add(collector.name)
+            failed = True
+            res = collector.empty()
+        return res, time.perf_counter() - start, failed
+
+    def _get_timeout(self, collector: Collector) -> Optional[float]:
+        """
+        Get seconds to wait for collector - its own timeout or the registry default
+
+        Keyword arguments:
+            collector -- collector to get timeout for
+        """
+        if collector.timeout_s is not None:
+            return collector.timeout_s
+        return self.timeout_s
+
+    def _submit(self, collector: Collector) -> Optional["Future"]:
+        """
+        Start collector on thread pool
+
+        Returns None if an earlier sample from this collector is still running, so a hung
+        collector does not pile up threads
+
+        Keyword arguments:
+            collector -- collector to run
+        """
+        inflight = self._inflight.get(collector.name)
+        if inflight is not None:
+            if not inflight.done():
+                return None
+            del self._inflight[collector.name]
+
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self._collectors),
+                thread_name_prefix="iriscast-collector",
+            )
+        return self._executor.submit(self._run, collector, self._get_timeout(collector))
+
+    def collect(self) -> Dict:
+        """
+        Run all enabled collectors concurrently, returning their combined stats
+
+        A collector which fails or times out leaves its fields empty rather than failing the
+        whole sample
+        """
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+
+        collectors = self.collectors
+        start = time.monotonic()
+        futures = {c.name: self._submit(c) for c in collectors}
+
+        all_stats = {}
+        results = {}
+        for collector in collectors:
+            future = futures[collector.name]
+            timeout = self._get_timeout(collector)
+            if future is None:
+                logger.warning(
+                    "collector %s still running from previous sample, skipping",
+                    collector.name,
+                )
+                self.timings[collector.name].record(0.0, failed=True)
+                all_stats.update(collector.empty())
+                continue
+
+            remaining = (
+                None
+                if timeout is None
+                else max(0.0, start + timeout - time.monotonic())
+            )
+            try:
+                res, duration, failed = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                logger.warning(
+                    "collector %s timed out after %ss", collector.name, timeout
+                )
+                self._inflight[collector.name] = future
+                res, duration, failed = collector.empty(), timeout, True
+
+            self.timings[collector.name].record(duration, failed)
+            all_stats.update(res)
+            if not failed:
+                results[collector.name] = res
+
+        for collector in collectors:
+            if collector.requires and collector.name in results:
+                all_stats.update(collector.combine(results[collector.name], all_stats))
+        return all_stats
+
+    def self_stats(self) -> List[Dict]:
+        """
+        Get recorded timings for each registered collector
+        """
+        return [
+            {
+                "collector": name,
+                "enabled": name not in self._disabled,
+                "declared_cost_ms": collector.cost_ms,
+                "calls": self.timings[name].calls,
+                "failures": self.timings[name].failures,
+                "mean_ms": round(self.timings[name].mean_s * 1000, 3),
+                "max_ms": round(self.timings[name].max_s * 1000, 3),
+                "last_ms": round(self.timings[name].last_s * 1000, 3),
+            }
+            for name, collector in self._collectors.items()
+        ]
+
+
+def default_registry(timeout_s: Optional[float] = None) -> CollectorRegistry:
+    """
+    Get a registry of collectors used by default - power, OS load and RAM usage
+
+    Keyword arguments:
+        timeout_s -- float, seconds to wait for each collector. Waits forever if None
+    """
+    return CollectorRegistry(
+        [IpmiPowerCollector(), OsLoadCollector(), RamUsageCollector()], timeout_s
+    )
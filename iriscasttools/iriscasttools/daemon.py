@@ -0,0 +1,250 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Long-running sampling mode - keeps a single process alive and collects iriscast stats
+on a fixed-interval schedule rather than re-starting python for every sample
+"""
+
+import datetime
+import logging
+import signal
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Union
+
+from iriscasttools.collectors import CollectorRegistry, default_registry
+from iriscasttools.ringbuffer import DEFAULT_WINDOWS, SampleRingBuffer, capacity_for
+from iriscasttools.sinks import FileSink, StreamSink
+from iriscasttools.stats import get_iriscast_stats
+
+logger = logging.getLogger(__name__)
+
+Sink = Union[StreamSink, FileSink]
+
+
+def sample_schedule(
+    interval: float,
+    stop_event: threading.Event,
+    clock: Callable[[], float] = time.monotonic,
+    max_samples: Optional[int] = None,
+) -> Iterator[int]:
+    """
+    Yield tick numbers on a drift-free schedule
+
+    Each tick is anchored to the time the schedule started (start + tick * interval) so
+    time spent collecting a sample does not push later samples back. If a sample overruns
+    one or more intervals, the missed ticks are skipped rather than run back-to-back.
+
+    Keyword arguments:
+        interval -- float, seconds between each tick
+        stop_event -- threading.Event, schedule stops when this is set
+        clock -- a monotonic clock function returning seconds
+        max_samples -- int, stop after this many ticks. Runs forever if None
+    """
+    start = clock()
+    tick = 0
+    samples = 0
+    while max_samples is None or samples < max_samples:
+        delay = start + (tick * interval) - clock()
+        if delay > 0 and stop_event.wait(delay):
+            return
+        if stop_event.is_set():
+            return
+
+        yield tick
+        samples += 1
+
+        elapsed = clock() - start
+        next_tick = int(elapsed // interval) + 1
+        if next_tick > tick + 1:
+            logger.warning(
+                "sample %s overran interval of %ss, skipping %s sample(s)",
+                tick,
+                interval,
+                next_tick - tick - 1,
+            )
+        tick = max(tick + 1, next_tick)
+
+
+def get_timestamped_stats(registry: Optional[CollectorRegistry] = None):
+    """
+    Get iriscast stats with the time the sample was taken prepended as an ISO-8601 UTC
+    timestamp
+
+    Keyword arguments:
+        registry -- CollectorRegistry, collectors to run. Defaults to power, OS load and RAM
+    """
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(
+        timespec="seconds"
+    )
+    stats = {"timestamp": timestamp}
+    stats.update(get_iriscast_stats(registry=registry))
+    return stats
+
+
+class Sampler:
+    """
+    Collects timestamped samples, keeping the latest one and a rolling history used for
+    min/max/avg aggregates
+    """
+
+    def __init__(
+        self,
+        registry: CollectorRegistry,
+        interval: float,
+        windows: Optional[Dict[str, float]] = None,
+    ):
+        """
+        Keyword arguments:
+            registry -- CollectorRegistry, collectors to run
+            interval -- float, seconds between samples, used to size history
+            windows -- dict, aggregate window name to length in seconds. Defaults to 1, 5
+                and 15 minutes
+        """
+        self.registry = registry
+        self.windows = windows if windows is not None else DEFAULT_WINDOWS
+        self.capacity = capacity_for(interval, self.windows)
+        self.history: Optional[SampleRingBuffer] = None
+        self.latest: Optional[Dict] = None
+
+    def sample(self) -> Dict:
+        """
+        Collect a sample, record it in history and return it
+        """
+        stats = get_timestamped_stats(self.registry)
+        if self.history is None:
+            # history fields are fixed by the first sample
+            self.history = SampleRingBuffer(
+                [k for k in stats if k != "timestamp"], self.capacity
+            )
+        self.history.append(stats, time.time())
+        self.latest = stats
+        return stats
+
+    def aggregates(self) -> Dict:
+        """
+        Get rolling aggregates of samples collected so far, with timestamp of latest sample
+        """
+        if self.history is None:
+            return {}
+        res = {"timestamp": self.latest["timestamp"]}
+        res.update(self.history.aggregates(self.windows))
+        return res
+
+
+def install_signal_handlers(stop_event: threading.Event):
+    """
+    Stop the daemon cleanly on SIGTERM/SIGINT
+
+    Keyword arguments:
+        stop_event -- threading.Event to set when a stop signal is received
+    """
+
+    def _handler(signum, _frame):
+        logger.info("received signal %s, stopping", signum)
+        stop_event.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _handler)
+
+
+def _sample_loop(
+    sampler: Sampler,
+    sink: Sink,
+    schedule: Iterator[int],
+    aggregate_every: Optional[float] = None,
+):
+    """
+    Take a sample on every tick of schedule, writing either each sample or aggregates
+
+    Keyword arguments:
+        sampler -- Sampler to collect samples with
+        sink -- sink to write rows to
+        schedule -- iterator yielding when each sample should be taken
+        aggregate_every -- float, seconds between writing aggregate rows. Every sample is
+            written if None
+    """
+    next_aggregate = time.monotonic()
+    for _ in schedule:
+        try:
+            stats = sampler.sample()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            # a single failed sample should not kill a long-running process
+            logger.error("failed to collect sample: %s", repr(exc))
+            continue
+
+        if aggregate_every is None:
+            sink.write(stats)
+        elif time.monotonic() >= next_aggregate:
+            while next_aggregate <= time.monotonic():
+                next_aggregate += aggregate_every
+            sink.write(sampler.aggregates())
+
+
+# pylint: disable=too-many-arguments
+def run_daemon(
+    interval: float,
+    *,
+    as_csv: bool = True,
+    include_header: bool = False,
+    output: Optional[str] = None,
+    max_samples: Optional[int] = None,
+    stop_event: Optional[threading.Event] = None,
+    registry: Optional[CollectorRegistry] = None,
+    aggregate_every: Optional[float] = None,
+    sink: Optional[Sink] = None,
+):
+    """
+    Collect iriscast stats every interval seconds until stopped
+
+    If aggregate_every is set, rows of rolling 1, 5 and 15 minute min/max/avg of each
+    field are written every aggregate_every seconds instead of every raw sample
+
+    Keyword arguments:
+        interval -- float, seconds between each sample
+        as_csv -- bool, flag to set if each row should be written as csv or dict
+        include_header -- bool, flag to set if a csv header should be written before the first row
+        output -- str, filepath to append rows to. Rows are written to stdout if None
+        max_samples -- int, stop after this many samples. Runs until signalled if None
+        stop_event -- threading.Event, set to stop the daemon. One is created if None
+        registry -- CollectorRegistry, collectors to run. Defaults to power, OS load and RAM
+        aggregate_every -- float, seconds between writing aggregate rows
+        sink -- StreamSink or FileSink to write rows to. If given, as_csv, include_header
+            and output are ignored
+    """
+    if interval <= 0:
+        raise ValueError(f"interval must be greater than 0, got {interval}")
+    if aggregate_every is not None and aggregate_every <= 0:
+        raise ValueError(
+            f"aggregate_every must be greater than 0, got {aggregate_every}"
+        )
+
+    owns_registry = registry is None
+    if owns_registry:
+        # keep one registry for lifetime of daemon so collector timings accumulate
+        registry = default_registry(timeout_s=interval)
+
+    if stop_event is None:
+        stop_event = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            install_signal_handlers(stop_event)
+
+    if sink is None:
+        if output:
+            sink = FileSink(
+                output, as_csv=as_csv, include_header=include_header, batch_rows=1
+            )
+        else:
+            sink = StreamSink(sys.stdout, as_csv, include_header)
+    try:
+        _sample_loop(
+            Sampler(registry, interval),
+            sink,
+            sample_schedule(interval, stop_event, max_samples=max_samples),
+            aggregate_every,
+        )
+    finally:
+        sink.close()
+        if owns_registry:
+            registry.close()
@@ -0,0 +1,272 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Serves the latest iriscast sample over HTTP in Prometheus text exposition format.
+Samples are collected on a fixed schedule and cached, so a scrape never waits on IPMI
+"""
+
+import logging
+import math
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from iriscasttools.cgroups import parse_vm_values
+from iriscasttools.collectors import CollectorRegistry, default_registry
+from iriscasttools.daemon import Sampler, install_signal_handlers, sample_schedule
+from iriscasttools.ringbuffer import to_float
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# field to metric name and help text. Other numeric fields are exported as iriscast_<field>
+FIELD_METRICS = {
+    "current_power": ("iriscast_power_watts", "Current power draw reported by BMC"),
+    "minimum_power_over_sampling_duration": (
+        "iriscast_bmc_power_min_watts",
+        "Minimum power draw over BMC sampling period",
+    ),
+    "maximum_power_over_sampling_duration": (
+        "iriscast_bmc_power_max_watts",
+        "Maximum power draw over BMC sampling period",
+    ),
+    "average_power_over_sampling_duration": (
+        "iriscast_bmc_power_avg_watts",
+        "Average power draw over BMC sampling period",
+    ),
+    "os_load_1": ("iriscast_os_load_1", "OS load average over 1 minute"),
+    "os_load_5": ("iriscast_os_load_5", "OS load average over 5 minutes"),
+    "os_load_15": ("iriscast_os_load_15", "OS load average over 15 minutes"),
+    "ram_usage_percentage": (
+        "iriscast_ram_usage_percent",
+        "Used RAM as percentage of total RAM",
+    ),
+}
+
+
+def escape_label(val: str) -> str:
+    """
+    Escape a label value for Prometheus text format
+
+    Keyword arguments:
+        val -- str, label value
+    """
+    return val.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    Format labels as {key="value",...}
+
+    Keyword arguments:
+        labels -- dict, label name to value
+    """
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+def format_value(val: float) -> str:
+    """
+    Format a sample value, using Prometheus spelling of special floats
+
+    Keyword arguments:
+        val -- float, value to format
+    """
+    if math.isnan(val):
+        return "NaN"
+    if math.isinf(val):
+        return "+Inf" if val > 0 else "-Inf"
+    return repr(val)
+
+
+def _metric_name(field: str):
+    """get metric name and help text for a sample field"""
+    return FIELD_METRICS.get(field, (f"iriscast_{field}", f"iriscast {field}"))
+
+
+def render_metrics(sampler: Sampler, hostname: str) -> str:
+    """
+    Render latest sample, rolling aggregates and collector timings as Prometheus text
+
+    Keyword arguments:
+        sampler -- Sampler holding latest sample and sample history
+        hostname -- str, value of host label
+    """
+    host = {"host": hostname}
+    lines: List[str] = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, val in samples:
+            lines.append(f"{name}{format_labels(labels)} {format_value(val)}")
+
+    latest = sampler.latest or {}
+    if latest.get("vm_power"):
+        add(
+            "iriscast_vm_power_watts",
+            "gauge",
+            "Share of current power draw attributed to VM by CPU time",
+            [
+                ({**host, "vm": vm}, val)
+                for vm, val in parse_vm_values(latest["vm_power"]).items()
+            ],
+        )
+    for field, val in latest.items():
+        val = to_float(val)
+        # missing or non-numeric fields, e.g. timestamps, are left out
+        if not math.isnan(val):
+            name, help_text = _metric_name(field)
+            add(name, "gauge", help_text, [(host, val)])
+
+    if sampler.history is not None:
+        windows = {
+            window: sampler.history.aggregate(window_s)
+            for window, window_s in sampler.windows.items()
+        }
+        for field in sampler.history.fields:
+            name, help_text = _metric_name(field)
+            for stat in ("min", "max", "avg"):
+                samples = [
+                    ({**host, "window": window}, agg[field][stat])
+                    for window, agg in windows.items()
+                    if agg[field][stat] != ""
+                ]
+                if samples:
+                    add(
+                        f"{name}_{stat}_over_window",
+                        "gauge",
+                        f"Rolling {stat} of: {help_text}",
+                        samples,
+                    )
+
+    timings = sampler.registry.self_stats()
+    add(
+        "iriscast_collector_last_duration_seconds",
+        "gauge",
+        "Time taken by collector on last sample",
+        [({**host, "collector": t["collector"]}, t["last_ms"] / 1000) for t in timings],
+    )
+    add(
+        "iriscast_collector_failures_total",
+        "counter",
+        "Number of samples a collector failed or timed out on",
+        [
+            ({**host, "collector": t["collector"]}, float(t["failures"]))
+            for t in timings
+        ],
+    )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    HTTP server returning a cached metrics page on /metrics
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address):
+        """
+        Keyword arguments:
+            server_address -- tuple, (host, port) to listen on
+        """
+        super().__init__(server_address, MetricsHandler)
+        self._body = b""
+        self._lock = threading.Lock()
+
+    @property
+    def body(self) -> bytes:
+        """latest metrics page"""
+        with self._lock:
+            return self._body
+
+    def update(self, metrics: str):
+        """
+        Replace cached metrics page
+
+        Keyword arguments:
+            metrics -- str, metrics page in Prometheus text format
+        """
+        with self._lock:
+            self._body = metrics.encode("utf-8")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Request handler returning cached metrics page from MetricsServer
+    """
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """handle GET request"""
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+# pylint: disable=too-many-arguments
+def run_exporter(
+    interval: float,
+    port: int,
+    *,
+    bind: str = "",
+    registry: Optional[CollectorRegistry] = None,
+    max_samples: Optional[int] = None,
+    stop_event: Optional[threading.Event] = None,
+):
+    """
+    Serve iriscast stats on http://<bind>:<port>/metrics, sampling every interval seconds
+
+    Keyword arguments:
+        interval -- float, seconds between each sample
+        port -- int, port to listen on
+        bind -- str, address to listen on. Listens on all addresses if empty
+        registry -- CollectorRegistry, collectors to run. Defaults to power, OS load and RAM
+        max_samples -- int, stop after this many samples. Runs until signalled if None
+        stop_event -- threading.Event, set to stop the exporter. One is created if None
+    """
+    if interval <= 0:
+        raise ValueError(f"interval must be greater than 0, got {interval}")
+
+    owns_registry = registry is None
+    if owns_registry:
+        registry = default_registry(timeout_s=interval)
+
+    if stop_event is None:
+        stop_event = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            install_signal_handlers(stop_event)
+
+    hostname = socket.getfqdn()
+    sampler = Sampler(registry, interval)
+    server = MetricsServer((bind, port))
+    server_thread = threading.Thread(
+        target=server.serve_forever, name="iriscast-exporter", daemon=True
+    )
+    server_thread.start()
+    logger.info("serving metrics on %s:%s/metrics", bind or "*", port)
+    try:
+        for _ in sample_schedule(interval, stop_event, max_samples=max_samples):
+            try:
+                sampler.sample()
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                logger.error("failed to collect sample: %s", repr(exc))
+                continue
+            server.update(render_metrics(sampler, hostname))
+    finally:
+        server.shutdown()
+        server.server_close()
+        if owns_registry:
+            registry.close()
@@ -0,0 +1,281 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Runs iriscasttools on many hosts at once over SSH and merges their stats into a single csv
+"""
+
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from iriscasttools import utils
+
+SSH_COMMAND = ("ssh", "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=accept-new")
+REMOTE_COMMAND = ("python3", "-m", "iriscasttools", "--as-csv", "--include-header")
+
+
+# pylint: disable=too-few-public-methods
+class HostResult:
+    """
+    Outcome of collecting stats from a single host
+    """
+
+    def __init__(
+        self,
+        host: str,
+        stats: Optional[Dict] = None,
+        error: Optional[str] = None,
+        duration_s: float = 0.0,
+    ):
+        """
+        Keyword arguments:
+            host -- str, host stats were collected from
+            stats -- dict, stats collected. None if collection failed
+            error -- str, reason collection failed. None if it succeeded
+            duration_s -- float, seconds taken to collect
+        """
+        self.host = host
+        self.stats = stats
+        self.error = error
+        self.duration_s = duration_s
+
+    @property
+    def failed(self) -> bool:
+        """True if stats could not be collected from host"""
+        return self.error is not None
+
+
+def read_inventory(path: str) -> List[str]:
+    """
+    Read hosts from an inventory file, one per line. Blank lines and # comments are ignored,
+    as are repeated hosts
+
+    Keyword arguments:
+        path -- str, path to inventory file, or - to read from stdin
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(path, encoding="utf-8") as inventory:
+            lines = inventory.readlines()
+
+    hosts = {}
+    for line in lines:
+        host = line.split("#", 1)[0].strip()
+        if host:
+            hosts[host] = None
+    return list(hosts)
+
+
+def parse_csv_output(out: str) -> Dict:
+    """
+    Parse output of iriscasttools --as-csv --include-header into a dict
+
+    Keyword arguments:
+        out -- str, stdout of remote command
+    """
+    lines = [line for line in out.splitlines() if line.strip()]
+    if len(lines) < 2:
+        raise ValueError(f"expected csv header and row, got {out!r}")
+    header, row = lines[-2].split(","), lines[-1].split(",")
+    if len(header) != len(row):
+        raise ValueError(
+            f"csv header and row lengths differ: {lines[-2]!r}, {lines[-1]!r}"
+        )
+    return dict(zip(header, row))
+
+
+def collect_host(
+    host: str,
+    remote_cmd: Sequence[str] = REMOTE_COMMAND,
+    timeout: float = 30.0,
+    ssh_cmd: Sequence[str] = SSH_COMMAND,
+) -> HostResult:
+    """
+    Run iriscasttools on a host over SSH
+
+    Never raises - failures are returned as a HostResult with error set
+
+    Keyword arguments:
+        host -- str, host to connect to
+        remote_cmd -- command to run on host, must write a csv header and row
+        timeout -- float, seconds to wait for host, including connecting
+        ssh_cmd -- ssh command and options
+    """
+    cmd = [
+        *ssh_cmd,
+        "-o",
+        f"ConnectTimeout={max(1, int(timeout))}",
+        host,
+        shlex.join(remote_cmd),
+    ]
+    start = time.monotonic()
+    try:
+        res = subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+            check=False,
+            stdin=subprocess.DEVNULL,
+        )
+    except subprocess.TimeoutExpired:
+        return HostResult(host, error=f"timed out after {timeout}s", duration_s=timeout)
+    except OSError as run_err:
+        return HostResult(
+            host, error=repr(run_err), duration_s=time.monotonic() - start
+        )
+
+    duration = time.monotonic() - start
+    if res.returncode != 0:
+        stderr = res.stderr.strip().splitlines()
+        reason = stderr[-1] if stderr else "no output"
+        return HostResult(
+            host, error=f"exit code {res.returncode}: {reason}", duration_s=duration
+        )
+    try:
+        return HostResult(host, stats=parse_csv_output(res.stdout), duration_s=duration)
+    except ValueError as parse_err:
+        return HostResult(host, error=str(parse_err), duration_s=duration)
+
+
+def collect_fleet(
+    hosts: Iterable[str],
+    remote_cmd: Sequence[str] = REMOTE_COMMAND,
+    *,
+    parallel: int = 64,
+    timeout: float = 30.0,
+    ssh_cmd: Sequence[str] = SSH_COMMAND,
+) -> List[HostResult]:
+    """
+    Collect stats from many hosts at once, with at most parallel connections open
+
+    Results are returned in the same order as hosts
+
+    Keyword arguments:
+        hosts -- hosts to collect from
+        remote_cmd -- command to run on each host
+        parallel -- int, maximum number of hosts to connect to at once
+        timeout -- float, seconds to wait for each host
+        ssh_cmd -- ssh command and options
+    """
+    if parallel < 1:
+        raise ValueError(f"parallel must be at least 1, got {parallel}")
+    hosts = list(hosts)
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(
+        max_workers=min(parallel, len(hosts)), thread_name_prefix="iriscast-fleet"
+    ) as executor:
+        return list(
+            executor.map(
+                lambda host: collect_host(host, remote_cmd, timeout, ssh_cmd), hosts
+            )
+        )
+
+
+def merge_results(results: Iterable[HostResult]) -> str:
+    """
+    Merge stats of all hosts which succeeded into a csv with a header, with host as the
+    first column
+
+    Hosts may report different fields, e.g. if a collector is disabled on some of them -
+    columns are the union of all fields, left empty for hosts without them
+
+    Keyword arguments:
+        results -- results to merge
+    """
+    ok = [r for r in results if not r.failed]
+    fields = {}
+    for res in ok:
+        fields.update(dict.fromkeys(res.stats))
+    rows = [
+        {"host": res.host, **{f: res.stats.get(f, "") for f in fields}} for res in ok
+    ]
+    if not rows:
+        return ""
+    return "\n".join(utils.to_csv(row, i == 0) for i, row in enumerate(rows))
+
+
+def format_failures(results: Iterable[HostResult]) -> str:
+    """
+    Summarise hosts which failed, one per line
+
+    Keyword arguments:
+        results -- results to summarise
+    """
+    results = list(results)
+    failed = [r for r in results if r.failed]
+    lines = [f"{len(failed)} of {len(results)} hosts failed"]
+    lines.extend(f"{r.host}: {r.error}" for r in failed)
+    return "\n".join(lines)
+
+
+# pylint: disable=too-many-arguments
+def run_fleet(
+    hosts: Iterable[str],
+    remote_cmd: Sequence[str] = REMOTE_COMMAND,
+    *,
+    parallel: int = 64,
+    timeout: float = 30.0,
+    output: Optional[str] = None,
+    ssh_cmd: Sequence[str] = SSH_COMMAND,
+) -> int:
+    """
+    Collect stats from all hosts, write merged csv to output and report how many hosts
+    succeeded and which failed on stderr
+
+    Returns exit status - 0 if all hosts succeeded, 1 if any failed
+
+    Keyword arguments:
+        hosts -- hosts to collect from
+        remote_cmd -- command to run on each host
+        parallel -- int, maximum number of hosts to connect to at once
+        timeout -- float, seconds to wait for each host
+        output -- str, file to write csv to. Writes to stdout if None
+        ssh_cmd -- ssh command and options
+    """
+    start = time.monotonic()
+    results = collect_fleet(
+        hosts, remote_cmd, parallel=parallel, timeout=timeout, ssh_cmd=ssh_cmd
+    )
+    merged = merge_results(results)
+    if output:
+        with open(output, "w", encoding="utf-8") as out_file:
+            out_file.write(merged + "\n" if merged else "")
+    elif merged:
+        print(merged)
+
+    # diagnostics go to stderr so stdout only holds the merged csv
+    n_failed = sum(r.failed for r in results)
+    print(
+        f"collected from {len(results) - n_failed} of {len(results)} hosts in "
+        f"{time.monotonic() - start:.1f}s",
+        file=sys.stderr,
+    )
+    if n_failed:
+        print(format_failures(results), file=sys.stderr)
+        return 1
+    return 0
+
+
+def remote_command(cmd_args) -> List[str]:
+    """
+    Build command to run on each host, passing on collector options from command line args
+
+    Keyword arguments:
+        cmd_args -- argparse.Namespace, parsed command line args
+    """
+    cmd = list(REMOTE_COMMAND)
+    for name in cmd_args.disable:
+        cmd += ["--disable", name]
+    if cmd_args.max_cost is not None:
+        cmd += ["--max-cost", str(cmd_args.max_cost)]
+    if cmd_args.power_source is not None:
+        cmd += ["--power-source", cmd_args.power_source]
+    # collectors on the host shouldn't outlast the host timeout
+    cmd += ["--timeout", str(min(cmd_args.timeout, cmd_args.host_timeout))]
+    return cmd
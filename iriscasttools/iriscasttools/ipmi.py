@@ -0,0 +1,300 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Reads DCMI power statistics in-process through the Linux kernel IPMI driver (/dev/ipmi0)
+rather than forking ipmi-dcmi for every sample
+"""
+
+import ctypes
+import datetime
+import fcntl
+import logging
+import os
+import select
+import struct
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# from linux/ipmi.h
+IPMI_SYSTEM_INTERFACE_ADDR_TYPE = 0x0C
+IPMI_BMC_CHANNEL = 0x0F
+IPMI_RESPONSE_RECV_TYPE = 1
+
+# DCMI Get Power Reading - DCMI spec v1.5 section 6.6.1
+DCMI_NETFN = 0x2C
+DCMI_GROUP_EXTENSION_ID = 0xDC
+DCMI_CMD_GET_POWER_READING = 0x02
+DCMI_SYSTEM_POWER_STATISTICS_MODE = 0x01
+DCMI_POWER_MEASUREMENT_ACTIVE = 0x40
+
+IPMI_MAX_MSG_LENGTH = 272
+
+# failed readings in a row after which a device is no longer read in-process
+MAX_FAILURES = 3
+
+
+class IpmiError(Exception):
+    """
+    raised when the BMC returns an error or an unexpected response
+    """
+
+
+# pylint: disable=too-few-public-methods
+class IpmiSystemInterfaceAddr(ctypes.Structure):
+    """struct ipmi_system_interface_addr"""
+
+    _fields_ = [
+        ("addr_type", ctypes.c_int),
+        ("channel", ctypes.c_short),
+        ("lun", ctypes.c_ubyte),
+    ]
+
+
+class IpmiMsg(ctypes.Structure):
+    """struct ipmi_msg"""
+
+    _fields_ = [
+        ("netfn", ctypes.c_ubyte),
+        ("cmd", ctypes.c_ubyte),
+        ("data_len", ctypes.c_ushort),
+        ("data", ctypes.POINTER(ctypes.c_ubyte)),
+    ]
+
+
+class IpmiReq(ctypes.Structure):
+    """struct ipmi_req"""
+
+    _fields_ = [
+        ("addr", ctypes.c_void_p),
+        ("addr_len", ctypes.c_uint),
+        ("msgid", ctypes.c_long),
+        ("msg", IpmiMsg),
+    ]
+
+
+class IpmiRecv(ctypes.Structure):
+    """struct ipmi_recv"""
+
+    _fields_ = [
+        ("recv_type", ctypes.c_int),
+        ("addr", ctypes.c_void_p),
+        ("addr_len", ctypes.c_uint),
+        ("msgid", ctypes.c_long),
+        ("msg", IpmiMsg),
+    ]
+
+
+# pylint: enable=too-few-public-methods
+
+
+def _ioc(direction: int, number: int, size: int) -> int:
+    """
+    Build an ioctl request number, equivalent to the _IOC macro in asm-generic/ioctl.h
+
+    Keyword Arguments:
+        direction -- int, _IOC_READ (2) and/or _IOC_WRITE (1)
+        number -- int, command number
+        size -- int, size of argument struct
+    """
+    return (direction << 30) | (size << 16) | (ord("i") << 8) | number
+
+
+IPMICTL_RECEIVE_MSG_TRUNC = _ioc(2 | 1, 11, ctypes.sizeof(IpmiRecv))
+IPMICTL_SEND_COMMAND = _ioc(2, 13, ctypes.sizeof(IpmiReq))
+
+
+def parse_power_reading(data: bytes) -> Dict:
+    """
+    Parse response data of a DCMI Get Power Reading command
+
+    Returns values in the same format as ipmi-dcmi --get-system-power-statistics
+
+    Keyword Arguments:
+        data -- bytes, response data starting with completion code
+    """
+    if not data:
+        raise IpmiError("empty response to DCMI Get Power Reading")
+    if data[0] != 0:
+        raise IpmiError(f"DCMI Get Power Reading failed, completion code {data[0]:#x}")
+    if len(data) < 19 or data[1] != DCMI_GROUP_EXTENSION_ID:
+        raise IpmiError(f"malformed DCMI Get Power Reading response {data.hex()}")
+
+    (
+        current_power,
+        minimum_power,
+        maximum_power,
+        average_power,
+        time_stamp,
+        period,
+        state,
+    ) = struct.unpack_from("<HHHHIIB", data, 2)
+
+    return {
+        "current_power": current_power,
+        "minimum_power_over_sampling_duration": minimum_power,
+        "maximum_power_over_sampling_duration": maximum_power,
+        "average_power_over_sampling_duration": average_power,
+        "time_stamp": datetime.datetime.fromtimestamp(time_stamp).strftime(
+            "%m/%d/%Y - %H:%M:%S"
+        ),
+        "statistics_reporting_time_period": period,
+        "power_measurement": (
+            "Active" if state & DCMI_POWER_MEASUREMENT_ACTIVE else "Not Available"
+        ),
+    }
+
+
+class DcmiPowerReader:
+    """
+    Holds an open IPMI device and issues DCMI Get Power Reading requests through it
+
+    The device is opened on first use and kept open between readings
+    """
+
+    def __init__(self, device_path: str, timeout: float = 2.0):
+        """
+        Keyword Arguments:
+            device_path -- str, path to IPMI device e.g. /dev/ipmi0
+            timeout -- float, seconds to wait for the BMC to respond
+        """
+        self.device_path = device_path
+        self.timeout = timeout
+        self._fd = None
+        self._msgid = 0
+        self._lock = threading.Lock()
+        # failed readings since the last one which succeeded
+        self.failures = 0
+
+    def open(self):
+        """open IPMI device if not already open"""
+        if self._fd is None:
+            self._fd = os.open(self.device_path, os.O_RDWR | os.O_CLOEXEC)
+
+    def close(self):
+        """close IPMI device, it will be re-opened on next reading"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, netfn: int, cmd: int, data: bytes) -> bytes:
+        """
+        Send a request to the BMC and wait for the response
+
+        Keyword Arguments:
+            netfn -- int, network function code
+            cmd -- int, command code
+            data -- bytes, request data
+        """
+        self._msgid += 1
+        addr = IpmiSystemInterfaceAddr(
+            IPMI_SYSTEM_INTERFACE_ADDR_TYPE, IPMI_BMC_CHANNEL, 0
+        )
+        req_data = (ctypes.c_ubyte * len(data)).from_buffer_copy(data)
+        req = IpmiReq(
+            ctypes.addressof(addr),
+            ctypes.sizeof(addr),
+            self._msgid,
+            IpmiMsg(netfn, cmd, len(data), req_data),
+        )
+        fcntl.ioctl(self._fd, IPMICTL_SEND_COMMAND, req)
+
+        recv_addr = IpmiSystemInterfaceAddr()
+        recv_data = (ctypes.c_ubyte * IPMI_MAX_MSG_LENGTH)()
+        while True:
+            readable, _, _ = select.select([self._fd], [], [], self.timeout)
+            if not readable:
+                raise IpmiError(
+                    f"timed out waiting for response from {self.device_path}"
+                )
+
+            recv = IpmiRecv(
+                0,
+                ctypes.addressof(recv_addr),
+                ctypes.sizeof(recv_addr),
+                0,
+                IpmiMsg(0, 0, IPMI_MAX_MSG_LENGTH, recv_data),
+            )
+            fcntl.ioctl(self._fd, IPMICTL_RECEIVE_MSG_TRUNC, recv)
+            # discard events or stale responses to earlier timed out requests
+            if recv.recv_type == IPMI_RESPONSE_RECV_TYPE and recv.msgid == self._msgid:
+                return bytes(recv_data[: recv.msg.data_len])
+
+    def get_power_reading(self) -> Dict:
+        """
+        Get system power statistics using DCMI Get Power Reading
+        """
+        try:
+            with self._lock:
+                self.open()
+                res = self._request(
+                    DCMI_NETFN,
+                    DCMI_CMD_GET_POWER_READING,
+                    bytes(
+                        [
+                            DCMI_GROUP_EXTENSION_ID,
+                            DCMI_SYSTEM_POWER_STATISTICS_MODE,
+                            0,
+                            0,
+                        ]
+                    ),
+                )
+            reading = parse_power_reading(res)
+        except (OSError, IpmiError):
+            self.failures += 1
+            raise
+        self.failures = 0
+        return reading
+
+
+_READERS: Dict[str, Optional[DcmiPowerReader]] = {}
+
+
+def get_power_reader(device_path: str) -> Optional[DcmiPowerReader]:
+    """
+    Get a shared reader for given IPMI device
+
+    Returns None if the device can't be opened - e.g. permission denied - so callers can
+    fall back to the ipmi-dcmi command. The result is cached so the device is only opened
+    once per process.
+
+    Keyword Arguments:
+        device_path -- str, path to IPMI device
+    """
+    if device_path not in _READERS:
+        reader = DcmiPowerReader(device_path)
+        try:
+            reader.open()
+        except OSError as open_err:
+            logger.info(
+                "cannot open %s, using ipmi-dcmi instead: %s",
+                device_path,
+                repr(open_err),
+            )
+            reader = None
+        _READERS[device_path] = reader
+    return _READERS[device_path]
+
+
+def disable_power_reader(device_path: str):
+    """
+    Stop reading given IPMI device in-process, closing its shared reader
+
+    Used when the BMC keeps failing to answer DCMI, so later readings go straight to the
+    ipmi-dcmi command instead of waiting for a response each time
+
+    Keyword Arguments:
+        device_path -- str, path to IPMI device
+    """
+    reader = _READERS.get(device_path)
+    if reader is not None:
+        reader.close()
+    _READERS[device_path] = None
@@ -0,0 +1,235 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Power sources which are much cheaper to read than IPMI - RAPL energy counters from
+/sys/class/powercap and hwmon power meters - and a policy to pick the cheapest one a host has
+"""
+
+import glob
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from iriscasttools import utils
+
+logger = logging.getLogger(__name__)
+
+POWERCAP_ROOT = "/sys/class/powercap"
+HWMON_ROOT = "/sys/class/hwmon"
+
+# top level RAPL zones only e.g. intel-rapl:0 - subzones e.g. intel-rapl:0:0 are already
+# counted in their parent
+_RAPL_ZONE_RE = re.compile(r"^[a-z]+-rapl:\d+$")
+
+
+def _read_int(fd: int) -> int:
+    """
+    Read an integer from the start of an open sysfs file
+
+    Keyword arguments:
+        fd -- int, open file descriptor
+    """
+    return int(os.pread(fd, 64, 0))
+
+
+class PowerSource:
+    """
+    Base class for a source of node power readings in Watts
+
+    Subclasses set the class attributes below and implement available() and read()
+        name -- str, name used to refer to source on the command line
+        cost_ms -- float, declared typical time in milliseconds to take one reading
+    """
+
+    name: str = ""
+    cost_ms: float = 0.0
+
+    def available(self) -> bool:
+        """Check if source can be read on this host"""
+        raise NotImplementedError
+
+    def read(self) -> float:
+        """Get current power in Watts"""
+        raise NotImplementedError
+
+    def close(self):
+        """release any open files"""
+
+
+class RaplSource(PowerSource):
+    """
+    CPU package power from RAPL energy counters, e.g. /sys/class/powercap/intel-rapl:0/energy_uj
+
+    Counters are read each time and turned into Watts from the energy used since the last
+    reading, allowing for counters wrapping around. The first reading waits prime_s seconds
+    between two counter reads so it has something to compare against. AMD CPUs report
+    RAPL through the same interface.
+    """
+
+    name = "rapl"
+    cost_ms = 0.05
+
+    def __init__(
+        self,
+        root: str = POWERCAP_ROOT,
+        prime_s: float = 0.1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Keyword arguments:
+            root -- str, path powercap zones are found in
+            prime_s -- float, seconds between the two counter reads of the first reading
+            clock -- a monotonic clock function returning seconds
+        """
+        self.root = root
+        self.prime_s = prime_s
+        self._clock = clock
+        # zone path to (open energy_uj file, counter range in uJ)
+        self._zones: Optional[Dict[str, Tuple[int, int]]] = None
+        self._last: Optional[Tuple[float, Dict[str, int]]] = None
+
+    def _open_zones(self) -> Dict[str, Tuple[int, int]]:
+        """open energy counter of each top level zone, once"""
+        if self._zones is None:
+            self._zones = {}
+            for zone in sorted(glob.glob(os.path.join(self.root, "*-rapl:*"))):
+                if not _RAPL_ZONE_RE.match(os.path.basename(zone)):
+                    continue
+                try:
+                    with open(
+                        os.path.join(zone, "max_energy_range_uj"), encoding="utf-8"
+                    ) as range_file:
+                        energy_range = int(range_file.read())
+                    fd = os.open(
+                        os.path.join(zone, "energy_uj"), os.O_RDONLY | os.O_CLOEXEC
+                    )
+                except (OSError, ValueError) as open_err:
+                    # energy_uj is only readable by root on most kernels
+                    logger.debug("cannot read RAPL zone %s: %s", zone, repr(open_err))
+                    continue
+                self._zones[zone] = (fd, energy_range)
+        return self._zones
+
+    def available(self):
+        return bool(self._open_zones())
+
+    def _read_counters(self) -> Tuple[float, Dict[str, int]]:
+        """read all energy counters, returning time read and counter of each zone"""
+        counters = {zone: _read_int(fd) for zone, (fd, _) in self._open_zones().items()}
+        return self._clock(), counters
+
+    def read(self):
+        if not self._open_zones():
+            raise RuntimeError(f"no readable RAPL zones in {self.root}")
+        if self._last is None:
+            self._last = self._read_counters()
+            time.sleep(self.prime_s)
+
+        last_time, last_counters = self._last
+        now, counters = self._read_counters()
+        self._last = (now, counters)
+        if now <= last_time:
+            raise RuntimeError("no time has passed since last RAPL reading")
+
+        energy_uj = 0
+        for zone, counter in counters.items():
+            delta = counter - last_counters[zone]
+            if delta < 0:
+                # counter wrapped around
+                delta += self._zones[zone][1] + 1
+            energy_uj += delta
+        return energy_uj / (now - last_time) / 1e6
+
+    def close(self):
+        for fd, _ in (self._zones or {}).values():
+            os.close(fd)
+        self._zones = None
+        self._last = None
+
+
+class HwmonSource(PowerSource):
+    """
+    Power from hwmon power meters, e.g. ACPI power_meter power1_average, in microwatts
+
+    Meters average power themselves, so no previous reading is needed. All power*_average
+    files found are summed
+    """
+
+    name = "hwmon"
+    cost_ms = 0.02
+
+    def __init__(self, root: str = HWMON_ROOT):
+        """
+        Keyword arguments:
+            root -- str, path hwmon devices are found in
+        """
+        self.root = root
+        self._fds: Optional[List[int]] = None
+
+    def _open_meters(self) -> List[int]:
+        """open each power*_average file, once"""
+        if self._fds is None:
+            self._fds = []
+            paths = glob.glob(os.path.join(self.root, "hwmon*", "power*_average"))
+            # older kernels put ACPI power meter files under device/
+            paths += glob.glob(
+                os.path.join(self.root, "hwmon*", "device", "power*_average")
+            )
+            for path in sorted(paths):
+                try:
+                    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+                    _read_int(fd)
+                except (OSError, ValueError) as open_err:
+                    logger.debug("cannot read power meter %s: %s", path, repr(open_err))
+                    continue
+                self._fds.append(fd)
+        return self._fds
+
+    def available(self):
+        return bool(self._open_meters())
+
+    def read(self):
+        fds = self._open_meters()
+        if not fds:
+            raise RuntimeError(f"no readable hwmon power meters in {self.root}")
+        return sum(_read_int(fd) for fd in fds) / 1e6
+
+    def close(self):
+        for fd in self._fds or ():
+            os.close(fd)
+        self._fds = None
+
+
+class IpmiSource(PowerSource):
+    """
+    Current power from the BMC over IPMI - the reference reading for the whole node, but
+    the slowest to read
+    """
+
+    name = "ipmi"
+    cost_ms = 50.0
+
+    def available(self):
+        return utils.check_ipmi_conn()
+
+    def read(self):
+        return float(utils.get_ipmi_power_stats("current_power")["current_power"])
+
+
+SOURCES = {source.name: source for source in (RaplSource, HwmonSource, IpmiSource)}
+
+
+def select_source(sources: Iterable[PowerSource]) -> Optional[PowerSource]:
+    """
+    Pick the cheapest available power source, None if there are none
+
+    Keyword arguments:
+        sources -- power sources to choose from
+    """
+    for source in sorted(sources, key=lambda s: s.cost_ms):
+        if source.available():
+            logger.info("using %s power source", source.name)
+            return source
+    return None
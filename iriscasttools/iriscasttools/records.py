@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Compact binary record format for long-term storage of samples
+
+A file is a small header describing the fields, followed by fixed-width little-endian
+rows - a float64 epoch timestamp then one float per field, NaN where a value is missing.
+Rows are only ever appended, so files can be memory-mapped and sliced by time without
+parsing any text. Reading into arrays requires numpy, which is optional
+"""
+
+import datetime
+import math
+import os
+import struct
+import time
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+
+from iriscasttools.ringbuffer import to_float
+
+MAGIC = b"IRISREC\0"
+VERSION = 1
+TIMESTAMP_FIELD = "timestamp"
+# magic, version, number of fields, total header length in bytes
+_PREAMBLE = struct.Struct("<8sHHI")
+# struct type code of each value to numpy type
+VALUE_TYPES = {"f": "<f4", "d": "<f8"}
+
+
+def _numpy():
+    """import numpy on first use - it's optional, and slow to import"""
+    try:
+        # pylint: disable=import-outside-toplevel
+        import numpy
+    except ImportError as import_err:
+        raise ImportError(
+            "numpy is required to read records as arrays, use iter_records instead"
+        ) from import_err
+    return numpy
+
+
+def default_type(field: str) -> str:
+    """
+    Get struct type code a field is stored as - float32 unless it needs more precision
+
+    Keyword arguments:
+        field -- str, field name
+    """
+    # float32 only holds whole numbers exactly up to 2^24, not enough for kB of RAM
+    return "d" if field.endswith("_kb") else "f"
+
+
+def to_epoch(timestamp: Union[None, float, str, datetime.datetime]) -> float:
+    """
+    Convert a timestamp to epoch seconds
+
+    Keyword arguments:
+        timestamp -- epoch seconds, ISO-8601 string or datetime. NaN if None
+    """
+    if timestamp is None:
+        return math.nan
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp.timestamp()
+    return float(timestamp)
+
+
+class RecordHeader:
+    """
+    Describes the fields in a record file and how each row is laid out
+    """
+
+    def __init__(self, fields: Iterable[str], types: Optional[Iterable[str]] = None):
+        """
+        Keyword arguments:
+            fields -- names of fields in each row, not including timestamp
+            types -- struct type code of each field, "f" or "d". Picked by default_type if None
+        """
+        self.fields = tuple(fields)
+        self.types = (
+            tuple(types) if types is not None else tuple(map(default_type, self.fields))
+        )
+        if len(self.types) != len(self.fields):
+            raise ValueError("a type must be given for every field")
+        invalid = set(self.types) - set(VALUE_TYPES)
+        if invalid:
+            raise ValueError(
+                f"invalid field types {invalid}, must be one of 'f' or 'd'"
+            )
+        self.row = struct.Struct("<d" + "".join(self.types))
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, RecordHeader)
+            and self.fields == other.fields
+            and self.types == other.types
+        )
+
+    @property
+    def row_size(self) -> int:
+        """bytes per row"""
+        return self.row.size
+
+    def encode(self) -> bytes:
+        """
+        Encode header, padded to a multiple of 8 bytes so rows stay aligned
+        """
+        body = b"".join(
+            code.encode() + struct.pack("<B", len(name.encode())) + name.encode()
+            for code, name in zip(self.types, self.fields)
+        )
+        size = _PREAMBLE.size + len(body)
+        size += -size % 8
+        preamble = _PREAMBLE.pack(MAGIC, VERSION, len(self.fields), size)
+        return (preamble + body).ljust(size, b"\0")
+
+    @classmethod
+    def decode(cls, data: bytes) -> Tuple["RecordHeader", int]:
+        """
+        Decode header from start of a file, returning header and its length in bytes
+
+        Keyword arguments:
+            data -- bytes, start of file. Must hold at least the whole header
+        """
+        if len(data) < _PREAMBLE.size:
+            raise ValueError("file too short to hold a record header")
+        magic, version, n_fields, size = _PREAMBLE.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not an iriscast record file")
+        if version != VERSION:
+            raise ValueError(f"unsupported record file version {version}")
+        if len(data) < size:
+            raise ValueError("file too short to hold record header")
+
+        fields, types = [], []
+        pos = _PREAMBLE.size
+        for _ in range(n_fields):
+            types.append(chr(data[pos]))
+            length = data[pos + 1]
+            fields.append(data[pos + 2 : pos + 2 + length].decode())
+            pos += 2 + length
+        return cls(fields, types), size
+
+    @classmethod
+    def read(cls, path: str) -> Tuple["RecordHeader", int]:
+        """
+        Read header of a record file, returning header and its length in bytes
+
+        Keyword arguments:
+            path -- str, path to record file
+        """
+        with open(path, "rb") as record_file:
+            preamble = record_file.read(_PREAMBLE.size)
+            if len(preamble) == _PREAMBLE.size:
+                size = _PREAMBLE.unpack(preamble)[3]
+                preamble += record_file.read(max(0, size - _PREAMBLE.size))
+        return cls.decode(preamble)
+
+    def encode_row(self, stats: Dict, timestamp=None) -> bytes:
+        """
+        Encode a sample as a row
+
+        Missing or non-numeric values are stored as NaN
+
+        Keyword arguments:
+            stats -- dict, field to value
+            timestamp -- epoch seconds, ISO-8601 string or datetime. Taken from the
+                timestamp field of stats if None, or now if stats has no timestamp
+        """
+        if timestamp is None:
+            timestamp = stats.get(TIMESTAMP_FIELD, time.time())
+        return self.row.pack(
+            to_epoch(timestamp), *(to_float(stats.get(f)) for f in self.fields)
+        )
+
+    def dtype(self):
+        """numpy structured dtype of a row"""
+        return _numpy().dtype(
+            [(TIMESTAMP_FIELD, "<f8")]
+            + [(f, VALUE_TYPES[t]) for f, t in zip(self.fields, self.types)]
+        )
+
+
+def header_for(stats: Dict) -> RecordHeader:
+    """
+    Build a header for samples shaped like stats
+
+    The timestamp field and fields holding text, e.g. power_measurement, are left out.
+    Empty values are assumed to be numbers which failed to be collected
+
+    Keyword arguments:
+        stats -- dict, a sample
+    """
+    return RecordHeader(
+        f
+        for f, val in stats.items()
+        if f != TIMESTAMP_FIELD and (val == "" or not math.isnan(to_float(val)))
+    )
+
+
+def count_rows(path: str, header_size: int, row_size: int) -> int:
+    """
+    Count whole rows in a record file - a partly written last row is ignored
+
+    Keyword arguments:
+        path -- str, path to record file
+        header_size -- int, length of header in bytes
+        row_size -- int, bytes per row
+    """
+    return max(0, os.path.getsize(path) - header_size) // row_size
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    """
+    Read rows of a record file as dicts, without needing numpy
+
+    Keyword arguments:
+        path -- str, path to record file
+    """
+    header, size = RecordHeader.read(path)
+    count = count_rows(path, size, header.row_size)
+    names = (TIMESTAMP_FIELD,) + header.fields
+    with open(path, "rb") as record_file:
+        record_file.seek(size)
+        data = record_file.read(count * header.row_size)
+    for row in header.row.iter_unpack(data):
+        yield dict(zip(names, row))
+
+
+def load_records(path: str, start=None, end=None):
+    """
+    Memory-map a record file as a numpy structured array, optionally sliced by time
+
+    Columns are accessed by field name, e.g. records["current_power"]. Rows are only read
+    from disk when used. Rows must have been appended in time order to slice by time
+
+    Keyword arguments:
+        path -- str, path to record file
+        start -- first time to include - epoch seconds, ISO-8601 string or datetime.
+            From first row if None
+        end -- time to stop before - epoch seconds, ISO-8601 string or datetime.
+            To last row if None
+    """
+    np = _numpy()
+    header, size = RecordHeader.read(path)
+    dtype = header.dtype()
+    count = count_rows(path, size, header.row_size)
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+
+    records = np.memmap(path, dtype=dtype, mode="r", offset=size, shape=(count,))
+    timestamps = records[TIMESTAMP_FIELD]
+    first = 0 if start is None else np.searchsorted(timestamps, to_epoch(start), "left")
+    last = count if end is None else np.searchsorted(timestamps, to_epoch(end), "left")
+    return records[first:last]
@@ -0,0 +1,142 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Fixed-size in-memory history of samples, used to give rolling min/max/avg aggregates
+"""
+
+import math
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, Optional
+
+# window name to length in seconds
+DEFAULT_WINDOWS = {"1m": 60, "5m": 300, "15m": 900}
+
+
+def to_float(val) -> float:
+    """
+    Convert a sample value to float, giving NaN for missing or non-numeric values
+
+    Keyword arguments:
+        val -- value to convert
+    """
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class SampleRingBuffer:
+    """
+    Holds the most recent samples, oldest overwritten first
+
+    Each field is stored in its own array('d') so memory use is fixed at
+    8 bytes * capacity * (fields + 1) no matter how long the process runs
+    """
+
+    def __init__(self, fields: Iterable[str], capacity: int):
+        """
+        Keyword arguments:
+            fields -- fields to keep history of
+            capacity -- int, maximum number of samples to keep
+        """
+        if capacity <= 0:
+            raise ValueError(f"capacity must be greater than 0, got {capacity}")
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._timestamps = array("d", [math.nan]) * capacity
+        self._values = {f: array("d", [math.nan]) * capacity for f in self.fields}
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, sample: Dict, timestamp: Optional[float] = None):
+        """
+        Add a sample, overwriting the oldest if full
+
+        Keyword arguments:
+            sample -- dict, field to value. Missing or non-numeric values are stored as NaN
+            timestamp -- float, epoch seconds sample was taken. Defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._timestamps[self._next] = timestamp
+            for field, values in self._values.items():
+                values[self._next] = to_float(sample.get(field))
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def aggregate(self, window_s: float, now: Optional[float] = None) -> Dict:
+        """
+        Get min, max and mean of each field over samples taken in the last window_s seconds
+
+        Returns a dict of field to {"min", "max", "avg"}. Values are empty strings if a field
+        has no numeric samples in the window
+
+        Keyword arguments:
+            window_s -- float, length of window in seconds
+            now -- float, epoch seconds window ends at. Defaults to now
+        """
+        if now is None:
+            now = time.time()
+        start = now - window_s
+        with self._lock:
+            idx = [
+                i for i in range(self.capacity) if start <= self._timestamps[i] <= now
+            ]
+            res = {}
+            for field, values in self._values.items():
+                vals = [values[i] for i in idx if not math.isnan(values[i])]
+                if vals:
+                    res[field] = {
+                        "min": min(vals),
+                        "max": max(vals),
+                        "avg": round(sum(vals) / len(vals), 3),
+                    }
+                else:
+                    res[field] = {"min": "", "max": "", "avg": ""}
+        return res
+
+    def aggregates(
+        self, windows: Optional[Dict[str, float]] = None, now: Optional[float] = None
+    ) -> Dict:
+        """
+        Get rolling aggregates over several windows as a flat dict
+
+        Keys look like current_power_avg_5m
+
+        Keyword arguments:
+            windows -- dict, window name to length in seconds. Defaults to 1, 5 and 15 minutes
+            now -- float, epoch seconds windows end at. Defaults to now
+        """
+        if windows is None:
+            windows = DEFAULT_WINDOWS
+        if now is None:
+            now = time.time()
+        res = {}
+        window_stats = {
+            name: self.aggregate(window_s, now) for name, window_s in windows.items()
+        }
+        for field in self.fields:
+            for stat in ("min", "max", "avg"):
+                for name, agg in window_stats.items():
+                    res[f"{field}_{stat}_{name}"] = agg[field][stat]
+        return res
+
+
+def capacity_for(interval: float, windows: Optional[Dict[str, float]] = None) -> int:
+    """
+    Get number of samples needed to cover the longest window at given sampling interval
+
+    Keyword arguments:
+        interval -- float, seconds between samples
+        windows -- dict, window name to length in seconds. Defaults to 1, 5 and 15 minutes
+    """
+    if windows is None:
+        windows = DEFAULT_WINDOWS
+    return math.ceil(max(windows.values()) / interval) + 1
@@ -0,0 +1,342 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Sinks that samples are written to - a stream such as stdout, or a batched, rotating file
+"""
+
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, TextIO
+
+from iriscasttools import records, utils
+
+logger = logging.getLogger(__name__)
+
+
+def format_row(stats: Dict, as_csv: bool = True, include_header: bool = False) -> str:
+    """
+    Format a sample as a single line of csv or as a dict
+
+    Keyword arguments:
+        stats -- dict, sample to format
+        as_csv -- bool, flag to set if row should be formatted as csv or dict
+        include_header -- bool, flag to set if csv header should be included
+    """
+    if as_csv:
+        return utils.to_csv(stats, include_header) + "\n"
+    return f"{stats}\n"
+
+
+class StreamSink:
+    """
+    Writes each sample straight to a stream such as stdout, with a csv header before the
+    first row if requested
+    """
+
+    def __init__(self, out: TextIO, as_csv: bool = True, include_header: bool = False):
+        """
+        Keyword arguments:
+            out -- file-like object to write rows to
+            as_csv -- bool, flag to set if each row should be written as csv or dict
+            include_header -- bool, flag to set if a csv header should be written before the first row
+        """
+        self.out = out
+        self.as_csv = as_csv
+        self._header_pending = as_csv and include_header
+
+    def write(self, stats: Dict):
+        """
+        Write a single row
+
+        Keyword arguments:
+            stats -- dict, row to write
+        """
+        self.out.write(format_row(stats, self.as_csv, self._header_pending))
+        self._header_pending = False
+        self.out.flush()
+
+    def close(self):
+        """flush stream, the stream itself is left open"""
+        self.out.flush()
+
+
+# pylint: disable=too-many-instance-attributes
+class FileSink:
+    """
+    Appends samples to a file, batching rows so they are written with a single syscall
+
+    Rows are buffered until batch_rows rows are waiting or batch_seconds have passed since
+    the last write. The file can be rotated when it grows past rotate_bytes or when the UTC
+    date changes - the closed segment is renamed with the time it was rotated, e.g.
+    stats-20240101T000000.csv, and optionally gzipped in the background. A csv header is
+    written at the start of every segment if requested.
+
+    fsync policy can be one of:
+        "never": leave flushing to disk up to the OS
+        "batch": fsync after every batch is written
+        "rotate": fsync each segment before it is rotated or closed
+    """
+
+    binary = False
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        path: str,
+        *,
+        as_csv: bool = True,
+        include_header: bool = False,
+        batch_rows: int = 100,
+        batch_seconds: float = 60.0,
+        rotate_bytes: Optional[int] = None,
+        rotate_daily: bool = False,
+        compress: bool = False,
+        fsync: str = "rotate",
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Keyword arguments:
+            path -- str, file to append rows to
+            as_csv -- bool, flag to set if each row should be written as csv or dict
+            include_header -- bool, flag to set if a csv header should start each segment
+            batch_rows -- int, write once this many rows are waiting
+            batch_seconds -- float, write once this many seconds have passed since last write
+            rotate_bytes -- int, rotate once file is at least this size. Never rotates on size if None
+            rotate_daily -- bool, flag to set if file should be rotated when UTC date changes
+            compress -- bool, flag to set if rotated segments should be gzipped
+            fsync -- str, when to fsync the file, one of "never", "batch" or "rotate"
+            clock -- a monotonic clock function returning seconds
+        """
+        if fsync not in utils.FSYNC_POLICIES:
+            raise ValueError(
+                f"fsync must be one of {utils.FSYNC_POLICIES}, got {fsync}"
+            )
+        if batch_rows < 1:
+            raise ValueError(f"batch_rows must be at least 1, got {batch_rows}")
+
+        self.path = Path(path)
+        self.as_csv = as_csv
+        self.include_header = as_csv and include_header
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.fsync = fsync
+        self._clock = clock
+
+        self._rows: List = []
+        self._header = None
+        self._last_write = clock()
+        self._compressors: List[threading.Thread] = []
+        self._file = None
+        self._date = None
+        self._needs_header = False
+        self._open()
+
+    def _open(self):
+        """open current segment for appending"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # pylint: disable=consider-using-with
+        if self.binary:
+            self._file = open(self.path, "ab")
+        else:
+            self._file = open(self.path, "a", encoding="utf-8")
+        if self._file.tell() == 0:
+            self._date = datetime.datetime.now(datetime.timezone.utc).date()
+            self._needs_header = self.include_header
+        else:
+            # continuing an existing file - header was already written, and the file
+            # belongs to the day it was last written to
+            self._date = datetime.datetime.fromtimestamp(
+                self.path.stat().st_mtime, datetime.timezone.utc
+            ).date()
+            self._needs_header = False
+
+    def write(self, stats: Dict):
+        """
+        Add a row, writing batch to file if full or due
+
+        Keyword arguments:
+            stats -- dict, row to write
+        """
+        if self.rotate_daily:
+            today = datetime.datetime.now(datetime.timezone.utc).date()
+            if today != self._date:
+                self.flush()
+                self.rotate()
+
+        if self.include_header and self._header is None:
+            self._header = self._encode_header(stats)
+        self._rows.append(self._encode_row(stats))
+
+        if (
+            len(self._rows) >= self.batch_rows
+            or self._clock() - self._last_write >= self.batch_seconds
+        ):
+            self.flush()
+
+    def _encode_header(self, stats: Dict):
+        """
+        Get header written at the start of each segment
+
+        Keyword arguments:
+            stats -- dict, first row to be written
+        """
+        return ",".join(stats.keys()) + "\n"
+
+    def _encode_row(self, stats: Dict):
+        """
+        Get a row as it is written to file
+
+        Keyword arguments:
+            stats -- dict, row to write
+        """
+        return format_row(stats, self.as_csv)
+
+    def flush(self):
+        """
+        Write all buffered rows to file in one call, then rotate if file is too large
+        """
+        self._last_write = self._clock()
+        if not self._rows:
+            return
+        if self._needs_header and self._header:
+            self._rows.insert(0, self._header)
+            self._needs_header = False
+        self._file.write((b"" if self.binary else "").join(self._rows))
+        self._file.flush()
+        self._rows = []
+        if self.fsync == "batch":
+            os.fsync(self._file.fileno())
+
+        if self.rotate_bytes is not None and self._file.tell() >= self.rotate_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """
+        Close current segment, rename it with current time and start a new one
+        """
+        self._close_file()
+        if self.path.exists() and self.path.stat().st_size > 0:
+            stamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+                "%Y%m%dT%H%M%S"
+            )
+            segment = self.path.with_name(f"{self.path.stem}-{stamp}{self.path.suffix}")
+            # avoid clobbering a segment rotated within the same second
+            i = 1
+            while segment.exists() or Path(f"{segment}.gz").exists():
+                segment = self.path.with_name(
+                    f"{self.path.stem}-{stamp}.{i}{self.path.suffix}"
+                )
+                i += 1
+            self.path.rename(segment)
+            logger.debug("rotated %s to %s", self.path, segment)
+            if self.compress:
+                thread = threading.Thread(
+                    target=compress_segment, args=(segment,), daemon=True
+                )
+                thread.start()
+                self._compressors.append(thread)
+        self._compressors = [t for t in self._compressors if t.is_alive()]
+        self._open()
+
+    def _close_file(self):
+        """close current segment, syncing to disk first if required"""
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.fsync in ("batch", "rotate"):
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        """
+        Write any buffered rows and close file, waiting for segments to finish compressing
+        """
+        self.flush()
+        self._close_file()
+        for thread in self._compressors:
+            thread.join()
+        self._compressors = []
+
+
+class BinarySink(FileSink):
+    """
+    Appends samples to a file in the compact binary record format from records.py, with
+    the same batching, rotation and fsync options as FileSink
+
+    Fields holding text are left out. If an existing file was written with different
+    fields it is rotated out of the way first
+    """
+
+    binary = True
+
+    def __init__(self, path: str, **kwargs):
+        """
+        Keyword arguments:
+            path -- str, file to append records to
+            **kwargs -- batching, rotation and fsync options, see FileSink
+        """
+        kwargs["as_csv"] = False
+        kwargs["include_header"] = True
+        self._existing: Optional[records.RecordHeader] = None
+        self._record_header: Optional[records.RecordHeader] = None
+        super().__init__(path, **kwargs)
+        # every segment starts with a header, which FileSink only writes for csv
+        self.include_header = True
+
+    def _open(self):
+        """open current segment, reading header of an existing file"""
+        super()._open()
+        self._existing = None
+        if self._file.tell() == 0:
+            self._needs_header = True
+            return
+        try:
+            self._existing, size = records.RecordHeader.read(self.path)
+        except ValueError as header_err:
+            raise ValueError(
+                f"{self.path} exists but is not a record file: {header_err}"
+            ) from header_err
+        # drop a partly written row left by a crash so later rows stay aligned
+        valid = size + self._existing.row_size * records.count_rows(
+            self.path, size, self._existing.row_size
+        )
+        if valid != self._file.tell():
+            logger.warning("truncating partly written row at end of %s", self.path)
+            self._file.truncate(valid)
+            self._file.seek(valid)
+
+    def _encode_header(self, stats):
+        self._record_header = records.header_for(stats)
+        if self._existing is not None and self._existing != self._record_header:
+            logger.info("fields in %s have changed, rotating", self.path)
+            self.rotate()
+        return self._record_header.encode()
+
+    def _encode_row(self, stats):
+        return self._record_header.encode_row(stats)
+
+
+def compress_segment(segment: Path):
+    """
+    gzip a closed segment, removing the original once compressed
+
+    Keyword arguments:
+        segment -- Path, file to compress
+    """
+    gz_path = Path(f"{segment}.gz")
+    try:
+        with open(segment, "rb") as src, gzip.open(gz_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        segment.unlink()
+    except OSError as compress_err:
+        logger.error("failed to compress %s: %s", segment, repr(compress_err))
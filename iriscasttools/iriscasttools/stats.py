@@ -6,34 +6,122 @@ Collects energy usage metrics using IPMI, as well as other metrics such as CPU a
 
 import argparse
 import logging
+from typing import TYPE_CHECKING, Optional
 from iriscasttools import utils
+from iriscasttools.collectors import CollectorRegistry, default_registry
+
+if TYPE_CHECKING:
+    from iriscasttools.sinks import FileSink
 
 logger = logging.getLogger(__name__)
 
+# names of sources in powersources.SOURCES, kept here so parsing args doesn't import it
+POWER_SOURCES = ("rapl", "hwmon", "ipmi")
+
+# optional collectors and sinks are imported only when their options are given, so a
+# single sample from cron doesn't pay for importing them
+# pylint: disable=import-outside-toplevel
 
-def get_iriscast_stats(csv=False, include_header=False):
+
+def get_iriscast_stats(
+    csv=False, include_header=False, registry: Optional[CollectorRegistry] = None
+):
     """
     Get stats for iriscast
 
     Keyword arguments:
         csv -- bool, flag to set if output should be formatted as csv or dict
         include_header -- bool, flag to set if header should be included if csv flag set
+        registry -- CollectorRegistry, collectors to run. Defaults to power, OS load and RAM
 
     """
-
-    all_stats = {}
-
-    power_stats = utils.get_ipmi_power_stats("current_power")
-
-    all_stats.update(power_stats)
-    all_stats.update(utils.get_os_load("os_load_5"))
-    all_stats.update(utils.get_ram_usage("ram_usage_percentage"))
+    if registry is None:
+        with default_registry() as default:
+            all_stats = default.collect()
+    else:
+        all_stats = registry.collect()
 
     if csv:
         return utils.to_csv(all_stats, include_header)
     return all_stats
 
 
+def build_registry(cmd_args) -> CollectorRegistry:
+    """
+    Build collector registry from parsed command line args
+
+    Keyword arguments:
+        cmd_args -- argparse.Namespace, parsed command line args
+    """
+    timeout = cmd_args.timeout
+    if cmd_args.daemon or cmd_args.serve is not None:
+        # a slow collector should never hold up the next sample
+        timeout = min(timeout, cmd_args.interval)
+    registry = default_registry(timeout)
+    if cmd_args.power_source is not None:
+        from iriscasttools import powersources
+        from iriscasttools.collectors import SourcePowerCollector
+
+        registry.register(
+            SourcePowerCollector()
+            if cmd_args.power_source == "auto"
+            else SourcePowerCollector(
+                sources=[powersources.SOURCES[cmd_args.power_source]()]
+            )
+        )
+    if cmd_args.vm_power:
+        from iriscasttools.collectors import VmPowerCollector
+
+        registry.register(VmPowerCollector())
+    for name in cmd_args.disable:
+        registry.disable(name)
+    if cmd_args.max_cost is not None:
+        registry.disable_above_cost(cmd_args.max_cost)
+    return registry
+
+
+def build_sink(cmd_args) -> Optional["FileSink"]:
+    """
+    Build file sink from parsed command line args
+
+    Returns None if no output file was given, in which case rows go to stdout
+
+    Keyword arguments:
+        cmd_args -- argparse.Namespace, parsed command line args
+    """
+    if not cmd_args.output:
+        return None
+    from iriscasttools.sinks import BinarySink, FileSink
+
+    options = {
+        "batch_rows": cmd_args.batch_rows,
+        "batch_seconds": cmd_args.batch_seconds,
+        "rotate_bytes": cmd_args.rotate_size,
+        "rotate_daily": cmd_args.rotate_daily,
+        "compress": cmd_args.compress,
+        "fsync": cmd_args.fsync,
+    }
+    if cmd_args.binary:
+        return BinarySink(cmd_args.output, **options)
+    return FileSink(
+        cmd_args.output,
+        as_csv=cmd_args.as_csv,
+        include_header=cmd_args.include_header,
+        **options,
+    )
+
+
+def format_self_stats(registry: CollectorRegistry) -> str:
+    """
+    Format timings recorded for each collector as csv with a header
+
+    Keyword arguments:
+        registry -- CollectorRegistry, registry to report on
+    """
+    rows = registry.self_stats()
+    return "\n".join(utils.to_csv(row, i == 0) for i, row in enumerate(rows))
+
+
 def parse_args(inp_args):
     """
     Parse commandline args
@@ -48,6 +136,149 @@ def parse_args(inp_args):
     )
     parser.add_argument("-c", "--as-csv", default=False, action="store_true")
     parser.add_argument("-i", "--include-header", default=False, action="store_true")
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        default=False,
+        action="store_true",
+        help="keep running and collect a sample every --interval seconds",
+    )
+    parser.add_argument(
+        "-n",
+        "--interval",
+        default=60.0,
+        type=float,
+        help="seconds between samples in daemon mode",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="file to append samples to in daemon mode, defaults to stdout",
+    )
+    parser.add_argument(
+        "--binary",
+        default=False,
+        action="store_true",
+        help="with --output, append samples as compact binary records instead of text",
+    )
+    parser.add_argument(
+        "--batch-rows",
+        default=60,
+        type=int,
+        help="with --output, write to file once this many rows are waiting",
+    )
+    parser.add_argument(
+        "--batch-seconds",
+        default=60.0,
+        type=float,
+        help="with --output, write to file once this many seconds have passed since last write",
+    )
+    parser.add_argument(
+        "--rotate-size",
+        default=None,
+        type=int,
+        metavar="BYTES",
+        help="with --output, rotate file once it reaches this size",
+    )
+    parser.add_argument(
+        "--rotate-daily",
+        default=False,
+        action="store_true",
+        help="with --output, rotate file when the UTC date changes",
+    )
+    parser.add_argument(
+        "--compress",
+        default=False,
+        action="store_true",
+        help="gzip rotated files",
+    )
+    parser.add_argument(
+        "--fsync",
+        default="rotate",
+        choices=utils.FSYNC_POLICIES,
+        help="when to fsync output file - never, after every batch, "
+        "or before rotating and on exit (default)",
+    )
+    parser.add_argument(
+        "--aggregate-every",
+        default=None,
+        type=float,
+        help="in daemon mode, write rolling 1/5/15 minute min/max/avg of each field every "
+        "this many seconds instead of every sample",
+    )
+    parser.add_argument(
+        "--self-stats",
+        default=False,
+        action="store_true",
+        help="write time taken and failures of each collector to stderr on exit",
+    )
+    parser.add_argument(
+        "--disable",
+        default=[],
+        action="append",
+        choices=[c.name for c in default_registry().collectors],
+        help="collector to turn off, can be given more than once",
+    )
+    parser.add_argument(
+        "--power-source",
+        default=None,
+        choices=["auto", *POWER_SOURCES],
+        help="also read power from RAPL, hwmon or IPMI - auto picks the cheapest "
+        "available on this host",
+    )
+    parser.add_argument(
+        "--vm-power",
+        default=False,
+        action="store_true",
+        help="estimate power used by each libvirt guest from its share of CPU time",
+    )
+    parser.add_argument(
+        "--max-cost",
+        default=None,
+        type=float,
+        help="turn off collectors with a declared sampling cost above this many milliseconds",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        default=10.0,
+        type=float,
+        help="seconds to wait for each collector before leaving its fields empty, "
+        "capped at --interval in daemon mode",
+    )
+    parser.add_argument(
+        "--serve",
+        default=None,
+        type=int,
+        metavar="PORT",
+        help="sample every --interval seconds and serve latest sample on "
+        "http://<bind>:<PORT>/metrics in Prometheus format",
+    )
+    parser.add_argument(
+        "--bind",
+        default="",
+        help="address to serve metrics on, defaults to all addresses",
+    )
+    parser.add_argument(
+        "--fleet",
+        default=None,
+        metavar="INVENTORY",
+        help="collect from every host listed in INVENTORY (one per line, - for stdin) "
+        "over SSH and write a single csv",
+    )
+    parser.add_argument(
+        "--parallel",
+        default=64,
+        type=int,
+        help="with --fleet, maximum number of hosts to connect to at once",
+    )
+    parser.add_argument(
+        "--host-timeout",
+        default=30.0,
+        type=float,
+        help="with --fleet, seconds to wait for each host before reporting it as failed",
+    )
     args, unknown = parser.parse_known_args(inp_args)
 
     if unknown:
@@ -57,4 +288,24 @@ def parse_args(inp_args):
     if not args.as_csv:
         args.include_header = False
 
+    if args.interval <= 0:
+        parser.error(f"--interval must be greater than 0, got {args.interval}")
+    if args.aggregate_every is not None and args.aggregate_every <= 0:
+        parser.error(
+            f"--aggregate-every must be greater than 0, got {args.aggregate_every}"
+        )
+    if args.binary and not args.output:
+        parser.error("--binary requires --output")
+    if args.batch_rows < 1:
+        parser.error(f"--batch-rows must be at least 1, got {args.batch_rows}")
+    if args.timeout <= 0:
+        parser.error(f"--timeout must be greater than 0, got {args.timeout}")
+    if args.parallel < 1:
+        parser.error(f"--parallel must be at least 1, got {args.parallel}")
+    if args.host_timeout <= 0:
+        parser.error(f"--host-timeout must be greater than 0, got {args.host_timeout}")
+    if args.fleet and args.vm_power:
+        # each host only takes one sample, and per-guest fields are empty on the first
+        parser.error("--vm-power can't be used with --fleet")
+
     return args
@@ -4,17 +4,37 @@
 Provides utility functions to collect energy usage information
 """
 
+import contextlib
+import contextvars
+import functools
+import itertools
+import random
 import subprocess
 import time
 import os
 from pathlib import Path
 import re
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple, Type, Union
 import logging
 import datetime
 
 logger = logging.getLogger(__name__)
 
+MEMINFO_PATH = "/proc/meminfo"
+IPMI_DEVICE_PATHS = ["/dev/ipmi0", "/dev/ipmi/0", "/dev/ipmidev/0"]
+IPMI_DCMI_CMD = "/usr/sbin/ipmi-dcmi"
+FREE_CMD = "free"
+# when output files are fsynced - never, after every batch, or before rotating and on exit
+FSYNC_POLICIES = ("never", "batch", "rotate")
+
+# inspect.CO_COROUTINE - inspect is slow to import and only this flag is needed from it
+_CO_COROUTINE = 0x80
+
+# time.monotonic() after which retry decorated functions stop retrying, set by retry_budget
+_retry_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "retry_deadline", default=None
+)
+
 
 class UnsetException(Exception):
     """
@@ -36,46 +56,141 @@ def get_func_str(func, *args, **kwargs):
     return f"{func.__name__}({','.join([args_str, kwargs_str])})"
 
 
+@contextlib.contextmanager
+def retry_budget(seconds: float):
+    """Limit total time any retry decorated function may spend retrying in this context
+
+    Nested budgets can only shorten the deadline, never extend it. Used to make sure
+    retries never run past the time a caller has left, e.g. a collector timeout
+
+    Keyword Arguments:
+        seconds: seconds from now after which no further retries are attempted
+    """
+    deadline = time.monotonic() + seconds
+    current = _retry_deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _retry_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _retry_deadline.reset(token)
+
+
+def remaining_budget() -> Optional[float]:
+    """Get seconds left before the enclosing retry_budget runs out, None if there isn't one"""
+    deadline = _retry_deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+# pylint: disable=too-many-arguments
 def retry(
-    retry_on: Tuple[Exception] = (UnsetException),
+    retry_on: Union[Tuple[Type[Exception], ...], Dict[Type[Exception], int]] = (
+        UnsetException,
+    ),
     retry_logger: logging.Logger = logger,
     retries: int = 3,
-    delay: int = 3,
-    backoff: int = 2,
+    delay: float = 3,
+    backoff: float = 2,
+    *,
+    max_delay: Optional[float] = None,
+    deadline: Optional[float] = None,
+    jitter: bool = True,
 ):
     """A retry decorator
 
+    The function is attempted once, then retried up to retries times. Delay between attempts
+    grows exponentially with full jitter, and retrying stops early once deadline seconds
+    have passed or the enclosing retry_budget runs out. Works on both plain and async
+    functions - async functions wait with asyncio.sleep so the event loop is never blocked
+
     Keyword Arguments:
-        retry_on: a set of exceptions that when any occur, will trigger a retry
-        retries: number of retries to perform before returning None
-        delay: number of seconds delay before next retry
-        backoff: a factor to increase delay after every fail
+        retry_on: a set of exceptions that when any occur, will trigger a retry. Or a dict
+            of exception to the maximum retries allowed when that exception is raised
+        retries: number of retries to perform before raising RuntimeError
+        delay: number of seconds delay before first retry
+        backoff: a factor to multiply delay by after every fail
         retry_logger: logger to log failed attempts
+        max_delay: maximum seconds delay between retries
+        deadline: maximum total seconds to spend across all attempts
+        jitter: flag to set if delay should be picked at random between 0 and the backoff delay
     """
+    if isinstance(retry_on, dict):
+        limits = dict(retry_on)
+    else:
+        limits = {exc_type: retries for exc_type in retry_on}
+    retry_exceptions = tuple(limits)
+
+    def get_delay(exc: Exception, attempt: int, start: float) -> float:
+        """Get seconds to wait before next attempt, raise if no retries or time left"""
+        limit = next(
+            (n for exc_type, n in limits.items() if isinstance(exc, exc_type)), retries
+        )
+        if attempt >= limit:
+            raise RuntimeError(
+                f"function failed and max retries {limit} exceeded"
+            ) from exc
+
+        seconds = delay * (backoff**attempt)
+        if max_delay is not None:
+            seconds = min(seconds, max_delay)
+        if jitter:
+            seconds = random.uniform(0, seconds)
+
+        budget = _retry_deadline.get()
+        if deadline is not None:
+            budget = (
+                start + deadline if budget is None else min(budget, start + deadline)
+            )
+        if budget is not None and time.monotonic() + seconds > budget:
+            raise RuntimeError(
+                f"function failed and retry deadline exceeded after {attempt + 1} attempts"
+            ) from exc
 
+        retry_logger.warning(
+            "function failed to run. Failed attempts: %s. Retrying after %.3fs delay",
+            attempt + 1,
+            seconds,
+        )
+        return seconds
+
+    # retry_exceptions is built at runtime so pylint can't tell these are all exceptions
+    # pylint: disable=catching-non-exception
     def decorator(func):
+        if getattr(func, "__code__", None) and func.__code__.co_flags & _CO_COROUTINE:
+            # imported here as asyncio is slow to import and only needed by async functions
+            # pylint: disable=import-outside-toplevel
+            from asyncio import sleep as asyncio_sleep
+
+            @functools.wraps(func)
+            async def async_inner(*args, **kwargs):
+                start = time.monotonic()
+                for attempt in itertools.count():
+                    try:
+                        retry_logger.debug(
+                            "running retry on %s", get_func_str(func, args, kwargs)
+                        )
+                        return await func(*args, **kwargs)
+                    except retry_exceptions as retry_exc:
+                        seconds = get_delay(retry_exc, attempt, start)
+                    await asyncio_sleep(seconds)
+                return None
+
+            return async_inner
+
+        @functools.wraps(func)
         def inner(*args, **kwargs):
-            res = None
-            for i in range(retries + 1):
+            start = time.monotonic()
+            for attempt in itertools.count():
                 try:
                     retry_logger.debug(
                         "running retry on %s", get_func_str(func, args, kwargs)
                     )
-                    res = func(*args, **kwargs)
-                    break
-                except retry_on as retry_exc:
-                    if i + 1 == retries:
-                        raise RuntimeError(
-                            f"function failed and max retries {retries} exceeded"
-                        ) from retry_exc
-                seconds = delay + (backoff * i)
-                retry_logger.warning(
-                    "function failed to run. Failed attempts: %s. Retrying after %s delay",
-                    i + 1,
-                    seconds,
-                )
+                    return func(*args, **kwargs)
+                except retry_exceptions as retry_exc:
+                    seconds = get_delay(retry_exc, attempt, start)
                 time.sleep(seconds)
-            return res
+            return None
 
         return inner
 
@@ -86,20 +201,41 @@ def retry(
 def run_cmd(cmd_args: str):
     """Run a bash command with given arguments and return output
 
+    The command is killed if it is still running when the enclosing retry_budget runs out,
+    so a hung command can't outlive the collector running it
+
     Keyword Arguments
         cmd_args: a string representing bash command to run
     """
-    with subprocess.Popen(
-        cmd_args, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    ) as out:
-        # assert we did not find any errors
-        err = out.stderr.read().decode()
-        if err:
-            raise RuntimeError(
-                f"Failed running command {cmd_args}, error raised: {err}"
-            )
-        res_out = out.stdout.read().decode()
-    return res_out
+    try:
+        out = subprocess.run(
+            cmd_args,
+            shell=True,
+            capture_output=True,
+            timeout=remaining_budget(),
+            check=False,
+        )
+    except subprocess.TimeoutExpired as timeout_err:
+        raise RuntimeError(
+            f"Failed running command {cmd_args}, timed out after {timeout_err.timeout:.3f}s"
+        ) from timeout_err
+    # assert we did not find any errors
+    err = out.stderr.decode()
+    if err:
+        raise RuntimeError(f"Failed running command {cmd_args}, error raised: {err}")
+    return out.stdout.decode()
+
+
+def find_ipmi_device() -> Optional[str]:
+    """Find IPMI device on host
+
+    Returns first path found out of /dev/ipmi0, /dev/ipmi/0 or /dev/ipmidev/0, or None if no
+    device exists
+    """
+    for device_path in IPMI_DEVICE_PATHS:
+        if Path(device_path).exists():
+            return device_path
+    return None
 
 
 def check_ipmi_conn():
@@ -108,9 +244,7 @@ def check_ipmi_conn():
     Checks if device exists at any of these locations /dev/ipmi0, /dev/ipmi/0 or /dev/ipmidev/0
     which imply that ipmi-dcmi can be used to get power info
     """
-    return any(
-        Path(f).exists() for f in ["/dev/ipmi0", "/dev/ipmi/0", "/dev/ipmidev/0"]
-    )
+    return find_ipmi_device() is not None
 
 
 def ipmi_raw_power_query():
@@ -119,7 +253,44 @@ def ipmi_raw_power_query():
 
     Calls ipmi-dcmi command to get all power statistics
     """
-    return run_cmd("/usr/sbin/ipmi-dcmi --get-system-power-statistics")
+    return run_cmd(f"{IPMI_DCMI_CMD} --get-system-power-statistics")
+
+
+def ipmi_dcmi_power_query() -> Optional[Dict]:
+    """
+    Get power statistics in-process through the kernel IPMI driver
+
+    Uses a DCMI Get Power Reading request on a device kept open between calls.
+    Returns None if the device can't be used, so caller can fall back to ipmi-dcmi. After
+    ipmi.MAX_FAILURES failed readings in a row the device is no longer read in-process
+    """
+    device_path = find_ipmi_device()
+    if device_path is None:
+        return None
+    # imported here as ctypes is slow to import and only needed on hosts with a BMC
+    # pylint: disable=import-outside-toplevel
+    from iriscasttools import ipmi
+
+    reader = ipmi.get_power_reader(device_path)
+    if reader is None:
+        return None
+    try:
+        return reader.get_power_reading()
+    except (OSError, ipmi.IpmiError) as dcmi_err:
+        logger.warning(
+            "in-process DCMI power reading failed, falling back to ipmi-dcmi: %s",
+            repr(dcmi_err),
+        )
+        if reader.failures >= ipmi.MAX_FAILURES:
+            logger.warning(
+                "DCMI power reading failed %s times in a row, using ipmi-dcmi from now on",
+                reader.failures,
+            )
+            ipmi.disable_power_reader(device_path)
+        else:
+            # re-open device on next reading in case it was left in a bad state
+            reader.close()
+        return None
 
 
 def to_csv(stats: Dict, include_header: bool = False):
@@ -138,6 +309,8 @@ def to_csv(stats: Dict, include_header: bool = False):
 def get_ipmi_power_stats(*args):
     """Get ipmi power stats as dictionary.
 
+    Reads from the IPMI device in-process where possible, falling back to ipmi-dcmi command
+
     Keyword arguments
     *args -- a set of fields to parse and collect.
     can be one or more of:
@@ -153,6 +326,14 @@ def get_ipmi_power_stats(*args):
 
     if not check_ipmi_conn():
         raise RuntimeError("Failed to find ipmi device on host")
+
+    dcmi_stats = ipmi_dcmi_power_query()
+    if dcmi_stats is not None:
+        power_stats.update(
+            {k: str(v) for k, v in dcmi_stats.items() if k in power_stats}
+        )
+        return power_stats
+
     res = ipmi_raw_power_query()
 
     for line in res.splitlines():
@@ -206,29 +387,93 @@ def get_os_load(*args):
     return res
 
 
+def read_meminfo(meminfo_path: str = MEMINFO_PATH) -> Dict[str, int]:
+    """Read memory statistics from /proc/meminfo
+
+    Returns a dictionary of meminfo keys (e.g. "MemTotal") to values in kB
+
+    Keyword Arguments
+    meminfo_path -- str, path to meminfo file
+    """
+    meminfo = {}
+    with open(meminfo_path, "rb") as meminfo_file:
+        for line in meminfo_file:
+            key, _, val = line.partition(b":")
+            val = val.split()
+            if val:
+                meminfo[key.decode()] = int(val[0])
+    return meminfo
+
+
+def read_free_cmd() -> Dict[str, int]:
+    """Read memory statistics using the free command
+
+    Fallback for hosts where /proc/meminfo cannot be read. Returns same keys as read_meminfo
+    """
+    meminfo = {}
+    for line in run_cmd(f"{FREE_CMD} -k -w").splitlines():
+        cols = line.split()
+        if cols and cols[0] == "Mem:":
+            (
+                meminfo["MemTotal"],
+                _,
+                meminfo["MemFree"],
+                _,
+                meminfo["Buffers"],
+                meminfo["Cached"],
+                meminfo["MemAvailable"],
+            ) = (int(col) for col in cols[1:8])
+        elif cols and cols[0] == "Swap:":
+            meminfo["SwapTotal"], _, meminfo["SwapFree"] = (
+                int(col) for col in cols[1:4]
+            )
+    return meminfo
+
+
 def get_ram_usage(*args):
     """Get Ram usage stats
 
+    Reads /proc/meminfo once per call, falling back to the free command if that's unavailable
+
     Keyword Arguments
     args -- a set of fields to parse and collect.
     can be one or more of:
-        "max_ram_kb",
-        "used_ram_kb",
+        "max_ram_kb": total usable RAM,
+        "used_ram_kb": total RAM - available RAM,
+        "available_ram_kb": estimate of RAM available for new processes without swapping,
+        "free_ram_kb": RAM not used for anything,
+        "buffers_ram_kb": RAM used by kernel buffers,
+        "cached_ram_kb": RAM used by page cache and reclaimable slab,
+        "swap_total_kb": total swap space,
+        "swap_used_kb": total swap - free swap,
         "ram_usage_percentage": (Used RAM / Total RAM) * 100
     """
     res = {x: "" for x in args}
 
-    stats = {"max_ram_kb": "", "used_ram_kb": "", "ram_usage_percentage": ""}
-
-    stats["max_ram_kb"] = int(
-        run_cmd("free -k | sed -n '2p' | awk '{print $2}'"),
-    )
-
-    stats["used_ram_kb"] = int(
-        run_cmd("free -k | sed -n '2p' | awk '{print $2}'"),
-    )
-
-    if stats["max_ram_kb"] and stats["used_ram_kb"]:
+    try:
+        meminfo = read_meminfo(MEMINFO_PATH)
+    except OSError as read_meminfo_err:
+        logger.debug(
+            "could not read %s, falling back to free: %s",
+            MEMINFO_PATH,
+            repr(read_meminfo_err),
+        )
+        meminfo = read_free_cmd()
+
+    stats = {
+        "max_ram_kb": meminfo["MemTotal"],
+        "used_ram_kb": meminfo["MemTotal"] - meminfo["MemAvailable"],
+        "available_ram_kb": meminfo["MemAvailable"],
+        "free_ram_kb": meminfo["MemFree"],
+        "buffers_ram_kb": meminfo["Buffers"],
+        # match free - page cache includes reclaimable slab
+        "cached_ram_kb": meminfo["Cached"] + meminfo.get("SReclaimable", 0),
+        "swap_total_kb": meminfo["SwapTotal"],
+        "swap_used_kb": meminfo["SwapTotal"] - meminfo["SwapFree"],
+        "ram_usage_percentage": "",
+    }
+
+    if stats["max_ram_kb"]:
         stats["ram_usage_percentage"] = round(
             (stats["used_ram_kb"] / stats["max_ram_kb"]) * 100, 3
         )
@@ -0,0 +1,146 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for collector benchmark harness for iriscasttools package
+"""
+
+import json
+import math
+import pytest
+
+from iriscasttools import utils
+from benchmarks.benchmark import (
+    FIXTURES_DIR,
+    SCENARIOS,
+    count_forks,
+    fake_hardware,
+    find_regressions,
+    main,
+    percentile,
+    run_benchmarks,
+    run_scenario,
+)
+
+_BASELINE = {
+    "p50_ms": 1.0,
+    "p99_ms": 2.0,
+    "cpu_ms": 1.0,
+    "forks_per_sample": 1.0,
+    "rss_growth_kb": 0,
+}
+
+
+@pytest.mark.parametrize(
+    "test_pct, expected_val",
+    [(50, 5), (99, 10), (100, 10), (0, 1), (10, 1), (11, 2)],
+)
+def test_percentile(test_pct, expected_val):
+    """
+    Test nearest-rank percentile
+    """
+    assert percentile(list(range(10, 0, -1)), test_pct) == expected_val
+
+
+def test_percentile_empty():
+    """
+    Test percentile of no values is NaN
+    """
+    assert math.isnan(percentile([], 50))
+
+
+def test_count_forks():
+    """
+    Test child processes are counted
+    """
+    with count_forks() as forks:
+        utils.run_cmd("true")
+        utils.run_cmd("true")
+    assert forks == [2]
+
+
+@pytest.mark.parametrize("test_dcmi", [True, False])
+def test_fake_hardware_power(test_dcmi):
+    """
+    Test power is read from fake hardware through DCMI or the fake ipmi-dcmi binary
+    """
+    with count_forks() as forks, fake_hardware(FIXTURES_DIR, dcmi=test_dcmi):
+        res = utils.get_ipmi_power_stats("current_power", "power_measurement")
+    assert res == {"current_power": "100", "power_measurement": "Active"}
+    assert forks == [0 if test_dcmi else 1]
+
+
+@pytest.mark.parametrize("test_scenario", list(SCENARIOS))
+def test_run_benchmarks(test_scenario):
+    """
+    Test each scenario runs against fake hardware and reports all metrics
+    """
+    res = run_benchmarks([test_scenario], samples=3)[test_scenario]
+    assert res["samples"] == 3
+    assert 0 <= res["p50_ms"] <= res["p99_ms"]
+    expected_forks = (
+        1.0 if test_scenario in ("power_ipmi_dcmi_cmd", "ram_free") else 0.0
+    )
+    assert res["forks_per_sample"] == expected_forks
+    assert res["rss_kb"] > 0
+
+
+def test_run_scenario_invalid():
+    """
+    Test at least one sample must be taken
+    """
+    with pytest.raises(ValueError):
+        run_scenario(dict, samples=0)
+
+
+@pytest.mark.parametrize(
+    "test_res, expected_regressions",
+    [
+        ({}, []),
+        # within tolerance and slack
+        ({"p50_ms": 1.9, "p99_ms": 3.4}, []),
+        ({"p50_ms": 2.1}, ["os_load: p50_ms 2.1 above baseline 1.0"]),
+        (
+            {"forks_per_sample": 2.0},
+            ["os_load: forks_per_sample 2.0 above baseline 1.0"],
+        ),
+        ({"rss_growth_kb": 1025}, ["os_load: rss_growth_kb 1025 above baseline 0"]),
+    ],
+)
+def test_find_regressions(test_res, expected_regressions):
+    """
+    Test results are compared against baseline with tolerance
+    """
+    results = {"os_load": {**_BASELINE, **test_res}, "new": _BASELINE}
+    assert (
+        find_regressions(results, {"os_load": _BASELINE}, tolerance=0.5)
+        == expected_regressions
+    )
+
+
+def test_main_baseline(tmp_path, capsys):
+    """
+    Test baseline saved, then compared against with regressions reported
+    """
+    baseline_fp = tmp_path / "baseline.json"
+    args = ["-n", "2", "--scenario", "os_load", "--baseline", str(baseline_fp)]
+    assert main(args + ["--save-baseline"]) == 0
+    out = capsys.readouterr().out
+    assert out.startswith("scenario,samples,p50_ms,p99_ms")
+    assert "os_load,2," in out
+
+    baseline = json.loads(baseline_fp.read_text(encoding="utf-8"))
+    assert main(args) == 0
+
+    baseline["os_load"]["forks_per_sample"] = -1
+    baseline_fp.write_text(json.dumps(baseline), encoding="utf-8")
+    assert main(args) == 1
+    assert "regression - os_load: forks_per_sample" in capsys.readouterr().err
+
+
+def test_main_no_baseline(tmp_path, capsys):
+    """
+    Test missing baseline is reported but not a failure
+    """
+    args = ["-n", "1", "--scenario", "os_load", "--baseline", str(tmp_path / "x.json")]
+    assert main(args) == 0
+    assert "no baseline" in capsys.readouterr().err
@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for reading guest CPU usage from cgroups for iriscasttools package
+"""
+
+import os
+import pytest
+
+from iriscasttools.cgroups import (
+    CgroupCpuTracker,
+    find_machine_slice,
+    format_vm_values,
+    parse_cpu_usage,
+    parse_vm_values,
+    split_power,
+    vm_name_from_scope,
+)
+
+SCOPE_1 = "machine-qemu\\x2d1\\x2dinstance\\x2d00000001.scope"
+SCOPE_2 = "machine-qemu\\x2d2\\x2dinstance\\x2d00000002.scope"
+
+
+def write_usage(slice_path, scope, usage_usec):
+    """
+    Write cgroup v2 cpu.stat for a scope
+    """
+    scope_path = slice_path / scope
+    scope_path.mkdir(parents=True, exist_ok=True)
+    (scope_path / "cpu.stat").write_text(
+        f"usage_usec {usage_usec}\nuser_usec 0\nsystem_usec 0\n", encoding="utf-8"
+    )
+
+
+@pytest.fixture(name="machine_slice")
+def machine_slice_fixture(tmp_path):
+    """
+    Fixture for a cgroup v2 machine.slice with no guests
+    """
+    slice_path = tmp_path / "machine.slice"
+    slice_path.mkdir()
+    (slice_path / "cpu.stat").write_text("usage_usec 0\n", encoding="utf-8")
+    return slice_path
+
+
+@pytest.mark.parametrize(
+    "test_scope, expected_name",
+    [
+        (SCOPE_1, "instance-00000001"),
+        ("machine-qemu-12-my-vm.scope", "my-vm"),
+        ("machine-kvm\\x2d3\\x2dvm.scope", "vm"),
+        ("libvirtd.service", None),
+        ("machine-qemu\\x2d1\\x2dvm", None),
+    ],
+)
+def test_vm_name_from_scope(test_scope, expected_name):
+    """
+    Test libvirt domain name is taken from scope name
+    """
+    assert vm_name_from_scope(test_scope) == expected_name
+
+
+def test_find_machine_slice_v2(machine_slice, tmp_path):
+    """
+    Test cgroup v2 machine.slice is found
+    """
+    assert find_machine_slice(str(tmp_path)) == (str(machine_slice), "cpu.stat", 1000)
+
+
+def test_find_machine_slice_v1(tmp_path):
+    """
+    Test cgroup v1 cpuacct machine.slice is found
+    """
+    slice_path = tmp_path / "cpu,cpuacct" / "machine.slice"
+    slice_path.mkdir(parents=True)
+    (slice_path / "cpuacct.usage").write_text("0\n", encoding="utf-8")
+    assert find_machine_slice(str(tmp_path)) == (str(slice_path), "cpuacct.usage", 1)
+
+
+def test_find_machine_slice_missing(tmp_path):
+    """
+    Test None returned on a host without VMs
+    """
+    assert find_machine_slice(str(tmp_path)) is None
+
+
+@pytest.mark.parametrize(
+    "test_data, test_ns_per_unit, expected_ns",
+    [
+        (b"usage_usec 12\nuser_usec 10\n", 1000, 12000),
+        (b"12345\n", 1, 12345),
+    ],
+)
+def test_parse_cpu_usage(test_data, test_ns_per_unit, expected_ns):
+    """
+    Test CPU usage is parsed from cpu.stat and cpuacct.usage as nanoseconds
+    """
+    assert parse_cpu_usage(test_data, test_ns_per_unit) == expected_ns
+
+
+def test_parse_cpu_usage_invalid():
+    """
+    Test error raised if cpu.stat has no usage
+    """
+    with pytest.raises(ValueError):
+        parse_cpu_usage(b"user_usec 10\n", 1000)
+
+
+def test_tracker_sample(machine_slice, tmp_path):
+    """
+    Test CPU time deltas are tracked between samples as guests come and go
+    """
+    write_usage(machine_slice, SCOPE_1, 100)
+    (machine_slice / "libvirtd.service").mkdir()
+    tracker = CgroupCpuTracker(str(tmp_path))
+
+    assert tracker.sample() == {"instance-00000001": None}
+
+    write_usage(machine_slice, SCOPE_1, 300)
+    write_usage(machine_slice, SCOPE_2, 50)
+    assert tracker.sample() == {"instance-00000001": 200000, "instance-00000002": None}
+
+    # guest 1 restarted, guest 2 gone
+    write_usage(machine_slice, SCOPE_1, 10)
+    (machine_slice / SCOPE_2 / "cpu.stat").unlink()
+    (machine_slice / SCOPE_2).rmdir()
+    assert tracker.sample() == {"instance-00000001": None}
+    assert len(os.listdir(machine_slice)) == 3
+    tracker.close()
+
+
+def test_tracker_sample_no_slice(tmp_path):
+    """
+    Test no guests returned on a host without machine.slice
+    """
+    assert not CgroupCpuTracker(str(tmp_path)).sample()
+
+
+@pytest.mark.parametrize(
+    "test_power, test_deltas, expected_split",
+    [
+        (100, {"a": 3, "b": 1}, {"a": 75.0, "b": 25.0}),
+        ("90", {"a": 1, "b": 2, "c": None}, {"a": 30.0, "b": 60.0}),
+        ("", {"a": 1}, {}),
+        (100, {"a": 0, "b": 0}, {}),
+        (100, {"a": None}, {}),
+    ],
+)
+def test_split_power(test_power, test_deltas, expected_split):
+    """
+    Test power split in proportion to CPU time
+    """
+    assert split_power(test_power, test_deltas) == expected_split
+
+
+def test_format_parse_vm_values():
+    """
+    Test per-guest values round trip through a single field
+    """
+    values = {"instance-2": 3.0, "instance-1": 12.5}
+    field = format_vm_values(values)
+    assert field == "instance-1=12.5;instance-2=3.0"
+    assert parse_vm_values(field) == values
+    assert not parse_vm_values("")
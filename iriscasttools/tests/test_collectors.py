@@ -0,0 +1,364 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for collector registry for iriscasttools package
+"""
+
+import logging
+import threading
+import time
+from unittest.mock import patch
+import pytest
+
+from iriscasttools import utils
+from iriscasttools.collectors import (
+    Collector,
+    CollectorRegistry,
+    IpmiPowerCollector,
+    OsLoadCollector,
+    RamUsageCollector,
+    SourcePowerCollector,
+    VmPowerCollector,
+    default_registry,
+)
+
+
+class FakeCollector(Collector):
+    """
+    A collector returning fixed values, or raising if given an exception
+    """
+
+    fields = ("a", "b")
+    default_fields = ("a",)
+
+    def __init__(self, name, cost_ms=0.0, raises=None, fields=None):
+        self.name = name
+        self.cost_ms = cost_ms
+        self.raises = raises
+        super().__init__(fields)
+
+    def sample(self, *fields):
+        if self.raises:
+            raise self.raises
+        return {f"{self.name}_{x}": 1 for x in fields}
+
+
+class BlockingCollector(FakeCollector):
+    """
+    A collector which blocks until released
+    """
+
+    def __init__(self, name, timeout_s=None):
+        super().__init__(name)
+        self.timeout_s = timeout_s
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def sample(self, *fields):
+        self.started.set()
+        self.release.wait()
+        return super().sample(*fields)
+
+
+def test_collector_invalid_field():
+    """
+    Test collector rejects fields it cannot provide
+    """
+    with pytest.raises(ValueError):
+        FakeCollector("fake", fields=["c"])
+
+
+def test_collector_empty():
+    """
+    Test empty gives selected fields with no value
+    """
+    assert FakeCollector("fake", fields=["a", "b"]).empty() == {"a": "", "b": ""}
+
+
+def test_registry_collect():
+    """
+    Test registry runs collectors in order and records timings
+    """
+    registry = CollectorRegistry(
+        [FakeCollector("one"), FakeCollector("two", fields=["a", "b"])]
+    )
+    res = registry.collect()
+    assert list(res.items()) == [("one_a", 1), ("two_a", 1), ("two_b", 1)]
+    assert registry.timings["one"].calls == 1
+    assert registry.timings["two"].failures == 0
+
+
+def test_registry_collect_failure():
+    """
+    Test a failing collector leaves its fields empty and counts failure
+    """
+    registry = CollectorRegistry(
+        [FakeCollector("one", raises=RuntimeError("no ipmi")), FakeCollector("two")]
+    )
+    assert registry.collect() == {"a": "", "two_a": 1}
+    assert registry.collect() == {"a": "", "two_a": 1}
+    assert registry.timings["one"].calls == 2
+    assert registry.timings["one"].failures == 2
+    assert registry.timings["two"].failures == 0
+
+
+def test_registry_collect_failure_logged_once(caplog):
+    """
+    Test a collector failing every sample only logs an error the first time, until it
+    succeeds again
+    """
+    caplog.set_level(logging.DEBUG, logger="iriscasttools")
+    collector = FakeCollector("one", raises=RuntimeError("no ipmi"))
+    registry = CollectorRegistry([collector])
+    registry.collect()
+    registry.collect()
+    collector.raises = None
+    registry.collect()
+    collector.raises = RuntimeError("no ipmi")
+    registry.collect()
+    assert [
+        r.levelno for r in caplog.records if r.getMessage().startswith("collector one")
+    ] == [logging.ERROR, logging.DEBUG, logging.ERROR]
+
+
+def test_registry_disable():
+    """
+    Test disabled collectors are not run
+    """
+    registry = CollectorRegistry([FakeCollector("one"), FakeCollector("two")])
+    registry.disable("one")
+    assert registry.collect() == {"two_a": 1}
+    assert registry.timings["one"].calls == 0
+
+    with pytest.raises(ValueError):
+        registry.disable("invalid")
+
+
+def test_registry_disable_above_cost():
+    """
+    Test collectors with a declared cost above threshold are disabled
+    """
+    registry = CollectorRegistry(
+        [FakeCollector("cheap", cost_ms=0.1), FakeCollector("expensive", cost_ms=100)]
+    )
+    registry.disable_above_cost(1)
+    assert [c.name for c in registry.collectors] == ["cheap"]
+
+
+class BarrierCollector(FakeCollector):
+    """
+    A collector which waits for all other collectors sharing its barrier to start
+    """
+
+    def __init__(self, name, barrier):
+        super().__init__(name)
+        self.barrier = barrier
+
+    def sample(self, *fields):
+        self.barrier.wait(timeout=5)
+        return super().sample(*fields)
+
+
+def test_registry_collect_concurrent():
+    """
+    Test collectors run at the same time - would fail on barrier timeout if run in turn
+    """
+    barrier = threading.Barrier(3)
+    collectors = [BarrierCollector(name, barrier) for name in ("one", "two", "three")]
+    with CollectorRegistry(collectors) as registry:
+        assert registry.collect() == {"one_a": 1, "two_a": 1, "three_a": 1}
+        assert registry.timings["one"].failures == 0
+
+
+def test_registry_collect_timeout():
+    """
+    Test a slow collector leaves its fields empty without holding up other collectors,
+    and is skipped while it is still running
+    """
+    slow = BlockingCollector("slow")
+    with CollectorRegistry([slow, FakeCollector("fast")], timeout_s=0.05) as registry:
+        start = time.monotonic()
+        assert registry.collect() == {"a": "", "fast_a": 1}
+        assert time.monotonic() - start < 1
+        assert registry.timings["slow"].failures == 1
+
+        # still running from last sample so not submitted again
+        assert registry.collect() == {"a": "", "fast_a": 1}
+        assert registry.timings["slow"].failures == 2
+
+        slow.release.set()
+        time.sleep(0.05)
+        assert registry.collect() == {"slow_a": 1, "fast_a": 1}
+        assert registry.timings["slow"].failures == 2
+
+
+def test_registry_collect_collector_timeout():
+    """
+    Test a collector's own timeout overrides registry timeout
+    """
+    slow = BlockingCollector("slow", timeout_s=0.01)
+    with CollectorRegistry([slow], timeout_s=60) as registry:
+        assert registry.collect() == {"a": ""}
+        slow.release.set()
+
+
+def test_registry_collect_retry_budget():
+    """
+    Test collectors run with a retry budget matching their timeout
+    """
+    budgets = {}
+
+    class BudgetCollector(FakeCollector):
+        """records retry deadline set while sampling"""
+
+        def sample(self, *fields):
+            # pylint: disable=protected-access
+            budgets[self.name] = utils._retry_deadline.get()
+            return super().sample(*fields)
+
+    with patch("iriscasttools.utils.time.monotonic", return_value=100):
+        with CollectorRegistry([BudgetCollector("one")], timeout_s=5) as registry:
+            registry.collect()
+    assert budgets == {"one": 105}
+
+
+@patch("iriscasttools.collectors.time.perf_counter")
+def test_registry_self_stats(mock_perf_counter):
+    """
+    Test recorded timings are reported for each collector
+
+    Keyword arguments:
+        mock_perf_counter -- mock time.perf_counter
+    """
+    mock_perf_counter.side_effect = [0, 0.002, 1, 1.004]
+    registry = CollectorRegistry([FakeCollector("one", cost_ms=5)])
+    registry.collect()
+    registry.collect()
+    assert registry.self_stats() == [
+        {
+            "collector": "one",
+            "enabled": True,
+            "declared_cost_ms": 5,
+            "calls": 2,
+            "failures": 0,
+            "mean_ms": 3.0,
+            "max_ms": 4.0,
+            "last_ms": 4.0,
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "collector, mock_func",
+    [
+        (IpmiPowerCollector(), "get_ipmi_power_stats"),
+        (OsLoadCollector(), "get_os_load"),
+        (RamUsageCollector(), "get_ram_usage"),
+    ],
+)
+def test_builtin_collectors(collector, mock_func):
+    """
+    Test built-in collectors call the matching utils function with selected fields
+    """
+    with patch(f"iriscasttools.collectors.utils.{mock_func}") as mock_util:
+        assert collector.sample(*collector.selected_fields) == mock_util.return_value
+        mock_util.assert_called_once_with(*collector.default_fields)
+
+
+def test_default_registry():
+    """
+    Test default registry collects power, OS load and RAM in that order
+    """
+    assert [c.name for c in default_registry().collectors] == [
+        "power",
+        "os_load",
+        "ram",
+    ]
+
+
+class CombineCollector(FakeCollector):
+    """
+    A collector which adds a field from another collector in combine
+    """
+
+    requires = ("power_a",)
+
+    def combine(self, res, stats):
+        return {k: v + stats["power_a"] for k, v in res.items()}
+
+
+def test_registry_collect_combine():
+    """
+    Test collectors which require fields from others are combined after all have run
+    """
+    registry = CollectorRegistry([CombineCollector("first"), FakeCollector("power")])
+    assert registry.collect() == {"first_a": 2, "power_a": 1}
+
+
+def test_registry_collect_combine_failure():
+    """
+    Test combine isn't called for a collector which failed
+    """
+    registry = CollectorRegistry(
+        [CombineCollector("first", raises=ValueError()), FakeCollector("power")]
+    )
+    assert registry.collect() == {"a": "", "power_a": 1}
+
+
+@patch("iriscasttools.cgroups.CgroupCpuTracker")
+def test_vm_power_collector(mock_tracker):
+    """
+    Test current_power is split between VMs by CPU time used
+
+    Keyword arguments:
+        mock_tracker -- Mock obj for CgroupCpuTracker
+    """
+    mock_tracker.return_value.sample.return_value = {
+        "instance-1": 3 * 10**9,
+        "instance-2": 10**9,
+        "instance-3": None,
+    }
+    collector = VmPowerCollector(fields=VmPowerCollector.fields)
+    res = collector.sample(*collector.selected_fields)
+    assert res == {
+        "vm_count": 3,
+        "vm_cpu_seconds": "instance-1=3.0;instance-2=1.0",
+        "vm_power": "",
+    }
+    assert collector.combine(res, {"current_power": "100"}) == {
+        "vm_count": 3,
+        "vm_cpu_seconds": "instance-1=3.0;instance-2=1.0",
+        "vm_power": "instance-1=75.0;instance-2=25.0",
+    }
+
+
+@patch("iriscasttools.powersources.select_source")
+def test_source_power_collector(mock_select_source):
+    """
+    Test power read from cheapest source, picked once
+
+    Keyword arguments:
+        mock_select_source -- Mock obj for select_source
+    """
+    mock_select_source.return_value.name = "rapl"
+    mock_select_source.return_value.read.return_value = 123.45678
+    collector = SourcePowerCollector(sources=[])
+    assert collector.sample(*collector.selected_fields) == {
+        "power_source": "rapl",
+        "source_power": 123.457,
+    }
+    collector.sample(*collector.selected_fields)
+    mock_select_source.assert_called_once()
+
+
+@patch("iriscasttools.powersources.select_source")
+def test_source_power_collector_unavailable(mock_select_source):
+    """
+    Test error raised if no power source is available
+
+    Keyword arguments:
+        mock_select_source -- Mock obj for select_source
+    """
+    mock_select_source.return_value = None
+    with pytest.raises(RuntimeError):
+        SourcePowerCollector().sample("source_power")
@@ -0,0 +1,190 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for daemon mode of iriscasttools package
+"""
+
+import threading
+from unittest.mock import patch
+import pytest
+
+from iriscasttools.daemon import run_daemon, sample_schedule
+
+
+# pylint: disable=too-few-public-methods
+class FakeClock:
+    """
+    A fake monotonic clock which only advances when told to
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeEvent(threading.Event):
+    """
+    An event whose wait() advances a fake clock instead of blocking
+    """
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        self.clock.now += timeout
+        return self.is_set()
+
+
+def test_sample_schedule_no_drift():
+    """
+    Test that time spent collecting a sample does not delay later samples
+    """
+    clock = FakeClock()
+    stop_event = FakeEvent(clock)
+    ticks = []
+    for tick in sample_schedule(10, stop_event, clock=clock, max_samples=4):
+        ticks.append((tick, clock.now))
+        # each sample takes 3 seconds
+        clock.now += 3
+
+    assert ticks == [(0, 0), (1, 10), (2, 20), (3, 30)]
+    assert stop_event.waits == [7, 7, 7]
+
+
+def test_sample_schedule_skips_overrun():
+    """
+    Test that ticks missed by a slow sample are skipped rather than run back-to-back
+    """
+    clock = FakeClock()
+    stop_event = FakeEvent(clock)
+    ticks = []
+    for tick in sample_schedule(10, stop_event, clock=clock, max_samples=3):
+        ticks.append((tick, clock.now))
+        clock.now += 25 if tick == 0 else 1
+
+    assert ticks == [(0, 0), (3, 30), (4, 40)]
+
+
+def test_sample_schedule_stops():
+    """
+    Test that schedule stops once stop event is set
+    """
+    stop_event = threading.Event()
+    ticks = []
+    for tick in sample_schedule(0.01, stop_event):
+        ticks.append(tick)
+        if tick == 2:
+            stop_event.set()
+    assert ticks == [0, 1, 2]
+
+
+def test_run_daemon_invalid_interval():
+    """
+    Test that run_daemon rejects a non-positive interval
+    """
+    with pytest.raises(ValueError):
+        run_daemon(0, stop_event=threading.Event())
+
+
+@pytest.mark.parametrize(
+    "test_include_header, expected_lines",
+    [
+        (False, ["t,100,0.5,10.0", "t,100,0.5,10.0"]),
+        (
+            True,
+            ["timestamp,current_power,os_load_5,ram_usage_percentage"]
+            + ["t,100,0.5,10.0"] * 2,
+        ),
+    ],
+)
+@patch("iriscasttools.daemon.get_iriscast_stats")
+@patch("iriscasttools.daemon.datetime")
+def test_run_daemon_to_file(
+    mock_datetime,
+    mock_get_iriscast_stats,
+    tmp_path,
+    test_include_header,
+    expected_lines,
+):
+    """
+    Test that daemon appends one csv row per sample to output file, with header only once
+
+    Keyword arguments:
+        mock_datetime -- Mock obj for datetime module
+        mock_get_iriscast_stats -- Mock obj for get_iriscast_stats
+    """
+    mock_datetime.datetime.now.return_value.isoformat.return_value = "t"
+    mock_get_iriscast_stats.return_value = {
+        "current_power": "100",
+        "os_load_5": 0.5,
+        "ram_usage_percentage": 10.0,
+    }
+    out_fp = tmp_path / "out.csv"
+    run_daemon(
+        0.001,
+        include_header=test_include_header,
+        output=str(out_fp),
+        max_samples=2,
+        stop_event=threading.Event(),
+    )
+    assert out_fp.read_text(encoding="utf-8").splitlines() == expected_lines
+
+
+@patch("iriscasttools.daemon.get_iriscast_stats")
+def test_run_daemon_survives_failed_sample(mock_get_iriscast_stats, tmp_path):
+    """
+    Test that a failed sample is logged and skipped rather than stopping the daemon
+
+    Keyword arguments:
+        mock_get_iriscast_stats -- Mock obj for get_iriscast_stats
+    """
+    mock_get_iriscast_stats.side_effect = [
+        RuntimeError("no ipmi"),
+        {"current_power": "1"},
+    ]
+    out_fp = tmp_path / "out.csv"
+    run_daemon(0.001, output=str(out_fp), max_samples=2, stop_event=threading.Event())
+    rows = out_fp.read_text(encoding="utf-8").splitlines()
+    assert len(rows) == 1
+    assert rows[0].endswith(",1")
+
+
+@patch("iriscasttools.daemon.get_iriscast_stats")
+@patch("iriscasttools.daemon.datetime")
+def test_run_daemon_aggregates(mock_datetime, mock_get_iriscast_stats, tmp_path):
+    """
+    Test that daemon writes rolling aggregates instead of raw samples when requested
+
+    Keyword arguments:
+        mock_datetime -- Mock obj for datetime module
+        mock_get_iriscast_stats -- Mock obj for get_iriscast_stats
+    """
+    mock_datetime.datetime.now.return_value.isoformat.return_value = "t"
+    mock_get_iriscast_stats.side_effect = [
+        {"current_power": "100"},
+        {"current_power": "300"},
+    ]
+    out_fp = tmp_path / "out.csv"
+    run_daemon(
+        0.001,
+        include_header=True,
+        output=str(out_fp),
+        max_samples=2,
+        stop_event=threading.Event(),
+        aggregate_every=0.001,
+    )
+    rows = out_fp.read_text(encoding="utf-8").splitlines()
+    assert rows[0] == (
+        "timestamp,current_power_min_1m,current_power_min_5m,current_power_min_15m,"
+        "current_power_max_1m,current_power_max_5m,current_power_max_15m,"
+        "current_power_avg_1m,current_power_avg_5m,current_power_avg_15m"
+    )
+    assert rows[1:] == [
+        "t,100.0,100.0,100.0,100.0,100.0,100.0,100.0,100.0,100.0",
+        "t,100.0,100.0,100.0,300.0,300.0,300.0,200.0,200.0,200.0",
+    ]
@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for Prometheus exporter for iriscasttools package
+"""
+
+import threading
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+import pytest
+
+from iriscasttools.collectors import CollectorRegistry
+from iriscasttools.daemon import Sampler
+from iriscasttools.exporter import (
+    MetricsServer,
+    escape_label,
+    format_value,
+    render_metrics,
+    run_exporter,
+)
+
+
+@pytest.mark.parametrize(
+    "test_val, expected_val",
+    [("host1", "host1"), ('a"b', 'a\\"b'), ("a\\b", "a\\\\b"), ("a\nb", "a\\nb")],
+)
+def test_escape_label(test_val, expected_val):
+    """
+    Test label values are escaped
+    """
+    assert escape_label(test_val) == expected_val
+
+
+@pytest.mark.parametrize(
+    "test_val, expected_val",
+    [(1.5, "1.5"), (100.0, "100.0"), (float("nan"), "NaN"), (float("inf"), "+Inf")],
+)
+def test_format_value(test_val, expected_val):
+    """
+    Test values are formatted with Prometheus spelling of special floats
+    """
+    assert format_value(test_val) == expected_val
+
+
+@patch("iriscasttools.daemon.get_iriscast_stats")
+@patch("iriscasttools.daemon.datetime")
+def test_render_metrics(mock_datetime, mock_get_iriscast_stats):
+    """
+    Test latest sample, aggregates and collector timings are rendered with HELP/TYPE lines
+
+    Keyword arguments:
+        mock_datetime -- Mock obj for datetime module
+        mock_get_iriscast_stats -- Mock obj for get_iriscast_stats
+    """
+    mock_datetime.datetime.now.return_value.isoformat.return_value = "t"
+    mock_get_iriscast_stats.return_value = {
+        "current_power": "100",
+        "power_measurement": "Active",
+        "custom": 2,
+    }
+    sampler = Sampler(CollectorRegistry(), 60, windows={"1m": 60})
+    sampler.sample()
+    lines = render_metrics(sampler, "hv1").splitlines()
+
+    assert lines[:6] == [
+        "# HELP iriscast_power_watts Current power draw reported by BMC",
+        "# TYPE iriscast_power_watts gauge",
+        'iriscast_power_watts{host="hv1"} 100.0',
+        "# HELP iriscast_custom iriscast custom",
+        "# TYPE iriscast_custom gauge",
+        'iriscast_custom{host="hv1"} 2.0',
+    ]
+    assert "# TYPE iriscast_power_watts_avg_over_window gauge" in lines
+    assert 'iriscast_power_watts_avg_over_window{host="hv1",window="1m"} 100.0' in lines
+    # non-numeric fields are left out
+    assert not [line for line in lines if "power_measurement" in line]
+    assert "# TYPE iriscast_collector_failures_total counter" in lines
+
+
+@patch("iriscasttools.daemon.get_iriscast_stats")
+def test_render_metrics_vm_power(mock_get_iriscast_stats):
+    """
+    Test per-VM power is rendered with a vm label
+
+    Keyword arguments:
+        mock_get_iriscast_stats -- Mock obj for get_iriscast_stats
+    """
+    mock_get_iriscast_stats.return_value = {
+        "current_power": "100",
+        "vm_count": 2,
+        "vm_power": "instance-1=75.0;instance-2=25.0",
+    }
+    sampler = Sampler(CollectorRegistry(), 60)
+    sampler.sample()
+    lines = render_metrics(sampler, "hv1").splitlines()
+
+    assert lines[:4] == [
+        "# HELP iriscast_vm_power_watts Share of current power draw attributed to VM by "
+        "CPU time",
+        "# TYPE iriscast_vm_power_watts gauge",
+        'iriscast_vm_power_watts{host="hv1",vm="instance-1"} 75.0',
+        'iriscast_vm_power_watts{host="hv1",vm="instance-2"} 25.0',
+    ]
+    assert 'iriscast_vm_count{host="hv1"} 2.0' in lines
+
+
+def test_render_metrics_no_sample():
+    """
+    Test metrics render before first sample has been taken
+    """
+    sampler = Sampler(CollectorRegistry(), 60)
+    assert "iriscast_power_watts" not in render_metrics(sampler, "hv1")
+
+
+@pytest.fixture(name="metrics_server")
+def metrics_server_fixture():
+    """
+    Fixture for a metrics server running on a free port
+    """
+    server = MetricsServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_metrics_server(metrics_server):
+    """
+    Test cached metrics page is served on /metrics
+    """
+    metrics_server.update('iriscast_power_watts{host="hv1"} 100.0\n')
+    port = metrics_server.server_address[1]
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as res:
+        assert res.status == 200
+        assert res.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert res.read() == b'iriscast_power_watts{host="hv1"} 100.0\n'
+
+
+def test_metrics_server_not_found(metrics_server):
+    """
+    Test other paths return 404
+    """
+    port = metrics_server.server_address[1]
+    with pytest.raises(urllib.error.HTTPError) as http_error:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/other", timeout=5):
+            pass
+    assert http_error.value.code == 404
+
+
+@patch("iriscasttools.exporter.render_metrics")
+@patch("iriscasttools.exporter.MetricsServer")
+@patch("iriscasttools.exporter.Sampler")
+def test_run_exporter(mock_sampler, mock_metrics_server, mock_render_metrics):
+    """
+    Test exporter updates cached page after every sample and shuts down server on exit
+
+    Keyword arguments:
+        mock_sampler -- Mock obj for Sampler class
+        mock_metrics_server -- Mock obj for MetricsServer class
+        mock_render_metrics -- Mock obj for render_metrics
+    """
+    run_exporter(
+        0.001,
+        0,
+        registry=CollectorRegistry(),
+        max_samples=3,
+        stop_event=threading.Event(),
+    )
+    server = mock_metrics_server.return_value
+    assert mock_sampler.return_value.sample.call_count == 3
+    assert server.update.call_count == 3
+    server.update.assert_called_with(mock_render_metrics.return_value)
+    server.shutdown.assert_called_once()
+    server.server_close.assert_called_once()
@@ -0,0 +1,269 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for fleet-wide collection over SSH for iriscasttools package
+"""
+
+import subprocess
+import threading
+import time
+from unittest.mock import MagicMock, patch
+import pytest
+
+from iriscasttools.fleet import (
+    REMOTE_COMMAND,
+    HostResult,
+    collect_fleet,
+    collect_host,
+    format_failures,
+    merge_results,
+    parse_csv_output,
+    read_inventory,
+    remote_command,
+    run_fleet,
+)
+from iriscasttools.stats import parse_args
+
+
+def test_read_inventory(tmp_path):
+    """
+    Test hosts are read one per line, skipping comments, blank lines and repeats
+    """
+    inventory = tmp_path / "hosts.txt"
+    inventory.write_text(
+        "# hypervisors\nhv1\n\nhv2  # rack 2\nhv1\n  hv3\n", encoding="utf-8"
+    )
+    assert read_inventory(str(inventory)) == ["hv1", "hv2", "hv3"]
+
+
+@pytest.mark.parametrize(
+    "test_out, expected_stats",
+    [
+        ("a,b\n1,2\n", {"a": "1", "b": "2"}),
+        ("some warning\na,b\n1,2\n\n", {"a": "1", "b": "2"}),
+    ],
+)
+def test_parse_csv_output(test_out, expected_stats):
+    """
+    Test header and row are parsed from end of remote output
+    """
+    assert parse_csv_output(test_out) == expected_stats
+
+
+@pytest.mark.parametrize("test_out", ["", "a,b\n", "a,b\n1\n"])
+def test_parse_csv_output_invalid(test_out):
+    """
+    Test error raised on unexpected remote output
+    """
+    with pytest.raises(ValueError):
+        parse_csv_output(test_out)
+
+
+@patch("iriscasttools.fleet.subprocess.run")
+def test_collect_host(mock_run):
+    """
+    Test remote command is run over ssh and its output parsed
+
+    Keyword arguments:
+        mock_run -- Mock obj for subprocess.run
+    """
+    mock_run.return_value = subprocess.CompletedProcess([], 0, "a,b\n1,2\n", "")
+    res = collect_host("hv1", REMOTE_COMMAND, timeout=5, ssh_cmd=("ssh",))
+
+    assert res.stats == {"a": "1", "b": "2"}
+    assert not res.failed
+    cmd = mock_run.call_args.args[0]
+    assert cmd == [
+        "ssh",
+        "-o",
+        "ConnectTimeout=5",
+        "hv1",
+        "python3 -m iriscasttools --as-csv --include-header",
+    ]
+    assert mock_run.call_args.kwargs["timeout"] == 5
+
+
+@pytest.mark.parametrize(
+    "test_run, expected_error",
+    [
+        (
+            subprocess.CompletedProcess(
+                [], 255, "", "ssh: connect to host hv1: refused\n"
+            ),
+            "exit code 255: ssh: connect to host hv1: refused",
+        ),
+        (subprocess.CompletedProcess([], 1, "", ""), "exit code 1: no output"),
+        (subprocess.TimeoutExpired("ssh", 5), "timed out after 5s"),
+        (FileNotFoundError("ssh"), "FileNotFoundError('ssh')"),
+        (
+            subprocess.CompletedProcess([], 0, "no stats", ""),
+            "expected csv header and row, got 'no stats'",
+        ),
+    ],
+)
+@patch("iriscasttools.fleet.subprocess.run")
+def test_collect_host_failed(mock_run, test_run, expected_error):
+    """
+    Test failures are returned rather than raised
+
+    Keyword arguments:
+        mock_run -- Mock obj for subprocess.run
+    """
+    if isinstance(test_run, Exception):
+        mock_run.side_effect = test_run
+    else:
+        mock_run.return_value = test_run
+    res = collect_host("hv1", timeout=5)
+    assert res.failed
+    assert res.stats is None
+    assert res.error == expected_error
+
+
+@patch("iriscasttools.fleet.collect_host")
+def test_collect_fleet_bounded(mock_collect_host):
+    """
+    Test hosts are collected concurrently, but no more than parallel at once, and
+    results keep inventory order
+
+    Keyword arguments:
+        mock_collect_host -- Mock obj for collect_host
+    """
+    lock = threading.Lock()
+    running = {"now": 0, "max": 0}
+
+    def fake_collect(host, *_):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.02)
+        with lock:
+            running["now"] -= 1
+        return HostResult(host, stats={"a": host})
+
+    mock_collect_host.side_effect = fake_collect
+    hosts = [f"hv{i}" for i in range(20)]
+    results = collect_fleet(hosts, parallel=4)
+
+    assert [r.host for r in results] == hosts
+    assert running["max"] == 4
+
+
+def test_collect_fleet_invalid():
+    """
+    Test parallel must be at least 1
+    """
+    with pytest.raises(ValueError):
+        collect_fleet(["hv1"], parallel=0)
+    assert not collect_fleet([])
+
+
+def test_merge_results():
+    """
+    Test results are merged into one csv, with union of fields and failed hosts left out
+    """
+    results = [
+        HostResult("hv1", stats={"current_power": "100", "os_load_5": "1.0"}),
+        HostResult("hv2", error="timed out after 5s"),
+        HostResult("hv3", stats={"os_load_5": "2.0", "ram_usage_percentage": "50"}),
+    ]
+    assert merge_results(results) == (
+        "host,current_power,os_load_5,ram_usage_percentage\n"
+        "hv1,100,1.0,\n"
+        "hv3,,2.0,50"
+    )
+    assert merge_results([HostResult("hv1", error="failed")]) == ""
+
+
+def test_format_failures():
+    """
+    Test failed hosts are summarised
+    """
+    results = [
+        HostResult("hv1", stats={}),
+        HostResult("hv2", error="timed out after 5s"),
+    ]
+    assert format_failures(results) == "1 of 2 hosts failed\nhv2: timed out after 5s"
+
+
+@pytest.mark.parametrize(
+    "test_results, expected_status",
+    [
+        ([HostResult("hv1", stats={"a": "1"})], 0),
+        ([HostResult("hv1", stats={"a": "1"}), HostResult("hv2", error="e")], 1),
+    ],
+)
+@patch("iriscasttools.fleet.collect_fleet")
+def test_run_fleet(mock_collect_fleet, tmp_path, capsys, test_results, expected_status):
+    """
+    Test merged csv written to output and failures reported on stderr
+
+    Keyword arguments:
+        mock_collect_fleet -- Mock obj for collect_fleet
+    """
+    mock_collect_fleet.return_value = test_results
+    out_fp = tmp_path / "fleet.csv"
+    assert run_fleet(["hv1", "hv2"], output=str(out_fp)) == expected_status
+    assert out_fp.read_text(encoding="utf-8") == "host,a\nhv1,1\n"
+    if expected_status:
+        assert "hv2: e" in capsys.readouterr().err
+
+
+@patch("iriscasttools.fleet.collect_fleet")
+def test_run_fleet_stdout(mock_collect_fleet, capsys):
+    """
+    Test only the merged csv is written to stdout, with the summary on stderr
+
+    Keyword arguments:
+        mock_collect_fleet -- Mock obj for collect_fleet
+    """
+    mock_collect_fleet.return_value = [
+        HostResult("hv1", stats={"a": "1"}),
+        HostResult("hv2", stats={"a": "2"}),
+    ]
+    assert run_fleet(["hv1", "hv2"]) == 0
+    captured = capsys.readouterr()
+    assert captured.out == "host,a\nhv1,1\nhv2,2\n"
+    assert "collected from 2 of 2 hosts" in captured.err
+
+
+def test_remote_command():
+    """
+    Test collector options are passed on to each host
+    """
+    cmd_args = parse_args(
+        [
+            "--fleet",
+            "-",
+            "--disable",
+            "ram",
+            "--max-cost",
+            "10",
+            "--power-source",
+            "rapl",
+            "--host-timeout",
+            "5",
+        ]
+    )
+    assert remote_command(cmd_args) == [
+        *REMOTE_COMMAND,
+        "--disable",
+        "ram",
+        "--max-cost",
+        "10.0",
+        "--power-source",
+        "rapl",
+        "--timeout",
+        "5.0",
+    ]
+
+
+@patch("iriscasttools.fleet.sys.stdin")
+def test_read_inventory_stdin(mock_stdin):
+    """
+    Test hosts are read from stdin given -
+
+    Keyword arguments:
+        mock_stdin -- Mock obj for sys.stdin
+    """
+    mock_stdin.readlines = MagicMock(return_value=["hv1\n", "hv2\n"])
+    assert read_inventory("-") == ["hv1", "hv2"]
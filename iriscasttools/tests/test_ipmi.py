@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for in-process IPMI DCMI reader for iriscasttools package
+"""
+
+import ctypes
+import struct
+from unittest.mock import patch
+import pytest
+
+from iriscasttools import ipmi
+from iriscasttools.ipmi import (
+    DcmiPowerReader,
+    IpmiError,
+    disable_power_reader,
+    get_power_reader,
+    parse_power_reading,
+)
+
+# completion code, group extension, current, min, max, avg, timestamp, period, state
+_TEST_RESPONSE = bytes([0x00, 0xDC]) + struct.pack(
+    "<HHHHIIB", 100, 20, 400, 150, 1669075200, 1000, 0x40
+)
+
+
+@pytest.mark.skipif(ctypes.sizeof(ctypes.c_void_p) != 8, reason="64-bit only")
+def test_ioctl_numbers():
+    """
+    Test ioctl request numbers match those generated by linux/ipmi.h on 64-bit hosts
+    """
+    assert ipmi.IPMICTL_SEND_COMMAND == 0x8028690D
+    assert ipmi.IPMICTL_RECEIVE_MSG_TRUNC == 0xC030690B
+
+
+@patch("iriscasttools.ipmi.datetime")
+def test_parse_power_reading(mock_datetime):
+    """
+    Test DCMI response is parsed into same format as ipmi-dcmi output
+
+    Keyword arguments:
+        mock_datetime -- mock datetime module
+    """
+    mock_datetime.datetime.fromtimestamp.return_value.strftime.return_value = "ts"
+    assert parse_power_reading(_TEST_RESPONSE) == {
+        "current_power": 100,
+        "minimum_power_over_sampling_duration": 20,
+        "maximum_power_over_sampling_duration": 400,
+        "average_power_over_sampling_duration": 150,
+        "time_stamp": "ts",
+        "statistics_reporting_time_period": 1000,
+        "power_measurement": "Active",
+    }
+    mock_datetime.datetime.fromtimestamp.assert_called_once_with(1669075200)
+
+
+def test_parse_power_reading_inactive():
+    """
+    Test power measurement state is reported when measurement is inactive
+    """
+    res = parse_power_reading(_TEST_RESPONSE[:-1] + b"\x00")
+    assert res["power_measurement"] == "Not Available"
+
+
+@pytest.mark.parametrize(
+    "test_response",
+    [
+        b"",
+        # non-zero completion code - command not supported
+        b"\xc1",
+        # wrong group extension
+        b"\x00\xaa" + _TEST_RESPONSE[2:],
+        # truncated
+        _TEST_RESPONSE[:10],
+        # truncated by one byte - missing power measurement state
+        _TEST_RESPONSE[:18],
+    ],
+)
+def test_parse_power_reading_invalid(test_response):
+    """
+    Test IpmiError raised on error or malformed responses
+    """
+    with pytest.raises(IpmiError):
+        parse_power_reading(test_response)
+
+
+@patch("iriscasttools.ipmi.select.select")
+@patch("iriscasttools.ipmi.fcntl.ioctl")
+@patch("iriscasttools.ipmi.os")
+def test_get_power_reading(mock_os, mock_ioctl, mock_select):
+    """
+    Test reader sends DCMI request and reads back matching response
+
+    Keyword arguments:
+        mock_os -- mock os module
+        mock_ioctl -- mock fcntl.ioctl
+        mock_select -- mock select.select
+    """
+    mock_os.open.return_value = 3
+    mock_select.return_value = ([3], [], [])
+    sent = {}
+
+    def fake_ioctl(_fd, request, arg):
+        if request == ipmi.IPMICTL_SEND_COMMAND:
+            sent["netfn"], sent["cmd"] = arg.msg.netfn, arg.msg.cmd
+            sent["data"] = bytes(arg.msg.data[: arg.msg.data_len])
+            sent["msgid"] = arg.msgid
+        else:
+            arg.recv_type = ipmi.IPMI_RESPONSE_RECV_TYPE
+            arg.msgid = sent["msgid"]
+            ctypes.memmove(arg.msg.data, _TEST_RESPONSE, len(_TEST_RESPONSE))
+            arg.msg.data_len = len(_TEST_RESPONSE)
+        return 0
+
+    mock_ioctl.side_effect = fake_ioctl
+    reader = DcmiPowerReader("/dev/ipmi0")
+    assert reader.get_power_reading()["current_power"] == 100
+    assert reader.get_power_reading()["current_power"] == 100
+
+    # device is only opened once
+    mock_os.open.assert_called_once()
+    assert sent["netfn"] == 0x2C
+    assert sent["cmd"] == 0x02
+    assert sent["data"] == b"\xdc\x01\x00\x00"
+
+    reader.close()
+    mock_os.close.assert_called_once_with(3)
+
+
+@patch("iriscasttools.ipmi.select.select")
+@patch("iriscasttools.ipmi.fcntl.ioctl")
+@patch("iriscasttools.ipmi.os")
+def test_get_power_reading_timeout(mock_os, mock_ioctl, mock_select):
+    """
+    Test IpmiError raised when BMC does not respond in time
+
+    Keyword arguments:
+        mock_os -- mock os module
+        mock_ioctl -- mock fcntl.ioctl
+        mock_select -- mock select.select
+    """
+    mock_os.open.return_value = 3
+    mock_select.return_value = ([], [], [])
+    with pytest.raises(IpmiError):
+        DcmiPowerReader("/dev/ipmi0", timeout=0.1).get_power_reading()
+    mock_ioctl.assert_called_once()
+
+
+@patch("iriscasttools.ipmi.parse_power_reading")
+@patch("iriscasttools.ipmi.DcmiPowerReader._request")
+@patch("iriscasttools.ipmi.os")
+def test_get_power_reading_failures(mock_os, mock_request, mock_parse):
+    """
+    Test failed readings in a row are counted, and the count reset by a successful reading
+
+    Keyword arguments:
+        mock_os -- mock os module
+        mock_request -- mock DcmiPowerReader._request
+        mock_parse -- mock parse_power_reading
+    """
+    mock_os.open.return_value = 3
+    mock_request.side_effect = [IpmiError, OSError, _TEST_RESPONSE]
+    reader = DcmiPowerReader("/dev/ipmi0")
+    for _ in range(2):
+        with pytest.raises((IpmiError, OSError)):
+            reader.get_power_reading()
+    assert reader.failures == 2
+    assert reader.get_power_reading() == mock_parse.return_value
+    assert reader.failures == 0
+
+
+@patch.dict("iriscasttools.ipmi._READERS", clear=True)
+@patch("iriscasttools.ipmi.os.open")
+def test_get_power_reader_cached(mock_open):
+    """
+    Test shared reader is created once per device and None cached if device can't be opened
+
+    Keyword arguments:
+        mock_open -- mock os.open
+    """
+    mock_open.side_effect = [3, PermissionError]
+    reader = get_power_reader("/dev/ipmi0")
+    assert isinstance(reader, DcmiPowerReader)
+    assert get_power_reader("/dev/ipmi0") is reader
+
+    assert get_power_reader("/dev/ipmi/0") is None
+    assert get_power_reader("/dev/ipmi/0") is None
+    assert mock_open.call_count == 2
+
+
+@patch.dict("iriscasttools.ipmi._READERS", clear=True)
+@patch("iriscasttools.ipmi.os")
+def test_disable_power_reader(mock_os):
+    """
+    Test disabled device is closed and no longer has a shared reader
+
+    Keyword arguments:
+        mock_os -- mock os module
+    """
+    mock_os.open.return_value = 3
+    assert get_power_reader("/dev/ipmi0") is not None
+    disable_power_reader("/dev/ipmi0")
+    mock_os.close.assert_called_once_with(3)
+    assert get_power_reader("/dev/ipmi0") is None
+    mock_os.open.assert_called_once()
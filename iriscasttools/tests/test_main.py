@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for command line entry point of iriscasttools package
+"""
+
+import sys
+import pytest
+
+# pylint: disable=protected-access
+from iriscasttools import __main__ as cli
+from iriscasttools.stats import parse_args
+
+
+@pytest.mark.parametrize(
+    "test_args, expected_stream",
+    [
+        (["-d"], "stderr"),
+        (["-d", "-c", "--include-header"], "stderr"),
+        (["-d", "--output", "out.csv"], "stdout"),
+        (["-d", "--serve", "9100"], "stdout"),
+        (["-c", "-i"], "stderr"),
+        (["-c", "--output", "out.csv"], "stderr"),
+        (["--fleet", "-"], "stderr"),
+        (["--fleet", "-", "--output", "out.csv"], "stdout"),
+    ],
+)
+def test_log_stream(test_args, expected_stream):
+    """
+    Test logs go to stderr when rows are written to stdout
+
+    Keyword arguments:
+        test_args -- command line args
+        expected_stream -- str, name of stream expected to be logged to
+    """
+    assert cli._log_stream(parse_args(test_args)) is getattr(sys, expected_stream)
@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for RAPL, hwmon and IPMI power sources for iriscasttools package
+"""
+
+from unittest.mock import MagicMock, patch
+import pytest
+
+from iriscasttools.powersources import (
+    HwmonSource,
+    IpmiSource,
+    PowerSource,
+    RaplSource,
+    select_source,
+)
+
+
+class FakeClock:
+    """
+    A fake monotonic clock which only advances when told to
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """move clock forward"""
+        self.now += seconds
+
+
+def write_zone(root, name, energy_uj, max_energy_range_uj=1000000):
+    """
+    Write a fake powercap RAPL zone
+    """
+    zone = root / name
+    zone.mkdir(exist_ok=True)
+    (zone / "energy_uj").write_text(f"{energy_uj}\n", encoding="utf-8")
+    (zone / "max_energy_range_uj").write_text(
+        f"{max_energy_range_uj}\n", encoding="utf-8"
+    )
+
+
+@pytest.fixture(name="clock")
+def clock_fixture():
+    """
+    Fixture for a fake clock
+    """
+    return FakeClock()
+
+
+@patch("iriscasttools.powersources.time.sleep")
+def test_rapl_source(mock_sleep, tmp_path, clock):
+    """
+    Test RAPL counters are summed over top level zones and turned into Watts
+
+    Keyword arguments:
+        mock_sleep -- Mock obj for time.sleep
+    """
+    write_zone(tmp_path, "intel-rapl:0", 0)
+    write_zone(tmp_path, "intel-rapl:1", 0)
+    # subzone is counted in its parent
+    write_zone(tmp_path, "intel-rapl:0:0", 0)
+
+    def prime(seconds):
+        clock.advance(seconds)
+        write_zone(tmp_path, "intel-rapl:0", 5000)
+        write_zone(tmp_path, "intel-rapl:1", 5000)
+        write_zone(tmp_path, "intel-rapl:0:0", 99999)
+
+    mock_sleep.side_effect = prime
+    source = RaplSource(str(tmp_path), prime_s=0.1, clock=clock)
+    assert source.available()
+    # first reading waits prime_s between two counter reads
+    assert source.read() == pytest.approx(0.1)
+    mock_sleep.assert_called_once_with(0.1)
+
+    clock.advance(2)
+    write_zone(tmp_path, "intel-rapl:0", 205000)
+    # counter wrapped around
+    write_zone(tmp_path, "intel-rapl:1", 4999)
+    assert source.read() == pytest.approx((200000 + 1000000) / 2 / 1e6)
+    source.close()
+
+
+def test_rapl_source_unavailable(tmp_path):
+    """
+    Test RAPL unavailable without zones, or if counters can't be read
+    """
+    source = RaplSource(str(tmp_path))
+    assert not source.available()
+    with pytest.raises(RuntimeError):
+        source.read()
+
+    (tmp_path / "intel-rapl:0").mkdir()
+    assert not RaplSource(str(tmp_path)).available()
+
+
+def test_hwmon_source(tmp_path):
+    """
+    Test power meters are summed, including ones under device/
+    """
+    (tmp_path / "hwmon0").mkdir()
+    (tmp_path / "hwmon0" / "power1_average").write_text("150000000\n", encoding="utf-8")
+    (tmp_path / "hwmon1" / "device").mkdir(parents=True)
+    (tmp_path / "hwmon1" / "device" / "power1_average").write_text(
+        "50500000\n", encoding="utf-8"
+    )
+    (tmp_path / "hwmon2").mkdir()
+    (tmp_path / "hwmon2" / "temp1_input").write_text("40000\n", encoding="utf-8")
+
+    source = HwmonSource(str(tmp_path))
+    assert source.available()
+    assert source.read() == 200.5
+
+    (tmp_path / "hwmon0" / "power1_average").write_text("100000000\n", encoding="utf-8")
+    assert source.read() == 150.5
+    source.close()
+
+
+def test_hwmon_source_unavailable(tmp_path):
+    """
+    Test hwmon unavailable without power meters
+    """
+    source = HwmonSource(str(tmp_path))
+    assert not source.available()
+    with pytest.raises(RuntimeError):
+        source.read()
+
+
+@patch("iriscasttools.powersources.utils")
+def test_ipmi_source(mock_utils):
+    """
+    Test IPMI source reads current_power
+
+    Keyword arguments:
+        mock_utils -- Mock obj for utils module
+    """
+    mock_utils.check_ipmi_conn.return_value = True
+    mock_utils.get_ipmi_power_stats.return_value = {"current_power": "250"}
+    source = IpmiSource()
+    assert source.available()
+    assert source.read() == 250.0
+    mock_utils.get_ipmi_power_stats.assert_called_once_with("current_power")
+
+
+def fake_source(name, cost_ms, available):
+    """
+    Get a power source mock with given cost and availability
+    """
+    source = MagicMock(spec=PowerSource)
+    source.name = name
+    source.cost_ms = cost_ms
+    source.available.return_value = available
+    return source
+
+
+@pytest.mark.parametrize(
+    "test_available, expected_source",
+    [
+        ({"ipmi": True, "rapl": True, "hwmon": True}, "hwmon"),
+        ({"ipmi": True, "rapl": True, "hwmon": False}, "rapl"),
+        ({"ipmi": True, "rapl": False, "hwmon": False}, "ipmi"),
+        ({"ipmi": False, "rapl": False, "hwmon": False}, None),
+    ],
+)
+def test_select_source(test_available, expected_source):
+    """
+    Test cheapest available source is picked
+    """
+    costs = {"ipmi": 50, "rapl": 0.05, "hwmon": 0.02}
+    sources = [fake_source(n, costs[n], a) for n, a in test_available.items()]
+    res = select_source(sources)
+    assert (res.name if res else None) == expected_source
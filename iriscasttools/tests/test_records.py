@@ -0,0 +1,207 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for binary record format for iriscasttools package
+"""
+
+import datetime
+import math
+from unittest.mock import patch
+import pytest
+
+from iriscasttools.records import (
+    RecordHeader,
+    header_for,
+    iter_records,
+    load_records,
+    to_epoch,
+)
+
+
+@pytest.fixture(name="np")
+def numpy_fixture():
+    """
+    Fixture for numpy, skipping test if it isn't installed
+    """
+    return pytest.importorskip("numpy")
+
+
+def write_records(path, header, rows):
+    """
+    Write a record file with given rows of (timestamp, stats)
+    """
+    with open(path, "wb") as record_file:
+        record_file.write(header.encode())
+        for timestamp, stats in rows:
+            record_file.write(header.encode_row(stats, timestamp))
+
+
+@pytest.fixture(name="record_file")
+def record_file_fixture(tmp_path):
+    """
+    Fixture for a record file holding 10 samples, 1 second apart
+    """
+    path = tmp_path / "stats.bin"
+    header = RecordHeader(["current_power", "used_ram_kb"])
+    write_records(
+        path,
+        header,
+        [(1000 + i, {"current_power": 100 + i, "used_ram_kb": i}) for i in range(10)],
+    )
+    return path
+
+
+@pytest.mark.parametrize(
+    "test_timestamp, expected_epoch",
+    [
+        (None, math.nan),
+        (10, 10.0),
+        ("1970-01-01T00:00:10+00:00", 10.0),
+        ("1970-01-01T00:00:10", 10.0),
+        (datetime.datetime(1970, 1, 1, 0, 0, 10, tzinfo=datetime.timezone.utc), 10.0),
+    ],
+)
+def test_to_epoch(test_timestamp, expected_epoch):
+    """
+    Test timestamps are converted to epoch seconds, naive times taken as UTC
+    """
+    res = to_epoch(test_timestamp)
+    assert res == expected_epoch or (math.isnan(res) and math.isnan(expected_epoch))
+
+
+def test_header_round_trip():
+    """
+    Test header is padded to 8 bytes and decodes to the same fields and types
+    """
+    header = RecordHeader(["current_power", "max_ram_kb", "os_load_5"])
+    assert header.types == ("f", "d", "f")
+    assert header.row_size == 8 + 4 + 8 + 4
+    data = header.encode()
+    assert len(data) % 8 == 0
+    assert RecordHeader.decode(data + b"rows") == (header, len(data))
+
+
+@pytest.mark.parametrize(
+    "test_data",
+    [b"", b"NOTIRIS\0" + bytes(8), RecordHeader(["a"]).encode()[:-4]],
+)
+def test_header_decode_invalid(test_data):
+    """
+    Test error raised for a file which isn't a record file or is truncated
+    """
+    with pytest.raises(ValueError):
+        RecordHeader.decode(test_data)
+
+
+@pytest.mark.parametrize("test_types", [["f"], ["i", "f"]])
+def test_header_invalid_types(test_types):
+    """
+    Test types must be given for every field and be floats
+    """
+    with pytest.raises(ValueError):
+        RecordHeader(["a", "b"], test_types)
+
+
+def test_header_for():
+    """
+    Test timestamp and text fields are left out of header, empty fields kept
+    """
+    header = header_for(
+        {
+            "timestamp": "2024-01-01T00:00:00+00:00",
+            "current_power": "",
+            "power_measurement": "Active",
+            "os_load_5": 1.5,
+        }
+    )
+    assert header.fields == ("current_power", "os_load_5")
+
+
+@patch("iriscasttools.records.time.time")
+def test_encode_row(mock_time):
+    """
+    Test rows are encoded with missing values as NaN and timestamp from stats or now
+
+    Keyword arguments:
+        mock_time -- Mock obj for time.time
+    """
+    mock_time.return_value = 5.0
+    header = RecordHeader(["a", "b"], ["f", "d"])
+    assert header.row.unpack(header.encode_row({"a": "1.5"}))[:2] == (5.0, 1.5)
+    assert math.isnan(header.row.unpack(header.encode_row({"a": ""}))[2])
+    assert header.row.unpack(header.encode_row({"timestamp": 7, "b": 2}))[::2] == (
+        7.0,
+        2.0,
+    )
+
+
+def test_iter_records(record_file):
+    """
+    Test rows are read as dicts without numpy
+    """
+    rows = list(iter_records(str(record_file)))
+    assert len(rows) == 10
+    assert rows[2] == {"timestamp": 1002.0, "current_power": 102.0, "used_ram_kb": 2.0}
+
+
+def test_load_records(np, record_file):
+    """
+    Test file is memory-mapped as a structured array
+    """
+    records = load_records(str(record_file))
+    assert len(records) == 10
+    assert records.dtype.names == ("timestamp", "current_power", "used_ram_kb")
+    assert records["current_power"].dtype == np.float32
+    np.testing.assert_array_equal(records["used_ram_kb"], np.arange(10))
+
+
+@pytest.mark.parametrize(
+    "test_start, test_end, expected_timestamps",
+    [
+        (1002, 1005, [1002, 1003, 1004]),
+        (None, 1002, [1000, 1001]),
+        (1008.5, None, [1009]),
+        ("1970-01-01T00:16:45+00:00", None, [1005, 1006, 1007, 1008, 1009]),
+        (2000, None, []),
+    ],
+)
+def test_load_records_time_range(
+    np, record_file, test_start, test_end, expected_timestamps
+):
+    """
+    Test records are sliced by time, start inclusive and end exclusive
+    """
+    records = load_records(str(record_file), test_start, test_end)
+    np.testing.assert_array_equal(records["timestamp"], expected_timestamps)
+
+
+@pytest.mark.usefixtures("np")
+def test_load_records_partial_row(record_file):
+    """
+    Test a partly written last row is ignored
+    """
+    with open(record_file, "ab") as out:
+        out.write(b"\0" * 5)
+    assert len(load_records(str(record_file))) == 10
+    assert len(list(iter_records(str(record_file)))) == 10
+
+
+@pytest.mark.usefixtures("np")
+def test_load_records_empty(tmp_path):
+    """
+    Test a file with only a header loads as an empty array
+    """
+    path = tmp_path / "stats.bin"
+    path.write_bytes(RecordHeader(["a"]).encode())
+    records = load_records(str(path))
+    assert len(records) == 0
+    assert records.dtype.names == ("timestamp", "a")
+
+
+@patch.dict("sys.modules", {"numpy": None})
+def test_load_records_no_numpy(record_file):
+    """
+    Test clear error raised if numpy is not installed
+    """
+    with pytest.raises(ImportError):
+        load_records(str(record_file))
@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for sample ring buffer for iriscasttools package
+"""
+
+import math
+import pytest
+
+from iriscasttools.ringbuffer import SampleRingBuffer, capacity_for, to_float
+
+
+@pytest.mark.parametrize(
+    "test_val, expected_val",
+    [("100", 100.0), (0.5, 0.5), (3, 3.0), ("", math.nan), (None, math.nan)],
+)
+def test_to_float(test_val, expected_val):
+    """
+    Test sample values are converted to float, with NaN for missing values
+    """
+    res = to_float(test_val)
+    assert res == expected_val or (math.isnan(res) and math.isnan(expected_val))
+
+
+def test_ring_buffer_invalid_capacity():
+    """
+    Test ring buffer rejects non-positive capacity
+    """
+    with pytest.raises(ValueError):
+        SampleRingBuffer(["a"], 0)
+
+
+def test_ring_buffer_aggregate():
+    """
+    Test min/max/avg only use samples in window and ignore missing values
+    """
+    buffer = SampleRingBuffer(["power", "load"], 10)
+    buffer.append({"power": "100", "load": 1.0}, timestamp=0)
+    buffer.append({"power": "200", "load": 2.0}, timestamp=50)
+    buffer.append({"power": "", "load": 3.0}, timestamp=100)
+    buffer.append({"power": "400"}, timestamp=110)
+
+    assert len(buffer) == 4
+    assert buffer.aggregate(60, now=110) == {
+        "power": {"min": 200.0, "max": 400.0, "avg": 300.0},
+        "load": {"min": 2.0, "max": 3.0, "avg": 2.5},
+    }
+    assert buffer.aggregate(1, now=200) == {
+        "power": {"min": "", "max": "", "avg": ""},
+        "load": {"min": "", "max": "", "avg": ""},
+    }
+
+
+def test_ring_buffer_overwrites_oldest():
+    """
+    Test oldest samples are dropped once buffer is full
+    """
+    buffer = SampleRingBuffer(["power"], 3)
+    for i in range(5):
+        buffer.append({"power": i}, timestamp=i)
+    assert len(buffer) == 3
+    assert buffer.aggregate(100, now=5) == {
+        "power": {"min": 2.0, "max": 4.0, "avg": 3.0}
+    }
+
+
+def test_ring_buffer_aggregates():
+    """
+    Test aggregates over several windows are flattened into a single row
+    """
+    buffer = SampleRingBuffer(["power"], 10)
+    buffer.append({"power": 100}, timestamp=0)
+    buffer.append({"power": 300}, timestamp=250)
+    assert buffer.aggregates({"1m": 60, "5m": 300}, now=250) == {
+        "power_min_1m": 300.0,
+        "power_min_5m": 100.0,
+        "power_max_1m": 300.0,
+        "power_max_5m": 300.0,
+        "power_avg_1m": 300.0,
+        "power_avg_5m": 200.0,
+    }
+
+
+@pytest.mark.parametrize(
+    "test_interval, expected_capacity", [(60, 16), (1, 901), (7, 130)]
+)
+def test_capacity_for(test_interval, expected_capacity):
+    """
+    Test capacity covers longest default window of 15 minutes
+    """
+    assert capacity_for(test_interval) == expected_capacity
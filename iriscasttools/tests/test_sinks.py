@@ -0,0 +1,295 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for output sinks for iriscasttools package
+"""
+
+import gzip
+import io
+import math
+import os
+from unittest.mock import patch
+import pytest
+
+from iriscasttools.records import iter_records
+from iriscasttools.sinks import (
+    BinarySink,
+    FileSink,
+    StreamSink,
+    compress_segment,
+    format_row,
+)
+
+
+# pylint: disable=too-few-public-methods
+class FakeClock:
+    """
+    A fake monotonic clock which only advances when told to
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.parametrize(
+    "test_as_csv, test_include_header, expected_row",
+    [
+        (True, False, "1,2\n"),
+        (True, True, "a,b\n1,2\n"),
+        (False, False, "{'a': 1, 'b': 2}\n"),
+    ],
+)
+def test_format_row(test_as_csv, test_include_header, expected_row):
+    """
+    Test rows are formatted as csv or dict with trailing newline
+    """
+    assert (
+        format_row({"a": 1, "b": 2}, test_as_csv, test_include_header) == expected_row
+    )
+
+
+def test_stream_sink():
+    """
+    Test stream sink writes header once, then each row immediately
+    """
+    out = io.StringIO()
+    sink = StreamSink(out, include_header=True)
+    sink.write({"a": 1})
+    sink.write({"a": 2})
+    sink.close()
+    assert out.getvalue() == "a\n1\n2\n"
+
+
+@pytest.mark.parametrize(
+    "test_kwargs",
+    [{"fsync": "always"}, {"batch_rows": 0}],
+)
+def test_file_sink_invalid(tmp_path, test_kwargs):
+    """
+    Test file sink rejects invalid options
+    """
+    with pytest.raises(ValueError):
+        FileSink(str(tmp_path / "out.csv"), **test_kwargs)
+
+
+def test_file_sink_batch_rows(tmp_path):
+    """
+    Test rows are only written once batch is full, in a single write
+    """
+    out_fp = tmp_path / "out.csv"
+    sink = FileSink(str(out_fp), include_header=True, batch_rows=3, batch_seconds=60)
+    sink.write({"a": 1})
+    sink.write({"a": 2})
+    assert out_fp.read_text(encoding="utf-8") == ""
+    sink.write({"a": 3})
+    assert out_fp.read_text(encoding="utf-8") == "a\n1\n2\n3\n"
+    sink.write({"a": 4})
+    sink.close()
+    assert out_fp.read_text(encoding="utf-8") == "a\n1\n2\n3\n4\n"
+
+
+def test_file_sink_batch_seconds(tmp_path):
+    """
+    Test rows are written once batch_seconds have passed since last write
+    """
+    clock = FakeClock()
+    out_fp = tmp_path / "out.csv"
+    sink = FileSink(str(out_fp), batch_rows=100, batch_seconds=10, clock=clock)
+    sink.write({"a": 1})
+    clock.now = 9
+    sink.write({"a": 2})
+    assert out_fp.read_text(encoding="utf-8") == ""
+    clock.now = 10
+    sink.write({"a": 3})
+    assert out_fp.read_text(encoding="utf-8") == "1\n2\n3\n"
+    sink.close()
+
+
+def test_file_sink_no_repeat_header(tmp_path):
+    """
+    Test header is not written again when appending to an existing file
+    """
+    out_fp = tmp_path / "out.csv"
+    out_fp.write_text("a\n1\n", encoding="utf-8")
+    sink = FileSink(str(out_fp), include_header=True, batch_rows=1)
+    sink.write({"a": 2})
+    sink.close()
+    assert out_fp.read_text(encoding="utf-8") == "a\n1\n2\n"
+
+
+@pytest.mark.parametrize("test_compress", [False, True])
+def test_file_sink_rotate_size(tmp_path, test_compress):
+    """
+    Test file is rotated once it reaches rotate_bytes, with header at start of each segment
+    """
+    out_fp = tmp_path / "out.csv"
+    sink = FileSink(
+        str(out_fp),
+        include_header=True,
+        batch_rows=1,
+        rotate_bytes=6,
+        compress=test_compress,
+    )
+    for i in range(3):
+        sink.write({"a": i})
+    sink.close()
+
+    segments = sorted(p.name for p in tmp_path.iterdir() if p.name != "out.csv")
+    assert len(segments) == 1
+    segment = tmp_path / segments[0]
+    if test_compress:
+        assert segment.name.endswith(".csv.gz")
+        with gzip.open(segment, "rt", encoding="utf-8") as seg_file:
+            assert seg_file.read() == "a\n0\n1\n"
+    else:
+        assert segment.name.endswith(".csv")
+        assert segment.read_text(encoding="utf-8") == "a\n0\n1\n"
+    assert segment.name.startswith("out-")
+    assert out_fp.read_text(encoding="utf-8") == "a\n2\n"
+
+
+def test_file_sink_rotate_same_second(tmp_path):
+    """
+    Test segments rotated within the same second do not overwrite each other
+    """
+    out_fp = tmp_path / "out.csv"
+    sink = FileSink(str(out_fp), batch_rows=1, rotate_bytes=1)
+    for i in range(3):
+        sink.write({"a": i})
+    sink.close()
+    contents = sorted(
+        p.read_text(encoding="utf-8") for p in tmp_path.iterdir() if p.name != "out.csv"
+    )
+    assert contents == ["0\n", "1\n", "2\n"]
+
+
+@patch("iriscasttools.sinks.datetime")
+def test_file_sink_rotate_daily(mock_datetime, tmp_path):
+    """
+    Test file is rotated when the UTC date changes
+
+    Keyword arguments:
+        mock_datetime -- Mock obj for datetime module
+    """
+    mock_now = mock_datetime.datetime.now.return_value
+    mock_now.date.return_value = "day1"
+    mock_now.strftime.return_value = "20240101T000000"
+    out_fp = tmp_path / "out.csv"
+    sink = FileSink(str(out_fp), batch_rows=10, rotate_daily=True)
+    sink.write({"a": 1})
+    mock_now.date.return_value = "day2"
+    sink.write({"a": 2})
+    sink.close()
+    assert (tmp_path / "out-20240101T000000.csv").read_text(encoding="utf-8") == "1\n"
+    assert out_fp.read_text(encoding="utf-8") == "2\n"
+
+
+@pytest.mark.parametrize(
+    "test_fsync, expected_fsyncs",
+    [("never", 0), ("batch", 3), ("rotate", 1)],
+)
+@patch("iriscasttools.sinks.os.fsync")
+def test_file_sink_fsync(mock_fsync, tmp_path, test_fsync, expected_fsyncs):
+    """
+    Test fsync is called according to policy
+
+    Keyword arguments:
+        mock_fsync -- Mock obj for os.fsync
+    """
+    sink = FileSink(str(tmp_path / "out.csv"), batch_rows=1, fsync=test_fsync)
+    sink.write({"a": 1})
+    sink.write({"a": 2})
+    sink.close()
+    assert mock_fsync.call_count == expected_fsyncs
+
+
+def test_compress_segment(tmp_path):
+    """
+    Test segment is replaced by gzipped copy
+    """
+    segment = tmp_path / "out-1.csv"
+    segment.write_text("a\n1\n", encoding="utf-8")
+    compress_segment(segment)
+    assert not segment.exists()
+    with gzip.open(f"{segment}.gz", "rt", encoding="utf-8") as seg_file:
+        assert seg_file.read() == "a\n1\n"
+    assert os.listdir(tmp_path) == ["out-1.csv.gz"]
+
+
+def test_binary_sink(tmp_path):
+    """
+    Test samples are appended as binary records, with header written once
+    """
+    out_fp = tmp_path / "out.bin"
+    sink = BinarySink(str(out_fp), batch_rows=2)
+    for i in range(3):
+        sink.write(
+            {
+                "timestamp": f"1970-01-01T00:00:0{i}+00:00",
+                "current_power": str(100 + i),
+                "power_measurement": "Active",
+            }
+        )
+    sink.close()
+
+    # reopening appends to existing file without a second header
+    sink = BinarySink(str(out_fp), batch_rows=1)
+    sink.write({"timestamp": "1970-01-01T00:00:03+00:00", "current_power": ""})
+    sink.close()
+
+    rows = list(iter_records(str(out_fp)))
+    assert [r["timestamp"] for r in rows] == [0.0, 1.0, 2.0, 3.0]
+    assert [r["current_power"] for r in rows[:3]] == [100.0, 101.0, 102.0]
+    assert math.isnan(rows[3]["current_power"])
+    assert list(rows[0]) == ["timestamp", "current_power"]
+
+
+def test_binary_sink_partial_row(tmp_path):
+    """
+    Test a partly written row left by a crash is dropped before appending
+    """
+    out_fp = tmp_path / "out.bin"
+    sink = BinarySink(str(out_fp), batch_rows=1)
+    sink.write({"timestamp": 1.0, "a": 1})
+    sink.close()
+    with open(out_fp, "ab") as out:
+        out.write(b"\1\2\3")
+
+    sink = BinarySink(str(out_fp), batch_rows=1)
+    sink.write({"timestamp": 2.0, "a": 2})
+    sink.close()
+    assert list(iter_records(str(out_fp))) == [
+        {"timestamp": 1.0, "a": 1.0},
+        {"timestamp": 2.0, "a": 2.0},
+    ]
+
+
+def test_binary_sink_fields_changed(tmp_path):
+    """
+    Test existing file is rotated if its fields differ from new samples
+    """
+    out_fp = tmp_path / "out.bin"
+    sink = BinarySink(str(out_fp), batch_rows=1)
+    sink.write({"timestamp": 1.0, "a": 1})
+    sink.close()
+
+    sink = BinarySink(str(out_fp), batch_rows=1)
+    sink.write({"timestamp": 2.0, "b": 2})
+    sink.close()
+
+    assert list(iter_records(str(out_fp))) == [{"timestamp": 2.0, "b": 2.0}]
+    (segment,) = [p for p in tmp_path.iterdir() if p.name != "out.bin"]
+    assert list(iter_records(str(segment))) == [{"timestamp": 1.0, "a": 1.0}]
+
+
+def test_binary_sink_not_record_file(tmp_path):
+    """
+    Test error raised rather than appending records to a text file
+    """
+    out_fp = tmp_path / "out.csv"
+    out_fp.write_text("a\n1\n", encoding="utf-8")
+    with pytest.raises(ValueError):
+        BinarySink(str(out_fp))
@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests for import time of iriscasttools package, which is run very often from cron
+"""
+
+import importlib
+import os
+import subprocess
+import sys
+import pytest
+
+import iriscasttools
+
+# milliseconds importing the command line entrypoint may take, measured by -X importtime.
+# It takes about 9ms, so this allows for slower machines without hiding a regression
+IMPORT_BUDGET_MS = 20
+
+# modules only needed by daemon, exporter and fleet modes, optional collectors and sinks,
+# or once collectors are run, which importing the command line should never import
+LAZY_MODULES = (
+    "asyncio",
+    "concurrent.futures",
+    "ctypes",
+    "gzip",
+    "http.server",
+    "inspect",
+    "numpy",
+    "iriscasttools.cgroups",
+    "iriscasttools.daemon",
+    "iriscasttools.exporter",
+    "iriscasttools.fleet",
+    "iriscasttools.ipmi",
+    "iriscasttools.powersources",
+    "iriscasttools.records",
+    "iriscasttools.sinks",
+    "logging.handlers",
+)
+
+
+def run_python(code, tmp_path, *flags):
+    """
+    Run code in a fresh interpreter, returning the completed process
+
+    Bytecode is cached under tmp_path so timings don't include compiling
+    """
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    env["PYTHONPYCACHEPREFIX"] = str(tmp_path)
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(iriscasttools.__file__)),
+    )
+
+
+def imported_modules(code, tmp_path):
+    """
+    Get names of all modules imported by running code in a fresh interpreter
+    """
+    res = run_python(f"{code}\nimport sys\nprint(' '.join(sys.modules))", tmp_path)
+    return set(res.stdout.split())
+
+
+def test_import_package_is_lazy(tmp_path):
+    """
+    Test importing package root doesn't import any submodules
+    """
+    modules = imported_modules("import iriscasttools", tmp_path)
+    assert {m for m in modules if m.startswith("iriscasttools")} == {"iriscasttools"}
+
+
+def test_import_cli_skips_unused_modules(tmp_path):
+    """
+    Test command line entrypoint doesn't import modules a single sample doesn't need
+    """
+    modules = imported_modules("import iriscasttools.__main__", tmp_path)
+    assert not modules & set(LAZY_MODULES)
+
+
+def test_lazy_submodules():
+    """
+    Test submodules are imported on first attribute access
+    """
+    assert iriscasttools.utils is importlib.import_module("iriscasttools.utils")
+    assert "records" in dir(iriscasttools)
+    with pytest.raises(AttributeError):
+        _ = iriscasttools.invalid
+
+
+def test_import_time_budget(tmp_path):
+    """
+    Test command line entrypoint imports within budget. Takes the fastest of a few runs,
+    after a first run to cache bytecode, to allow for noise
+    """
+    timings = []
+    for _ in range(4):
+        res = run_python("import iriscasttools.__main__", tmp_path, "-X", "importtime")
+        # lines look like "import time: self [us] | cumulative | imported package"
+        for line in res.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "iriscasttools.__main__":
+                timings.append(int(fields[1]) / 1000)
+    assert len(timings) == 4
+    assert min(timings[1:]) < IMPORT_BUDGET_MS
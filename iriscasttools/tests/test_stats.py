@@ -4,10 +4,47 @@
 Tests for main functions for iriscasttools package
 """
 
-from unittest.mock import patch
+from unittest.mock import NonCallableMock, patch
 import pytest
 
-from iriscasttools.stats import get_iriscast_stats, parse_args
+from iriscasttools.collectors import CollectorRegistry
+from iriscasttools.sinks import BinarySink
+from iriscasttools import powersources
+from iriscasttools.stats import (
+    POWER_SOURCES,
+    build_registry,
+    build_sink,
+    format_self_stats,
+    get_iriscast_stats,
+    parse_args,
+)
+
+_DEFAULT_ARGS = {
+    "as_csv": False,
+    "include_header": False,
+    "daemon": False,
+    "interval": 60.0,
+    "output": None,
+    "self_stats": False,
+    "disable": [],
+    "max_cost": None,
+    "timeout": 10.0,
+    "aggregate_every": None,
+    "serve": None,
+    "bind": "",
+    "batch_rows": 60,
+    "batch_seconds": 60.0,
+    "rotate_size": None,
+    "rotate_daily": False,
+    "compress": False,
+    "fsync": "rotate",
+    "vm_power": False,
+    "power_source": None,
+    "binary": False,
+    "fleet": None,
+    "parallel": 64,
+    "host_timeout": 30.0,
+}
 
 
 @pytest.mark.parametrize(
@@ -19,12 +56,178 @@ from iriscasttools.stats import get_iriscast_stats, parse_args
         (["--include-header"], {"as_csv": False, "include_header": False}),
         (["-i"], {"as_csv": False, "include_header": False}),
         (["--as-csv", "--include-header"], {"as_csv": True, "include_header": True}),
+        (["--daemon"], {"daemon": True}),
+        (["-d", "-n", "5"], {"daemon": True, "interval": 5.0}),
+        (
+            ["-d", "--interval", "0.5", "--output", "out.csv"],
+            {"daemon": True, "interval": 0.5, "output": "out.csv"},
+        ),
+        (["--self-stats"], {"self_stats": True}),
+        (["--disable", "power", "--disable", "ram"], {"disable": ["power", "ram"]}),
+        (["--max-cost", "1"], {"max_cost": 1.0}),
+        (["-t", "2.5"], {"timeout": 2.5}),
+        (["-d", "--aggregate-every", "60"], {"daemon": True, "aggregate_every": 60.0}),
+        (
+            ["--fleet", "hosts.txt", "--parallel", "8", "--host-timeout", "5"],
+            {"fleet": "hosts.txt", "parallel": 8, "host_timeout": 5.0},
+        ),
+        (
+            ["--serve", "9100", "--bind", "127.0.0.1"],
+            {"serve": 9100, "bind": "127.0.0.1"},
+        ),
+        (
+            ["--batch-rows", "10", "--batch-seconds", "5", "--fsync", "batch"],
+            {"batch_rows": 10, "batch_seconds": 5.0, "fsync": "batch"},
+        ),
+        (
+            ["--rotate-size", "1000", "--rotate-daily", "--compress"],
+            {"rotate_size": 1000, "rotate_daily": True, "compress": True},
+        ),
     ],
 )
 def test_parse_args(test_args, expected_arg_values):
-    """ test that args get parsed properly """
+    """test that args get parsed properly"""
     res = parse_args(test_args)
-    assert vars(res) == expected_arg_values
+    assert vars(res) == {**_DEFAULT_ARGS, **expected_arg_values}
+
+
+@pytest.mark.parametrize("test_interval", ["0", "-1"])
+def test_parse_args_invalid_interval(test_interval):
+    """test that a non-positive interval is rejected"""
+    with pytest.raises(SystemExit):
+        parse_args(["--daemon", "--interval", test_interval])
+
+
+@pytest.mark.parametrize("test_aggregate_every", ["0", "-1"])
+def test_parse_args_invalid_aggregate_every(test_aggregate_every):
+    """test that a non-positive aggregate interval is rejected"""
+    with pytest.raises(SystemExit):
+        parse_args(["--daemon", "--aggregate-every", test_aggregate_every])
+
+
+@pytest.mark.parametrize("test_timeout", ["0", "-1"])
+def test_parse_args_invalid_timeout(test_timeout):
+    """test that a non-positive timeout is rejected"""
+    with pytest.raises(SystemExit):
+        parse_args(["--timeout", test_timeout])
+
+
+def test_parse_args_invalid_collector():
+    """test that an unknown collector can't be disabled"""
+    with pytest.raises(SystemExit):
+        parse_args(["--disable", "invalid"])
+
+
+@pytest.mark.parametrize(
+    "test_args, expected_collectors",
+    [
+        ([], ["power", "os_load", "ram"]),
+        (["--disable", "power"], ["os_load", "ram"]),
+        (["--max-cost", "1"], ["os_load", "ram"]),
+        (["--max-cost", "0.05", "--disable", "os_load"], []),
+        (["--vm-power"], ["power", "os_load", "ram", "vm_power"]),
+        (["--power-source", "auto"], ["power", "os_load", "ram", "source_power"]),
+    ],
+)
+def test_build_registry(test_args, expected_collectors):
+    """test that collectors are disabled from command line args"""
+    registry = build_registry(parse_args(test_args))
+    assert [c.name for c in registry.collectors] == expected_collectors
+
+
+def test_build_registry_power_source():
+    """test that a single power source can be chosen"""
+    registry = build_registry(parse_args(["--power-source", "rapl"]))
+    assert [s.name for s in registry.collectors[-1].sources] == ["rapl"]
+
+
+def test_power_sources_match():
+    """test that power source choices match the sources powersources provides"""
+    assert set(POWER_SOURCES) == set(powersources.SOURCES)
+
+
+@pytest.mark.parametrize(
+    "test_args, expected_timeout",
+    [
+        ([], 10.0),
+        (["--timeout", "2"], 2.0),
+        (["--daemon", "--interval", "5"], 5.0),
+        (["--daemon", "--interval", "5", "--timeout", "1"], 1.0),
+        (["--serve", "9100", "--interval", "5"], 5.0),
+    ],
+)
+def test_build_registry_timeout(test_args, expected_timeout):
+    """test that collector timeout is capped at sampling interval in daemon mode"""
+    assert build_registry(parse_args(test_args)).timeout_s == expected_timeout
+
+
+@pytest.mark.parametrize(
+    "test_args",
+    [
+        ["--batch-rows", "0"],
+        ["--fsync", "always"],
+        ["--parallel", "0"],
+        ["--host-timeout", "0"],
+        ["--binary"],
+    ],
+)
+def test_parse_args_invalid_sink(test_args):
+    """test that invalid output file options are rejected"""
+    with pytest.raises(SystemExit):
+        parse_args(test_args)
+
+
+def test_parse_args_fleet_vm_power():
+    """test that --vm-power is rejected in fleet mode, as each host only takes one sample"""
+    with pytest.raises(SystemExit):
+        parse_args(["--fleet", "-", "--vm-power"])
+
+
+def test_build_sink(tmp_path):
+    """test that file sink is built from command line args"""
+    assert build_sink(parse_args([])) is None
+
+    out_fp = str(tmp_path / "out.csv")
+    sink = build_sink(
+        parse_args(["-c", "-i", "-o", out_fp, "--batch-rows", "5", "--compress"])
+    )
+    assert str(sink.path) == out_fp
+    assert sink.include_header
+    assert sink.batch_rows == 5
+    assert sink.compress
+    sink.close()
+
+    sink = build_sink(parse_args(["-d", "-o", out_fp, "--binary"]))
+    assert isinstance(sink, BinarySink)
+    sink.close()
+
+
+def test_format_self_stats():
+    """test that self stats are formatted as csv with one header"""
+    mock_registry = NonCallableMock(spec=CollectorRegistry)
+    mock_registry.self_stats.return_value = [
+        {"collector": "one", "calls": 1},
+        {"collector": "two", "calls": 2},
+    ]
+    assert format_self_stats(mock_registry) == "collector,calls\none,1\ntwo,2"
+
+
+@patch("iriscasttools.utils.get_ipmi_power_stats")
+@patch("iriscasttools.utils.get_os_load")
+@patch("iriscasttools.utils.get_ram_usage")
+def test_get_iriscast_stats_power_failure(
+    mock_get_ram_usage, mock_get_os_load, mock_get_ipmi_power_stats
+):
+    """
+    Test get iriscast stats still returns other stats if power collection fails
+    """
+    mock_get_ipmi_power_stats.side_effect = RuntimeError("no ipmi device")
+    mock_get_os_load.return_value = {"os_load_5": 0.5}
+    mock_get_ram_usage.return_value = {"ram_usage_percentage": 10.0}
+    assert get_iriscast_stats(True, True) == (
+        "current_power,os_load_5,ram_usage_percentage\n,0.5,10.0"
+    )
+
 
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-positional-arguments
@@ -4,9 +4,13 @@
 Tests for utility functions for iriscasttools package
 """
 
+import asyncio
+import contextlib
 import csv
+import inspect
 import os
 import pathlib
+import time
 from unittest.mock import NonCallableMock, patch
 import pytest
 from iriscasttools.utils import (
@@ -15,10 +19,16 @@ from iriscasttools.utils import (
     ipmi_raw_power_query,
     check_ipmi_conn,
     retry,
+    remaining_budget,
+    retry_budget,
     get_ipmi_power_stats,
     get_ram_usage,
     get_os_load,
+    read_meminfo,
+    ipmi_dcmi_power_query,
 )
+from iriscasttools import ipmi, utils
+from iriscasttools.ipmi import IpmiError
 
 _TEST_DIR = os.path.dirname(os.path.abspath(__file__))
 _TESTDATA_DIR = os.path.join(_TEST_DIR, "test_data")
@@ -84,30 +94,48 @@ def test_run_cmd_success(mock_subprocess):
         mock_subprocess -- Mock object for subprocess package
     """
     cmd_args = NonCallableMock()
-    popen_mock_obj = mock_subprocess.Popen.return_value.__enter__
-
-    stdout_mock = popen_mock_obj.return_value.stdout.read
-    stderr_mock = popen_mock_obj.return_value.stderr.read
-
-    stdout_mock.return_value = b"mock success"
-    stderr_mock.return_value = b""
+    mock_subprocess.run.return_value.stdout = b"mock success"
+    mock_subprocess.run.return_value.stderr = b""
 
     cmd_stdout = run_cmd(cmd_args)
-    mock_subprocess.Popen.assert_called_once_with(
-        cmd_args, shell=True, stdout=mock_subprocess.PIPE, stderr=mock_subprocess.PIPE
+    mock_subprocess.run.assert_called_once_with(
+        cmd_args, shell=True, capture_output=True, timeout=None, check=False
     )
     assert cmd_stdout == "mock success"
 
 
+def test_run_cmd_budget():
+    """
+    Test "run_cmd" function kills command once retry budget runs out, without retrying
+    """
+    start = time.monotonic()
+    with retry_budget(0.2):
+        with pytest.raises(RuntimeError):
+            run_cmd("sleep 5")
+    assert time.monotonic() - start < 2
+
+
+def test_remaining_budget():
+    """
+    Test "remaining_budget" function gets seconds left of enclosing retry budget
+    """
+    assert remaining_budget() is None
+    with patch("iriscasttools.utils.time.monotonic", side_effect=[100, 103]):
+        with retry_budget(5):
+            assert remaining_budget() == 2
+
+
 @pytest.mark.parametrize(
     "num_fail, expected_calls, expected_fail",
-    [(0, 1, False), (1, 2, False), (2, 3, False), (3, 3, True), (4, 3, True)],
+    [(0, 1, False), (1, 2, False), (3, 4, False), (4, 4, True), (5, 4, True)],
 )
-def test_retry(num_fail, expected_calls, expected_fail):
+@patch("iriscasttools.utils.time.sleep")
+def test_retry(mock_sleep, num_fail, expected_calls, expected_fail):
     """
-    Test "retry" decorator
+    Test "retry" decorator makes one attempt plus given number of retries
 
     Keyword arguments:
+        mock_sleep -- mock time.sleep
         num_fail -- int: number of times command to retry is mocked to fail
         expected_calls -- int: number of times retry function is expected to call subprocess library
     """
@@ -127,8 +155,146 @@ def test_retry(num_fail, expected_calls, expected_fail):
             runtime_error.value.args[0] == "function failed and max retries 3 exceeded"
         )
     else:
-        retry_func()
+        assert retry_func() == "success"
     assert retry_func.counter == expected_calls
+    assert mock_sleep.call_count == min(num_fail, 3)
+
+
+@pytest.mark.parametrize(
+    "test_jitter, test_max_delay, expected_delays",
+    [
+        (False, None, [1, 2, 4]),
+        (False, 3, [1, 2, 3]),
+        # mock random.uniform returns upper bound halved
+        (True, None, [0.5, 1, 2]),
+    ],
+)
+@patch("iriscasttools.utils.random.uniform")
+@patch("iriscasttools.utils.time.sleep")
+def test_retry_backoff(
+    mock_sleep, mock_uniform, test_jitter, test_max_delay, expected_delays
+):
+    """
+    Test "retry" decorator delay grows exponentially, capped at max_delay, with full jitter
+
+    Keyword arguments:
+        mock_sleep -- mock time.sleep
+        mock_uniform -- mock random.uniform
+    """
+    mock_uniform.side_effect = lambda low, high: (low + high) / 2
+
+    @retry(
+        retry_on=(AssertionError,),
+        retries=3,
+        delay=1,
+        backoff=2,
+        max_delay=test_max_delay,
+        jitter=test_jitter,
+    )
+    def retry_func():
+        raise AssertionError
+
+    with pytest.raises(RuntimeError):
+        retry_func()
+    assert [c.args[0] for c in mock_sleep.call_args_list] == expected_delays
+
+
+@patch("iriscasttools.utils.time.sleep")
+def test_retry_per_exception_limits(mock_sleep):
+    """
+    Test "retry" decorator applies retry limit of the exception raised on each attempt, and
+    does not retry other exceptions
+
+    Keyword arguments:
+        mock_sleep -- mock time.sleep
+    """
+    errors = [ValueError, ValueError, KeyError]
+
+    @retry(retry_on={ValueError: 5, KeyError: 1}, delay=0)
+    def retry_func():
+        raise errors.pop(0)
+
+    with pytest.raises(RuntimeError) as runtime_error:
+        retry_func()
+    assert runtime_error.value.args[0] == "function failed and max retries 1 exceeded"
+    assert isinstance(runtime_error.value.__cause__, KeyError)
+    assert not errors
+    assert mock_sleep.call_count == 2
+
+    @retry(retry_on={ValueError: 5})
+    def unhandled_func():
+        raise TypeError
+
+    with pytest.raises(TypeError):
+        unhandled_func()
+
+
+@pytest.mark.parametrize("test_budget", [False, True])
+@patch("iriscasttools.utils.time.sleep")
+def test_retry_deadline(mock_sleep, test_budget):
+    """
+    Test "retry" decorator gives up rather than wait past its deadline or retry budget
+
+    Keyword arguments:
+        mock_sleep -- mock time.sleep
+        test_budget -- bool, flag to set deadline using retry_budget instead of decorator
+    """
+
+    @retry(
+        retry_on=(AssertionError,),
+        retries=10,
+        delay=1,
+        backoff=1,
+        jitter=False,
+        deadline=None if test_budget else 2.5,
+    )
+    def retry_func():
+        raise AssertionError
+
+    with patch("iriscasttools.utils.time.monotonic") as mock_monotonic:
+        # each sleep advances the clock
+        mock_monotonic.side_effect = lambda: float(mock_sleep.call_count)
+        with pytest.raises(RuntimeError) as runtime_error:
+            with retry_budget(2.5) if test_budget else contextlib.nullcontext():
+                retry_func()
+    assert "deadline exceeded after 3 attempts" in runtime_error.value.args[0]
+    assert mock_sleep.call_count == 2
+
+
+def test_retry_budget_nested():
+    """
+    Test nested retry budgets can only shorten the deadline
+    """
+    with retry_budget(10):
+        with retry_budget(60):
+            with patch("iriscasttools.utils.time.sleep"):
+
+                @retry(retry_on=(AssertionError,), delay=30, jitter=False)
+                def retry_func():
+                    raise AssertionError
+
+                with pytest.raises(RuntimeError) as runtime_error:
+                    retry_func()
+    assert "deadline exceeded after 1 attempts" in runtime_error.value.args[0]
+
+
+def test_retry_async():
+    """
+    Test "retry" decorator waits with asyncio.sleep for coroutine functions
+    """
+    calls = []
+
+    @retry(retry_on=(AssertionError,), retries=2, delay=0.001)
+    async def retry_func():
+        calls.append(1)
+        if len(calls) < 3:
+            raise AssertionError
+        return "success"
+
+    with patch("iriscasttools.utils.time.sleep") as mock_sleep:
+        assert asyncio.run(retry_func()) == "success"
+    mock_sleep.assert_not_called()
+    assert len(calls) == 3
 
 
 @pytest.mark.parametrize(
@@ -194,16 +360,21 @@ def test_ipmi_raw_power_query(mock_run_cmd):
         (["some_invalid_arg"]),
     ],
 )
+@patch("iriscasttools.utils.ipmi_dcmi_power_query")
 @patch("iriscasttools.utils.ipmi_raw_power_query")
 @patch("iriscasttools.utils.check_ipmi_conn")
-def test_get_ipmi_power_stats(mock_check_ipmi_conn, mock_raw_power_query, test_args):
+def test_get_ipmi_power_stats(
+    mock_check_ipmi_conn, mock_raw_power_query, mock_dcmi_power_query, test_args
+):
     """
-    Test "ipmi_raw_power_query" function
+    Test "get_ipmi_power_stats" function falls back to parsing ipmi-dcmi output
 
     Keyword arguments:
+        mock_check_ipmi_conn -- mock
         mock_raw_power_query -- mock
-
+        mock_dcmi_power_query -- mock
     """
+    mock_dcmi_power_query.return_value = None
     ipmi_example_fp = os.path.join(_TESTDATA_DIR, "raw_ipmi_test.txt")
     ipmi_example_exp_vals_fp = os.path.join(_TESTDATA_DIR, "raw_ipmi_test_exp_vals.csv")
 
@@ -228,6 +399,118 @@ def test_get_ipmi_power_stats(mock_check_ipmi_conn, mock_raw_power_query, test_a
     assert result == expected_results
 
 
+@patch("iriscasttools.utils.ipmi_dcmi_power_query")
+@patch("iriscasttools.utils.ipmi_raw_power_query")
+@patch("iriscasttools.utils.check_ipmi_conn")
+def test_get_ipmi_power_stats_dcmi(
+    mock_check_ipmi_conn, mock_raw_power_query, mock_dcmi_power_query
+):
+    """
+    Test "get_ipmi_power_stats" function uses in-process DCMI reading without forking
+
+    Keyword arguments:
+        mock_check_ipmi_conn -- mock
+        mock_raw_power_query -- mock
+        mock_dcmi_power_query -- mock
+    """
+    mock_check_ipmi_conn.return_value = True
+    mock_dcmi_power_query.return_value = {
+        "current_power": 100,
+        "average_power_over_sampling_duration": 150,
+        "power_measurement": "Active",
+    }
+    result = get_ipmi_power_stats("current_power", "power_measurement", "invalid")
+    mock_raw_power_query.assert_not_called()
+    assert result == {
+        "current_power": "100",
+        "power_measurement": "Active",
+        "invalid": "",
+    }
+
+
+@patch("iriscasttools.ipmi.get_power_reader")
+@patch("iriscasttools.utils.find_ipmi_device")
+def test_ipmi_dcmi_power_query(mock_find_ipmi_device, mock_get_power_reader):
+    """
+    Test "ipmi_dcmi_power_query" function returns reading from shared reader
+
+    Keyword arguments:
+        mock_find_ipmi_device -- mock
+        mock_get_power_reader -- mock
+    """
+    mock_find_ipmi_device.return_value = "/dev/ipmi0"
+    mock_reader = mock_get_power_reader.return_value
+    assert ipmi_dcmi_power_query() == mock_reader.get_power_reading.return_value
+    mock_get_power_reader.assert_called_once_with("/dev/ipmi0")
+
+
+def test_co_coroutine_flag():
+    """
+    Test flag used to spot async functions for retry matches inspect's
+    """
+    # pylint: disable=protected-access,no-member
+    assert utils._CO_COROUTINE == inspect.CO_COROUTINE
+
+
+@pytest.mark.parametrize("test_err", [OSError, IpmiError])
+@patch("iriscasttools.ipmi.get_power_reader")
+@patch("iriscasttools.utils.find_ipmi_device")
+def test_ipmi_dcmi_power_query_fail(
+    mock_find_ipmi_device, mock_get_power_reader, test_err
+):
+    """
+    Test "ipmi_dcmi_power_query" function returns None and closes device on failure
+
+    Keyword arguments:
+        mock_find_ipmi_device -- mock
+        mock_get_power_reader -- mock
+        test_err -- exception raised by reader
+    """
+    mock_find_ipmi_device.return_value = "/dev/ipmi0"
+    mock_reader = mock_get_power_reader.return_value
+    mock_reader.get_power_reading.side_effect = test_err
+    mock_reader.failures = 1
+    assert ipmi_dcmi_power_query() is None
+    mock_reader.close.assert_called_once()
+
+
+@patch("iriscasttools.ipmi.disable_power_reader")
+@patch("iriscasttools.ipmi.get_power_reader")
+@patch("iriscasttools.utils.find_ipmi_device")
+def test_ipmi_dcmi_power_query_repeated_fail(
+    mock_find_ipmi_device, mock_get_power_reader, mock_disable_power_reader
+):
+    """
+    Test "ipmi_dcmi_power_query" function stops using device after repeated failures
+
+    Keyword arguments:
+        mock_find_ipmi_device -- mock
+        mock_get_power_reader -- mock
+        mock_disable_power_reader -- mock
+    """
+    mock_find_ipmi_device.return_value = "/dev/ipmi0"
+    mock_reader = mock_get_power_reader.return_value
+    mock_reader.get_power_reading.side_effect = IpmiError
+    mock_reader.failures = ipmi.MAX_FAILURES
+    assert ipmi_dcmi_power_query() is None
+    mock_disable_power_reader.assert_called_once_with("/dev/ipmi0")
+
+
+@patch("iriscasttools.ipmi.get_power_reader")
+@patch("iriscasttools.utils.find_ipmi_device")
+def test_ipmi_dcmi_power_query_no_device(mock_find_ipmi_device, mock_get_power_reader):
+    """
+    Test "ipmi_dcmi_power_query" function returns None if device can't be used
+
+    Keyword arguments:
+        mock_find_ipmi_device -- mock
+        mock_get_power_reader -- mock
+    """
+    mock_find_ipmi_device.return_value = "/dev/ipmi0"
+    mock_get_power_reader.return_value = None
+    assert ipmi_dcmi_power_query() is None
+
+
 @pytest.mark.parametrize(
     "test_args",
     [(["max_ram_kb", "used_ram_kb", "ram_usage_percentage"]), (["some_invalid_arg"])],
@@ -257,34 +540,72 @@ def test_get_os_load(mock_os_get_load_avg, test_args):
     assert result == expected_results
 
 
+_EXPECTED_RAM_USAGE = {
+    "max_ram_kb": 1500000,
+    "used_ram_kb": 1000000,
+    "available_ram_kb": 500000,
+    "free_ram_kb": 200000,
+    "buffers_ram_kb": 50000,
+    "cached_ram_kb": 320000,
+    "swap_total_kb": 100000,
+    "swap_used_kb": 25000,
+    "ram_usage_percentage": 66.667,
+}
+
+
+def test_read_meminfo():
+    """
+    Test "read_meminfo" function parses kB values and values without units
+    """
+    res = read_meminfo(os.path.join(_TESTDATA_DIR, "meminfo_test.txt"))
+    assert res["MemTotal"] == 1500000
+    assert res["SReclaimable"] == 20000
+    assert res["HugePages_Total"] == 0
+
+
 @pytest.mark.parametrize(
     "test_args",
-    [(["max_ram_kb", "used_ram_kb", "ram_usage_percentage"]), (["some_invalid_arg"])],
+    [
+        (["max_ram_kb", "used_ram_kb", "ram_usage_percentage"]),
+        (list(_EXPECTED_RAM_USAGE.keys())),
+        (["some_invalid_arg"]),
+    ],
 )
 @patch("iriscasttools.utils.run_cmd")
 def test_get_ram_usage(mock_run_cmd, test_args):
     """
-    Test "get_ram_usage" function
+    Test "get_ram_usage" function reads /proc/meminfo without running any commands
 
     Keyword arguments:
-        mock_retry - mock object to mock retry and run command function
-
+        mock_run_cmd - mock object to mock run command function
     """
-    # set ram usage out as arbitrary values
-    expected_results = {k: "" for k in test_args}
+    expected_results = {k: _EXPECTED_RAM_USAGE.get(k, "") for k in test_args}
+
+    with patch(
+        "iriscasttools.utils.MEMINFO_PATH",
+        os.path.join(_TESTDATA_DIR, "meminfo_test.txt"),
+    ):
+        result = get_ram_usage(*test_args)
+    mock_run_cmd.assert_not_called()
+    assert result == expected_results
 
-    mock_values = {"max_ram_kb": 1500000, "used_ram_kb": 1000000}
-    mock_values["ram_usage_percentage"] = round(
-        (mock_values["used_ram_kb"] / mock_values["max_ram_kb"]) * 100, 3
-    )
-    expected_results.update(
-        {k: v for k, v in mock_values.items() if k in expected_results.keys()}
-    )
-    mock_run_cmd.side_effect = [
-        str(mock_values["max_ram_kb"]),
-        str(mock_values["used_ram_kb"]),
-    ]
 
-    result = get_ram_usage(*test_args)
-    assert mock_run_cmd.call_count == 2
-    assert result == expected_results
+@patch("iriscasttools.utils.read_meminfo")
+@patch("iriscasttools.utils.run_cmd")
+def test_get_ram_usage_free_fallback(mock_run_cmd, mock_read_meminfo):
+    """
+    Test "get_ram_usage" function falls back to free command if /proc/meminfo can't be read
+
+    Keyword arguments:
+        mock_run_cmd - mock object to mock run command function
+        mock_read_meminfo - mock object to mock read_meminfo function
+    """
+    mock_read_meminfo.side_effect = FileNotFoundError
+    with open(
+        os.path.join(_TESTDATA_DIR, "free_test.txt"), "r", encoding="UTF-8"
+    ) as free_file:
+        mock_run_cmd.return_value = free_file.read()
+
+    result = get_ram_usage(*_EXPECTED_RAM_USAGE.keys())
+    mock_run_cmd.assert_called_once_with("free -k -w")
+    assert result == _EXPECTED_RAM_USAGE
@@ -1,170 +1,1426 @@
 #!/usr/bin/env python3
-from typing import List, Dict
-from datetime import datetime
+# pylint: disable=too-many-lines
+from typing import (
+    BinaryIO,
+    Callable,
+    List,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import argparse
+import codecs
+import contextlib
+import gzip
+import hashlib
+import itertools
 import json
+import os
+import re
 import socket
+import string
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 
+# Bytes read from the HTTP response at a time
+CHUNK_SIZE = 64 * 1024
+# Bytes of a window's response kept in memory before the rest is spooled to a temporary file
+SPOOL_SIZE = 1024 * 1024
+# Start of the list of series in a query_range response
+RESULT_RE = re.compile(r'"result"\s*:\s*\[')
+# Prometheus refuses range queries which would return more points than this per series
+MAX_POINTS = 11000
+# Output formats, to the extension of the files written
+OUTPUT_FORMATS = {
+    "csv": "csv",
+    "wide-csv": "csv",
+    "parquet": "parquet",
+    "arrow": "arrow",
+}
+# Labels which identify where a series came from rather than what it measures, left out of wide column names
+SOURCE_LABELS = ("__name__", "instance", "hostname", "job")
+# Day 0 of UNIX Epoch time
+EPOCH_DATE = date(1970, 1, 1)
+# Characters which aren't kept when naming a file after a query
+FILE_NAME_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+# Whitespace in label values, replaced so values stay within their space separated column
+WHITESPACE_RE = re.compile(r"\s+")
+# Metrics written with a hostname column rather than a column per label
+HOSTNAME_PREFIXES = ("openstack", "node")
+# Aggregations to the PromQL function which reduces points to one per step and the parameter it takes, if any
+AGGREGATIONS = {
+    "avg": ("avg", None),
+    "min": ("min", None),
+    "max": ("max", None),
+    "sum": ("sum", None),
+    "p50": ("quantile", "0.5"),
+    "p95": ("quantile", "0.95"),
+    "p99": ("quantile", "0.99"),
+}
+# A metric name with optional label matchers, which can take a range without a subquery. Braces are only
+# matched outside quoted label values, so e.g. 'foo{a="b"} or bar{c="d"}' isn't taken for one selector
+SELECTOR_RE = re.compile(
+    r"""[A-Za-z_:][A-Za-z0-9_:]*(\{([^}"'`]|"([^"\\]|\\.)*"|'([^'\\]|\\.)*'|`[^`]*`)*\})?"""
+)
+# One part of a Prometheus duration, e.g. the "5m" of "1h5m"
+DURATION_RE = re.compile(r"(\d+)([smhdw])")
+DURATION_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+}
 
+
+# pylint: disable=too-many-instance-attributes
 class RawData:
     """
-    This class gets the raw JSON data from the Prometheus endpoint and writes that to files.
+    This class gets the raw JSON data from the Prometheus endpoint and decodes it as it is downloaded.
     """
 
-    def __init__(self, metrics: List[str], start: str, end: str, url: str):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        metrics: List[str],
+        start: str,
+        end: str,
+        url: str,
+        max_in_flight: int = 8,
+        *,
+        drop_last: bool = True,
+        cache: Optional["ResponseCache"] = None,
+        step: int = 60,
+    ):
+        """
+        :param metrics: The metrics to query for
+        :param start: The start of the time range, as UNIX Epoch seconds
+        :param end: The end of the time range, as UNIX Epoch seconds
+        :param url: The Prometheus query_range endpoint
+        :param max_in_flight: The most queries to send at once
+        :param drop_last: Whether to leave out the last point of each series, as earlier versions always did
+        :param cache: The cache to read responses from and add them to, or None to always query Prometheus
+        :param step: The seconds between points
+        """
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}")
         self.metrics = metrics
         self.start = start
         self.end = end
-        self.step = 60
+        self.step = step
+        self.max_points = MAX_POINTS
         self.endpoint = url
+        self.max_in_flight = max_in_flight
+        self.drop_last = drop_last
+        self.cache = cache
+        # One connection pool shared by all queries, with a connection for each query in flight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def time_windows(self, start: Optional[float] = None) -> List[Tuple[float, float]]:
+        """
+        This method splits the time range into windows small enough to stay under the Prometheus points limit.
+        Windows don't overlap and each starts on the step after the end of the one before.
+        :param start: The time to start from if later than the start of the time range
+        :return: The start and end time of each window
+        """
+        start = max(float(self.start), start if start is not None else float("-inf"))
+        end = float(self.end)
+        span = self.step * (self.max_points - 1)
+        windows = []
+        while start <= end:
+            windows.append((start, min(start + span, end)))
+            start += span + self.step
+        return windows
+
+    def request_all(
+        self, metrics: Iterable[str], starts: Optional[Dict[str, float]] = None
+    ) -> Iterator[Tuple[str, Iterator[Dict]]]:
+        """
+        This method queries for each metric over the time range, fetching windows of all metrics concurrently.
+        Metrics with no time left to query after their start are left out.
+        :param metrics: The metrics to query for
+        :param starts: The time to start each metric from, if later than the start of the time range
+        :return: An iterator of each metric and its series, as returned by stitch_series
+        """
+        windows = self.fetch_windows(metrics, starts)
+        for metric, group in itertools.groupby(windows, key=lambda window: window[0]):
+            yield metric, self.stitch_series(
+                (series for _, series in group), self.drop_last
+            )
+
+    def request_series(self, metric: str) -> Iterator[Dict]:
+        """
+        This method queries for a metric over the time range.
+        :param metric: The metric to query for
+        :return: An iterator of series, as returned by stitch_series
+        """
+        return self.stitch_series(
+            (series for _, series in self.fetch_windows([metric])), self.drop_last
+        )
+
+    def fetch_windows(
+        self, metrics: Iterable[str], starts: Optional[Dict[str, float]] = None
+    ) -> Iterator[Tuple[str, Iterator[Dict]]]:
+        """
+        This method queries for each metric over each time window, with up to max_in_flight queries at once.
+        Windows are yielded in order of metric then time, each as soon as it and those before it have been read.
+        Responses are spooled to temporary files as they arrive and decoded one series at a time as they are
+        yielded, so at most SPOOL_SIZE bytes of each window in flight are held in memory.
+        :param metrics: The metrics to query for
+        :param starts: The time to start each metric from, if later than the start of the time range
+        :return: An iterator of each metric and the series in one of its windows
+        """
+        starts = starts or {}
+        tasks = [
+            (metric, start, end)
+            for metric in metrics
+            for start, end in self.time_windows(starts.get(metric))
+        ]
+        with ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="prom-query"
+        ) as executor:
+            pending = deque()
+            try:
+                for metric, start, end in tasks:
+                    if len(pending) == self.max_in_flight:
+                        done_metric, future = pending.popleft()
+                        yield done_metric, self.read_spool(future.result())
+                    pending.append(
+                        (metric, executor.submit(self.fetch_window, metric, start, end))
+                    )
+                while pending:
+                    done_metric, future = pending.popleft()
+                    yield done_metric, self.read_spool(future.result())
+            finally:
+                # Windows left unread when a query fails or the iterator is closed early
+                for _, future in pending:
+                    future.cancel()
+                for _, future in pending:
+                    if not future.cancelled() and future.exception() is None:
+                        future.result().close()
+
+    def fetch_window(self, metric: str, start: float, end: float) -> BinaryIO:
+        """
+        This method downloads the response for a metric in a time window to a temporary file.
+        :param metric: The metric to query for
+        :param start: The start of the window
+        :param end: The end of the window
+        :return: The response body, read from the start
+        """
+        # Closed by read_spool once the window has been read
+        # pylint: disable=consider-using-with
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        chunks = self.window_body(metric, start, end)
+        try:
+            for chunk in chunks:
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        finally:
+            chunks.close()
+        spool.seek(0)
+        return spool
+
+    def read_spool(self, spool: BinaryIO) -> Iterator[Dict]:
+        """
+        This method decodes the series in a downloaded response, closing its file once it has been read.
+        :param spool: The response body, as returned by fetch_window
+        :return: An iterator of series, each a dictionary with "metric" and "values" keys
+        """
+        with spool:
+            yield from self.stream_series(iter(lambda: spool.read(CHUNK_SIZE), b""))
+
+    @staticmethod
+    def stitch_series(
+        windows: Iterable[List[Dict]], drop_last: bool = True
+    ) -> Iterator[Dict]:
+        """
+        This method stitches series from consecutive time windows back together in time order.
+        Points repeated at window boundaries are removed. Series are yielded in parts as each window is read,
+        so each series may be yielded more than once.
+        :param windows: The series in each window, in time order
+        :param drop_last: Whether to leave out the last point of each series
+        :return: An iterator of series, each a dictionary with "metric" and "values" keys
+        """
+        # Labels of each series to the time of its last point seen
+        last_seen = {}
+        # Labels of each series to its last point, held back until it's known not to be the last of the series
+        held = {}
+        for window in windows:
+            for series in window:
+                key = tuple(sorted(series["metric"].items()))
+                last = last_seen.get(key)
+                values = [v for v in series["values"] if last is None or v[0] > last]
+                if not values:
+                    continue
+                last_seen[key] = values[-1][0]
+                values = held.get(key, []) + values
+                held[key] = values[-1:]
+                if len(values) > 1:
+                    yield {"metric": series["metric"], "values": values[:-1]}
+        if not drop_last:
+            for labels, values in held.items():
+                yield {"metric": dict(labels), "values": values}
+
+    def window_body(self, metric: str, start: float, end: float) -> Iterator[bytes]:
+        """
+        This method queries for a metric over a time window and yields the response body as it is downloaded.
+        Windows which have ended long enough ago are read from and added to the cache, if there is one.
+        :param metric: The metric to query for
+        :param start: The start of the window
+        :param end: The end of the window
+        :return: The response body in chunks of bytes
+        """
+        payload = {
+            "query": metric,
+            "start": self.format_time(start),
+            "end": self.format_time(end),
+            "step": self.step,
+        }
+        cache_path = None
+        if self.cache and self.cache.cacheable(end):
+            cache_path = self.cache.file_path(self.endpoint, payload)
+            cached = self.cache.read(cache_path)
+            if cached is not None:
+                try:
+                    yield from cached
+                finally:
+                    cached.close()
+                return
+
+        response = self.http_request(payload)
+        chunks = response.iter_content(CHUNK_SIZE)
+        if cache_path:
+            chunks = self.cache.write(cache_path, chunks)
+        try:
+            yield from chunks
+        finally:
+            if cache_path:
+                chunks.close()
+            response.close()
 
-    def request_to_json_file(self):
+    @staticmethod
+    def format_time(timestamp: float) -> str:
         """
-        This method runs the request and write function for each metric you want to query for.
-        It will write into CSV files called the metrics name.
+        This method formats a UNIX Epoch time for a query, without a decimal point for whole seconds.
+        :param timestamp: The time to format
+        :return: The formatted time
         """
-        for metric in self.metrics:
-            payload = {
-                "query": metric,
-                "start": self.start,
-                "end": self.end,
-                "step": self.step,
-            }
-            response = self.http_request(payload)
-            self.write_json_file(metric, response)
+        return str(int(timestamp)) if timestamp == int(timestamp) else str(timestamp)
 
     def http_request(self, metric) -> requests.Response:
         """
         This method uses the request library's get function to send a HTTP GET request to the endpoint.
+        The body is not downloaded until it is read from the response.
         :param metric: The metric to query for
         :return: The HTTP response
         """
-        response = requests.get(self.endpoint, params=metric, timeout=300)
+        response = self.session.get(
+            self.endpoint, params=metric, timeout=300, stream=True
+        )
         assert response.status_code == 200, "The HTTP response did not return okay."
         return response
 
     @staticmethod
-    def write_json_file(name: str, response: requests.Response):
+    def stream_series(chunks: Iterable[bytes]) -> Iterator[Dict]:
         """
-        This method writes the response data to a file.
-        :param name: The metric name
-        :param response: The HTTP response
+        This method incrementally decodes a query_range response body, yielding each series in the result as soon
+        as it has been read rather than parsing the whole body at once.
+        :param chunks: The response body in chunks of bytes
+        :return: An iterator of series, each a dictionary with "metric" and "values" keys
         """
-        with open(f"{name}.csv", "w", encoding="utf-8") as json_file:
-            data = response.json()
-            json_file.write(str(data))
+        chunks = iter(chunks)
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        decoder = json.JSONDecoder()
+        buffer, eof = "", False
+        match = None
+        while match is None:
+            if eof:
+                raise Exception("The response did not contain a query result.")
+            text, eof = RawData._read_text(chunks, text_decoder, CHUNK_SIZE)
+            buffer += text
+            match = RESULT_RE.search(buffer)
 
+        pos = match.end()
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                if buffer[pos] == "]":
+                    return
+                try:
+                    series, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The series has not been fully read yet
+                    pass
+                else:
+                    yield series
+                    continue
+            if eof:
+                raise Exception("The response ended part way through the query result.")
+            # Read at least as much again as is buffered so a large series is only re-parsed a few times
+            text, eof = RawData._read_text(
+                chunks, text_decoder, max(CHUNK_SIZE, len(buffer) - pos)
+            )
+            buffer = buffer[pos:] + text
+            pos = 0
 
-class JsonToCSV:
+    @staticmethod
+    def _read_text(
+        chunks: Iterator[bytes], text_decoder: codecs.IncrementalDecoder, size: int
+    ) -> Tuple[str, bool]:
+        """
+        This method reads and decodes at least the given number of characters from the response body.
+        Fewer characters are returned only when the body has ended.
+        :param chunks: The response body in chunks of bytes
+        :param text_decoder: The decoder for the body, which keeps characters split across chunks
+        :param size: The number of characters to read
+        :return: The text read and whether the body has ended
+        """
+        parts = []
+        while size > 0:
+            chunk = next(chunks, None)
+            if chunk is None:
+                parts.append(text_decoder.decode(b"", final=True))
+                return "".join(parts), True
+            parts.append(text_decoder.decode(chunk))
+            size -= len(parts[-1])
+        return "".join(parts), False
+
+
+class HostnameCache:
     """
-    This class trims the raw JSON data to a CSV format file.
+    This class caches reverse DNS lookups of addresses, so each address is only looked up once.
+    Lookups are kept for ttl seconds and can be saved to a JSON file to be reused by later runs.
     """
 
-    def __init__(self, metrics: List[str]):
-        self.metrics = metrics
+    def __init__(
+        self,
+        ttl: float = 24 * 60 * 60,
+        path: Optional[str] = None,
+        max_workers: int = 16,
+    ):
+        """
+        :param ttl: The seconds a lookup is kept for
+        :param path: The JSON file to load lookups from and save them to, or None to only keep them in memory
+        :param max_workers: The most lookups to run at once
+        """
+        self.ttl = ttl
+        self.path = path
+        self.max_workers = max_workers
+        # Address to its hostname and the time it was looked up
+        self.entries: Dict[str, Tuple[str, float]] = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """
+        This method loads the lookups which haven't expired from the cache file.
+        """
+        with open(self.path, "r", encoding="utf-8") as cache_file:
+            entries = json.load(cache_file)
+        now = time.time()
+        self.entries = {
+            address: (hostname, looked_up)
+            for address, (hostname, looked_up) in entries.items()
+            if now - looked_up < self.ttl
+        }
+
+    def save(self):
+        """
+        This method saves the lookups to the cache file, replacing it in one step so it is never left half written.
+        """
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(tmp_path, self.path)
+
+    def resolve_all(self, addresses: Iterable[str]):
+        """
+        This method looks up all addresses which aren't already cached at the same time.
+        :param addresses: The addresses to look up
+        """
+        now = time.time()
+        missing = {address for address in addresses if not self.cached(address, now)}
+        if not missing:
+            return
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(missing)),
+            thread_name_prefix="prom-dns",
+        ) as executor:
+            hostnames = executor.map(self.lookup, missing)
+            self.entries.update(
+                (address, (hostname, now))
+                for address, hostname in zip(missing, hostnames)
+            )
+
+    def cached(self, address: str, now: Optional[float] = None) -> bool:
+        """
+        This method checks whether the hostname of an address is cached and hasn't expired.
+        :param address: The address to check
+        :param now: The current time, if already known
+        :return: Whether the address needs looking up
+        """
+        now = time.time() if now is None else now
+        return address in self.entries and now - self.entries[address][1] < self.ttl
 
-    def json_to_csv(self):
+    def hostname(self, address: str) -> str:
         """
-        This method reads a file and calls the format function for each file.
-        Then writes the newly formatted data to that original file.
+        This method gets the hostname of an address, looking it up if it isn't cached.
+        :param address: The address to get the hostname of
+        :return: The hostname
         """
-        for metric in self.metrics:
-            json_data = self.read_json(metric)
-            dictionary = self.json_to_dict(json_data)
-            self.dict_to_csv(dictionary)
+        if not self.cached(address):
+            self.entries[address] = (self.lookup(address), time.time())
+        return self.entries[address][0]
 
     @staticmethod
-    def read_json(file_name: str) -> str:
+    def lookup(address: str) -> str:
         """
-        This method reads the data in to Python from the file.
-        :param file_name: The file name to read
-        :return: Returns the data read from the file
+        This method looks up the hostname of an address in DNS.
+        :param address: The address to look up
+        :return: The hostname, or the address if it has no hostname
         """
-        with open(f"{file_name}.csv", "r", encoding="utf-8") as json_file:
-            json_data = json_file.read()
-            return json_data
+        try:
+            return socket.gethostbyaddr(address)[0]
+        except OSError:
+            return address
+
+
+class ResponseCache:
+    """
+    This class keeps gzip compressed query_range response bodies on disk, so repeated exports are read from disk
+    rather than querying Prometheus again. Bodies are stored under a hash of the endpoint, query, range and step.
+    When the cache grows past max_bytes the least recently used bodies are removed.
+    """
+
+    def __init__(
+        self,
+        path: str = "response_cache",
+        max_bytes: int = 1024**3,
+        min_age: float = 15 * 60,
+    ):
+        """
+        :param path: The directory to keep response bodies in
+        :param max_bytes: The most bytes of compressed bodies to keep
+        :param min_age: Ranges which end less than this many seconds ago aren't cached, as Prometheus may still be
+        adding points to them
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.lock = threading.Lock()
+
+    def cacheable(self, end: float) -> bool:
+        """
+        This method checks whether a range ends long enough ago for its points to no longer change.
+        :param end: The end of the range
+        :return: Whether responses for the range can be cached
+        """
+        return end <= time.time() - self.min_age
+
+    def file_path(self, endpoint: str, payload: Dict) -> str:
+        """
+        This method gets the file a query's response body is kept in.
+        :param endpoint: The Prometheus query_range endpoint
+        :param payload: The query, start, end and step
+        :return: The path to the file
+        """
+        key = json.dumps([endpoint, payload], sort_keys=True)
+        return os.path.join(
+            self.path, hashlib.sha256(key.encode()).hexdigest() + ".json.gz"
+        )
+
+    def read(self, path: str) -> Optional[Iterator[bytes]]:
+        """
+        This method opens a cached response body, marking it as recently used.
+        :param path: The file the body is kept in
+        :return: The body in chunks of bytes, or None if it isn't cached
+        """
+        try:
+            cache_file = gzip.open(path, "rb")
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return self.read_chunks(cache_file)
 
     @staticmethod
-    def json_to_dict(data: str) -> Dict:
+    def read_chunks(cache_file: gzip.GzipFile) -> Iterator[bytes]:
         """
-        This method converts the read string into a Python dictionary.
-        :param data: The data read from the file
-        :return: Returns the data as a dictionary
+        This method reads a cached response body in chunks, closing the file once it has been read.
+        :param cache_file: The open cache file
+        :return: The body in chunks of bytes
         """
-        data = data.replace("'", '"')
-        json_data = json.loads(data)
-        return json_data
+        with cache_file:
+            yield from iter(lambda: cache_file.read(CHUNK_SIZE), b"")
 
-    def dict_to_csv(self, json_data: Dict):
+    def write(self, path: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
         """
-        This method writes the data into a CSV file formatted using f strings to only write the data we want.
-        :param json_data: The data from the file in a dictionary
+        This method passes on the chunks of a response body while compressing them to a temporary file.
+        The file is only moved into the cache once the whole body has been read, so a failed or partly read
+        response is never cached.
+        :param path: The file to keep the body in
+        :param chunks: The response body in chunks of bytes
+        :return: The same chunks
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            # The fastest compression level, so caching doesn't slow down downloads
+            with open(fd, "wb") as raw_file, gzip.GzipFile(
+                fileobj=raw_file, mode="wb", compresslevel=1, mtime=0
+            ) as cache_file:
+                for chunk in chunks:
+                    cache_file.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """
+        This method removes the least recently used bodies until the cache is no larger than max_bytes.
+        """
+        with self.lock:
+            with os.scandir(self.path) as entries:
+                files = [
+                    (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                    for entry in entries
+                    if entry.name.endswith(".json.gz")
+                ]
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+
+
+class ExportState:
+    """
+    This class keeps how far each query has been exported to CSV, so later runs only fetch and append new points.
+    For each query it stores the time of the last point written of each series and the size of the CSV file once
+    they were written. The state is only saved after the file has been flushed to disk, so a run which is
+    interrupted part way through a file is rolled back to the last saved size and resumed.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The JSON file to keep the state in
+        """
+        self.path = path
+        # Query to its file, size and the time of the last point written of each series
+        self.queries: Dict[str, Dict] = {}
+        # Query to the time of the last point written of each series seen in the current run
+        self.pending: Dict[str, Dict[str, float]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as state_file:
+                self.queries = json.load(state_file)
+
+    def save(self):
+        """
+        This method saves the state, replacing the state file in one step so it is never left half written.
+        """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as state_file:
+            json.dump(self.queries, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def starts(self, queries: Iterable[str], step: float) -> Dict[str, float]:
+        """
+        This method gets the time to fetch each query from, the step after the oldest series' last point written.
+        Queries whose file is missing or has shrunk since it was written are left out, so they are exported again
+        from the start.
+        :param queries: The queries to get the start of
+        :param step: The query step
+        :return: Each query to the time to start it from
+        """
+        starts = {}
+        for query in queries:
+            entry = self.queries.get(query)
+            if entry is None or not entry["series"]:
+                continue
+            if (
+                not os.path.exists(entry["file"])
+                or os.path.getsize(entry["file"]) < entry["size"]
+            ):
+                del self.queries[query]
+                continue
+            starts[query] = min(entry["series"].values()) + step
+        return starts
+
+    def prepare(self, query: str, file_name: str):
+        """
+        This method rolls a file back to its size when it was last saved, dropping rows written by an interrupted
+        run. Files of queries with no state are emptied so they are exported again from the start.
+        :param query: The query to be written
+        :param file_name: The file the query is written to
+        """
+        entry = self.queries.get(query)
+        size = entry["size"] if entry is not None and entry["file"] == file_name else 0
+        if os.path.exists(file_name):
+            os.truncate(file_name, size)
+
+    def new_points(self, query: str, data: Iterable[Dict]) -> Iterator[Dict]:
+        """
+        This method leaves out points of each series which have already been written.
+        :param query: The query the series are from
+        :param data: The series in the query result
+        :return: An iterator of the series with only new points
+        """
+        entry = self.queries.get(query, {})
+        written = entry.get("series", {})
+        self.pending[query] = seen = {}
+        for series in data:
+            key = json.dumps(series["metric"], sort_keys=True)
+            last = written.get(key)
+            values = [v for v in series["values"] if last is None or v[0] > last]
+            if values:
+                seen[key] = values[-1][0]
+            elif last is not None:
+                seen.setdefault(key, last)
+            yield {"metric": series["metric"], "values": values}
+
+    def commit(self, query: str, file_name: str):
+        """
+        This method flushes the file to disk then saves how far the query has been written.
+        Only series seen in this run are kept, so series which have gone away don't hold back later runs.
+        :param query: The query which was written
+        :param file_name: The file the query was written to
+        """
+        with open(file_name, "rb") as csv_file:
+            os.fsync(csv_file.fileno())
+        seen = self.pending.pop(query, {})
+        if not seen and query in self.queries:
+            seen = self.queries[query]["series"]
+        self.queries[query] = {
+            "file": file_name,
+            "size": os.path.getsize(file_name),
+            "series": seen,
+        }
+        self.save()
+
+
+class MissingLabels(dict):
+    """
+    This class is a dictionary of labels which returns an empty value for labels a series doesn't have.
+    """
+
+    def __missing__(self, key: str) -> str:
+        return ""
+
+
+class RowTemplate:
+    """
+    This class formats the label columns written before the value of each row, from a template of label names
+    such as "{project} {hostname}". Labels a series doesn't have are left empty, and whitespace in label values is
+    replaced with underscores so each value stays one column. A "hostname" field is filled with the hostname of
+    the series' instance for series without a hostname label.
+    """
+
+    def __init__(self, template: str, header: Optional[str] = None):
+        """
+        :param template: The label columns as a str.format template of label names, e.g. "{project} {hostname}"
+        :param header: The header of the label columns, defaults to the label names
+        """
+        self.template = template
+        self.fields = [
+            field for _, field, _, _ in string.Formatter().parse(template) if field
+        ]
+        self.header = header if header is not None else " ".join(self.fields)
+
+    @classmethod
+    def from_labels(cls, labels: Dict) -> "RowTemplate":
+        """
+        This method makes a template with a column for each label of a series other than its name.
+        :param labels: The labels of the series
+        :return: The template
         """
-        data = json_data["data"]["result"]
+        return cls(
+            " ".join(f"{{{label}}}" for label in sorted(labels) if label != "__name__")
+        )
+
+    def format(self, labels: Dict) -> str:
+        """
+        This method formats the label columns of a series.
+        :param labels: The labels of the series
+        :return: The label columns
+        """
+        return self.template.format_map(
+            MissingLabels(
+                (label, column_value(value)) for label, value in labels.items()
+            )
+        )
+
+    @staticmethod
+    def row_infix(columns: str) -> str:
+        """
+        This method gets the text written between the time and value of each row of a series.
+        :param columns: The label columns of the series
+        :return: The label columns with their separators
+        """
+        return f" {columns} " if columns else " "
+
+
+# Label columns of the metrics supported before templates were, kept so their output doesn't change
+HOSTNAME_TEMPLATE = RowTemplate("{hostname}", "Hostname")
+
+
+def column_value(value: str) -> str:
+    """
+    This function makes a label value safe to write as one column of a space separated row.
+    :param value: The label value
+    :return: The value with each run of whitespace replaced with an underscore
+    """
+    return WHITESPACE_RE.sub("_", value)
+
+
+def downsample_query(
+    metric: str, resolution: int, aggregation: str, by: Optional[str] = None
+) -> str:
+    """
+    This function rewrites a query so Prometheus reduces it to one point per resolution, e.g.
+    "avg_over_time(node_load1[300s])", optionally aggregating series with the same labels together.
+    Queries which aren't a plain metric are reduced with a subquery.
+    :param metric: The query to downsample
+    :param resolution: The seconds each point covers, which should also be the query step
+    :param aggregation: How points are reduced, one of AGGREGATIONS
+    :param by: Comma separated labels to aggregate series by, or None to keep every series
+    :return: The rewritten query
+    """
+    function, parameter = AGGREGATIONS[aggregation]
+    prefix = f"{parameter}, " if parameter else ""
+    if SELECTOR_RE.fullmatch(metric):
+        series = f"{metric}[{resolution}s]"
+    else:
+        series = f"({metric})[{resolution}s:]"
+    query = f"{function}_over_time({prefix}{series})"
+    if by:
+        labels = ", ".join(label.strip() for label in by.split(","))
+        query = f"{function} by ({labels}) ({prefix}{query})"
+    return query
+
+
+def parse_duration(text: str) -> int:
+    """
+    This function parses a duration given as seconds or in Prometheus' format, e.g. "300" or "1h30m".
+    :param text: The duration
+    :return: The duration in seconds
+    """
+    if text.isdigit():
+        seconds = int(text)
+    else:
+        parts = DURATION_RE.findall(text)
+        if "".join(number + unit for number, unit in parts) != text:
+            raise argparse.ArgumentTypeError(f"invalid duration {text!r}")
+        seconds = sum(int(number) * DURATION_UNITS[unit] for number, unit in parts)
+    if seconds < 1:
+        raise argparse.ArgumentTypeError(f"duration must be at least 1s, got {text!r}")
+    return seconds
+
+
+def import_pyarrow():
+    """
+    This function imports pyarrow when it's needed, as it is only required for parquet and arrow output.
+    :return: The pyarrow module
+    """
+    try:
+        # pylint: disable=import-outside-toplevel
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ImportError("pyarrow is required for parquet and arrow output.") from exc
+    return pyarrow
+
+
+class JsonToCSV:
+    """
+    This class trims the decoded JSON data to a CSV format file.
+    """
+
+    def __init__(
+        self,
+        metrics: List[str],
+        hostnames: Optional[HostnameCache] = None,
+        output_format: str = "csv",
+        state: Optional[ExportState] = None,
+        templates: Optional[Dict[str, Union[str, RowTemplate]]] = None,
+    ):
+        """
+        :param metrics: The metrics to write
+        :param hostnames: The cache to look up hostnames of node instances in
+        :param output_format: "csv" for a row per point, or "wide-csv", "parquet" or "arrow" for a row per time
+            with a column per host
+        :param state: The state of an incremental export to append new points to, or None to export everything
+        :param templates: Queries to the template of their label columns, as a RowTemplate or its template string.
+            Queries without one get a hostname column for "openstack" and "node" metrics, or a column per label
+            otherwise
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unsupported output format {output_format}: must be one of {', '.join(OUTPUT_FORMATS)}."
+            )
+        if state is not None and output_format != "csv":
+            raise ValueError("Incremental export is only supported for csv output.")
+        self.metrics = metrics
+        self.hostnames = hostnames if hostnames is not None else HostnameCache()
+        self.output_format = output_format
+        self.state = state
+        self.templates = templates or {}
+
+    def json_to_csv(self, raw_data: RawData):
+        """
+        This method queries Prometheus for all metrics and writes each query result to a CSV file.
+        :param raw_data: The RawData instance to query Prometheus with
+        """
+        starts = self.state.starts(self.metrics, raw_data.step) if self.state else None
         try:
-            metric_type = data[0]["metric"]["__name__"]
-        except IndexError as exc:
+            for metric, series in raw_data.request_all(self.metrics, starts):
+                self.dict_to_csv(series, metric)
+        finally:
+            self.hostnames.save()
+
+    def dict_to_csv(self, data: Iterable[Dict], query: Optional[str] = None):
+        """
+        This method writes the data into a CSV file formatted using f strings to only write the data we want.
+        :param data: The series in the query result
+        :param query: The query the data is from, needed to keep the state of an incremental export
+        """
+        data = iter(data)
+        first = next(data, None)
+        if first is None:
+            if self.state is not None and query in self.state.queries:
+                # Nothing new since the last run
+                return
             raise Exception(
-                "Your query returned no data. "
-                "Check that there is data in the time range then try decreasing the step to query at shorter intervals."
-            ) from exc
-        if metric_type.startswith("openstack"):
-            self.dict_to_csv_openstack(data)
-        elif metric_type.startswith("node"):
-            self.dict_to_csv_node(data)
+                "Your query returned no data. Check that there is data in the time range."
+            )
+        name = self.output_name(first["metric"], query)
+        template = self.template_for(name, first["metric"], query)
+        data = itertools.chain([first], data)
+        if self.output_format == "csv" and self.state is not None:
+            file_name = f"{name}.csv"
+            self.state.prepare(query, file_name)
+            self.dict_to_rows(name, self.state.new_points(query, data), template)
+            self.state.commit(query, file_name)
+        elif self.output_format == "csv":
+            self.dict_to_rows(name, data, template)
         else:
-            raise Exception(
-                "Unsupported query type: openstack or node currently supported."
+            self.dict_to_wide(name, self.resolve_instances(data, template), template)
+
+    @staticmethod
+    def output_name(labels: Dict, query: Optional[str]) -> str:
+        """
+        This method gets the name of the file to write a query result to - the metric name, or the query for
+        results without one such as aggregations.
+        :param labels: The labels of the first series in the result
+        :param query: The query the result is from
+        :return: The file name without an extension
+        """
+        if "__name__" in labels:
+            return labels["__name__"]
+        return FILE_NAME_RE.sub("_", query or "").strip("_") or "query"
+
+    def template_for(
+        self, name: str, labels: Dict, query: Optional[str]
+    ) -> RowTemplate:
+        """
+        This method gets the template of the label columns of a query result.
+        :param name: The name of the result's file
+        :param labels: The labels of the first series in the result
+        :param query: The query the result is from
+        :return: The template
+        """
+        if query in self.templates:
+            template = self.templates[query]
+            return (
+                template if isinstance(template, RowTemplate) else RowTemplate(template)
             )
+        if name.startswith(HOSTNAME_PREFIXES):
+            return HOSTNAME_TEMPLATE
+        return RowTemplate.from_labels(labels)
 
     @staticmethod
-    def dict_to_csv_openstack(data: Dict):
+    def instance_address(labels: Dict) -> str:
         """
-        This method supports "openstack" queries.
+        This method gets the address of the instance a series was scraped from.
+        :param labels: The labels of the series
+        :return: The address without a port
         """
-        file_name = data[0]["metric"]["__name__"] + ".csv"
-        with open(file_name, "w", encoding="utf-8") as csv_file:
-            line = f'Date Time Hostname {data[0]["metric"]["__name__"]}\n'
-            csv_file.write(line)
-            for metric in data:
-                for i in range(len(metric["values"]) - 1):
-                    time = datetime.fromtimestamp(metric["values"][i][0])
-                    hostname = metric["metric"]["hostname"]
-                    value = metric["values"][i][1]
-                    line = f"{time} {hostname} {value}\n"
-                    csv_file.write(line)
+        return labels["instance"].split(":")[0]
+
+    def hostname_address(self, template: RowTemplate, labels: Dict) -> Optional[str]:
+        """
+        This method gets the address to resolve for the hostname of a series, if its label columns need one.
+        :param template: The template of the label columns
+        :param labels: The labels of the series
+        :return: The address of the series' instance, or None if it doesn't need resolving
+        """
+        if (
+            "hostname" in template.fields
+            and "hostname" not in labels
+            and "instance" in labels
+        ):
+            return self.instance_address(labels)
+        return None
+
+    def label_columns(self, template: RowTemplate, labels: Dict) -> str:
+        """
+        This method formats the label columns of a series, resolving its instance if a hostname is needed.
+        :param template: The template of the label columns
+        :param labels: The labels of the series
+        :return: The label columns
+        """
+        address = self.hostname_address(template, labels)
+        if address is not None:
+            labels = {**labels, "hostname": self.hostnames.hostname(address)}
+        return template.format(labels)
+
+    def resolve_instances(
+        self, data: Iterable[Dict], template: RowTemplate
+    ) -> List[Dict]:
+        """
+        This method resolves the instances of all series which need a hostname together.
+        :param data: The series to resolve the instances of
+        :param template: The template of the label columns
+        :return: The series
+        """
+        data = list(data)
+        addresses = (
+            self.hostname_address(template, metric["metric"]) for metric in data
+        )
+        self.hostnames.resolve_all(
+            address for address in addresses if address is not None
+        )
+        return data
+
+    def dict_to_wide(self, name: str, data: Iterable[Dict], template: RowTemplate):
+        """
+        This method writes the data with a row per time and a column per host, in the output format.
+        Columns are named after the label columns of each series, with spaces replaced by underscores.
+        :param name: The metric name
+        :param data: The series in the query result
+        :param template: The template of the label columns
+        """
+        timestamps, columns = self.pivot(
+            data,
+            lambda labels: self.label_columns(template, labels).replace(" ", "_")
+            or name,
+        )
+        file_name = f"{name}.{OUTPUT_FORMATS[self.output_format]}"
+        if self.output_format == "wide-csv":
+            self.write_wide_csv(file_name, timestamps, columns)
+        else:
+            self.write_columnar(file_name, timestamps, columns)
 
     @staticmethod
-    def dict_to_csv_node(data: Dict):
+    def pivot(
+        data: Iterable[Dict], host_of: Callable[[Dict], str]
+    ) -> Tuple[List[float], Dict[str, Dict[float, str]]]:
         """
-        This method supports "node" queries.
+        This method pivots series into a column per series, named after the host it's from.
+        Hosts with more than one series, e.g. a series per sensor, have the labels of each series added to the name.
+        :param data: The series in the query result
+        :param host_of: The function to get the host a series is from, given its labels
+        :return: The sorted times of all points and each column's values by time
+        """
+        # Host and other labels of each series to its values by time
+        series_values = {}
+        for metric in data:
+            labels = metric["metric"]
+            extra = tuple(
+                sorted((k, v) for k, v in labels.items() if k not in SOURCE_LABELS)
+            )
+            values = series_values.setdefault((host_of(labels), extra), {})
+            values.update((timestamp, value) for timestamp, value in metric["values"])
+
+        series_per_host = {}
+        for host, _ in series_values:
+            series_per_host[host] = series_per_host.get(host, 0) + 1
+        columns = {}
+        for (host, extra), values in series_values.items():
+            if series_per_host[host] > 1:
+                host += (
+                    "{" + ",".join(f'{k}="{column_value(v)}"' for k, v in extra) + "}"
+                )
+            columns[host] = values
+        timestamps = sorted(set().union(*columns.values()))
+        return timestamps, columns
+
+    @staticmethod
+    def write_wide_csv(
+        file_name: str, timestamps: List[float], columns: Dict[str, Dict[float, str]]
+    ):
+        """
+        This method writes the pivoted data in the same space separated format as the CSV output.
+        Times a host has no point for are written as NaN.
+        :param file_name: The file to write
+        :param timestamps: The sorted times of all points
+        :param columns: Each column's values by time
         """
-        file_name = data[0]["metric"]["__name__"] + ".csv"
         with open(file_name, "w", encoding="utf-8") as csv_file:
-            line = f'Date Time Hostname {data[0]["metric"]["__name__"]}\n'
-            csv_file.write(line)
+            csv_file.write(" ".join(["Date", "Time", *columns]) + "\n")
+            dates = JsonToCSV.format_times(timestamps).astype(str).tolist()
+            csv_file.writelines(
+                " ".join([date, *(values.get(t, "NaN") for values in columns.values())])
+                + "\n"
+                for date, t in zip(dates, timestamps)
+            )
+
+    def write_columnar(
+        self,
+        file_name: str,
+        timestamps: List[float],
+        columns: Dict[str, Dict[float, str]],
+    ):
+        """
+        This method writes the pivoted data as a zstd compressed parquet or arrow IPC file.
+        Times are UTC timestamps in a "time" column, values are floats with times a host has no point for as null.
+        :param file_name: The file to write
+        :param timestamps: The sorted times of all points
+        :param columns: Each column's values by time
+        """
+        pyarrow = import_pyarrow()
+        times = np.round(np.asarray(timestamps, dtype=np.float64) * 1000)
+        arrays = {
+            "time": pyarrow.array(
+                times.astype(np.int64), pyarrow.timestamp("ms", tz="UTC")
+            )
+        }
+        for column, values in columns.items():
+            floats = np.array(
+                [values.get(t, "NaN") for t in timestamps], dtype=np.float64
+            )
+            missing = np.array([t not in values for t in timestamps], dtype=bool)
+            arrays[column] = pyarrow.array(floats, mask=missing)
+        table = pyarrow.table(arrays)
+        if self.output_format == "parquet":
+            pyarrow.parquet.write_table(table, file_name, compression="zstd")
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression="zstd")
+            with pyarrow.ipc.new_file(
+                file_name, table.schema, options=options
+            ) as writer:
+                writer.write_table(table)
+
+    def open_csv(self, name: str, header: str) -> TextIO:
+        """
+        This method opens the CSV file of a metric, writing the header if it is new.
+        Incremental exports append to the file, otherwise it is overwritten.
+        :param name: The metric name
+        :param header: The header of the label columns
+        :return: The open file
+        """
+        mode = "a" if self.state is not None else "w"
+        # pylint: disable=consider-using-with
+        csv_file = open(f"{name}.csv", mode, encoding="utf-8")
+        if csv_file.tell() == 0:
+            csv_file.write(" ".join(filter(None, ["Date Time", header, name])) + "\n")
+        return csv_file
+
+    def dict_to_rows(self, name: str, data: Iterable[Dict], template: RowTemplate):
+        """
+        This method writes a row per point with the label columns of its series, using a row format compiled
+        once per series. Series are written as they arrive, so only one is held in memory at a time, except
+        series whose instance hasn't been resolved yet. Those instances are looked up concurrently as they are
+        first seen, with at most as many series waiting for lookups as the hostname cache's max_workers.
+        :param name: The metric name
+        :param data: The series in the query result
+        :param template: The template of the label columns
+        """
+        with self.open_csv(name, template.header) as csv_file, ThreadPoolExecutor(
+            max_workers=self.hostnames.max_workers, thread_name_prefix="prom-dns"
+        ) as executor:
+            # Address to the lookup of its hostname
+            lookups = {}
+            # Series needing a hostname and its lookup, in the order they arrived so each series'
+            # parts are written in time order
+            waiting = deque()
             for metric in data:
-                for i in range(len(metric["values"]) - 1):
-                    time = datetime.fromtimestamp(metric["values"][i][0])
-                    hostname = socket.gethostbyaddr(
-                        metric["metric"]["instance"].split(":")[0]
-                    )[0]
-                    value = metric["values"][i][1]
-                    line = f"{time} {hostname} {value}\n"
-                    csv_file.write(line)
+                address = self.hostname_address(template, metric["metric"])
+                if address is None or (not waiting and self.hostnames.cached(address)):
+                    self.write_series(csv_file, metric, template)
+                else:
+                    if address not in lookups:
+                        lookups[address] = executor.submit(
+                            self.hostnames.hostname, address
+                        )
+                    waiting.append((lookups[address], metric))
+                while waiting and (
+                    waiting[0][0].done() or len(waiting) > self.hostnames.max_workers
+                ):
+                    lookup, waiting_metric = waiting.popleft()
+                    lookup.result()
+                    self.write_series(csv_file, waiting_metric, template)
+            for lookup, waiting_metric in waiting:
+                lookup.result()
+                self.write_series(csv_file, waiting_metric, template)
+
+    def write_series(self, csv_file: TextIO, metric: Dict, template: RowTemplate):
+        """
+        This method writes a row per point of a series.
+        :param csv_file: The file to write to
+        :param metric: The series, a dictionary with "metric" and "values" keys
+        :param template: The template of the label columns
+        """
+        if not metric["values"]:
+            return
+        timestamps, values = zip(*metric["values"])
+        infix = template.row_infix(self.label_columns(template, metric["metric"]))
+        # Rows are built as bytes, which numpy joins much quicker than text.
+        # Prometheus values are always ASCII
+        rows = np.char.add(
+            np.char.add(self.format_times(timestamps), infix.encode()),
+            np.char.add(np.array(values, dtype="S"), b"\n"),
+        )
+        csv_file.write(b"".join(rows.tolist()).decode())
+
+    @staticmethod
+    def format_times(timestamps: Iterable[float]) -> np.ndarray:
+        """
+        This method formats UNIX Epoch times as local times, the same as str(datetime.fromtimestamp(t)) but for
+        all times at once. Each distinct date is only formatted once and the time of day is built from its digits.
+        Microseconds are only included for times which have them.
+        :param timestamps: The times to format
+        :return: The formatted times as ASCII bytes
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        local_us = np.round(
+            (timestamps + JsonToCSV.utc_offsets(timestamps)) * 1e6
+        ).astype(np.int64)
+        seconds, micros = np.divmod(local_us, 1000000)
+        days, day_seconds = np.divmod(seconds, 86400)
+        chars = np.empty((len(timestamps), 19), dtype=np.uint8)
+        chars[:, :11] = JsonToCSV.date_chars(days)
+        hours, minutes, secs = (
+            day_seconds // 3600,
+            day_seconds // 60 % 60,
+            day_seconds % 60,
+        )
+        for column, part in ((11, hours), (14, minutes), (17, secs)):
+            chars[:, column] = ord("0") + part // 10
+            chars[:, column + 1] = ord("0") + part % 10
+        chars[:, [13, 16]] = ord(":")
+        formatted = chars.view("S19").reshape(-1)
+
+        fractional = micros != 0
+        if fractional.any():
+            formatted = formatted.astype(object)
+            formatted[fractional] += [
+                f".{us:06d}".encode() for us in micros[fractional]
+            ]
+            formatted = formatted.astype("S26")
+        return formatted
+
+    @staticmethod
+    def date_chars(days: np.ndarray) -> np.ndarray:
+        """
+        This method formats days since the UNIX Epoch as ISO dates followed by a space, formatting each run of
+        the same day once.
+        :param days: The days to format
+        :return: The ASCII characters of each date, one row per day
+        """
+        unique_days, day_index = JsonToCSV.runs(days)
+        dates = np.array(
+            [
+                (EPOCH_DATE + timedelta(days=int(day))).isoformat() + " "
+                for day in unique_days
+            ],
+            dtype="S11",
+        )
+        return dates.view(np.uint8).reshape(-1, 11)[day_index]
+
+    @staticmethod
+    def runs(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        This method groups runs of equal keys, which for keys in time order such as days is much quicker than
+        finding the unique keys.
+        :param keys: The keys to group
+        :return: The key of each run and the index of the run each key is in
+        """
+        if len(keys) == 0:
+            return keys, np.zeros(0, dtype=np.int64)
+        starts = np.empty(len(keys), dtype=bool)
+        starts[0] = True
+        np.not_equal(keys[1:], keys[:-1], out=starts[1:])
+        return keys[starts], np.cumsum(starts) - 1
+
+    @staticmethod
+    def utc_offsets(timestamps: np.ndarray) -> np.ndarray:
+        """
+        This method gets the local UTC offset at each time, in seconds.
+        Offsets are looked up once per run of times in the same hour. Hours the offset changes in, e.g. when clocks
+        go forward, are looked up for each time.
+        :param timestamps: The times to get the offset of
+        :return: The offset of each time
+        """
+        hours, inverse = JsonToCSV.runs(np.floor(timestamps / 3600))
+        starts = [time.localtime(hour * 3600).tm_gmtoff for hour in hours]
+        ends = [time.localtime(hour * 3600 + 3599).tm_gmtoff for hour in hours]
+        offsets = np.array(starts, dtype=np.float64)[inverse]
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if start != end:
+                changing = inverse == i
+                offsets[changing] = [
+                    time.localtime(t).tm_gmtoff for t in timestamps[changing]
+                ]
+        return offsets
+
+
+# Example metrics to query for when none are given
+EXAMPLE_METRICS = [
+    "openstack_nova_vcpus_used",
+    "openstack_nova_memory_used_bytes",
+    "node_hwmon_power_average_watt",
+]
+# Prometheus host api endpoint
+ENDPOINT = "http://172.16.102.82:9090/api/v1/query_range"
+
+
+def parse_args(inp_args: List[str]) -> argparse.Namespace:
+    """
+    This function parses the command line arguments.
+    :param inp_args: The command line arguments
+    :return: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Export the results of Prometheus queries to CSV."
+    )
+    parser.add_argument(
+        "metrics",
+        nargs="*",
+        default=EXAMPLE_METRICS,
+        help="metrics or PromQL queries to export",
+    )
+    # Start and end time as posix seconds - defaults to an example day
+    parser.add_argument(
+        "--start", default="1710770960", help="start time as UNIX Epoch seconds"
+    )
+    parser.add_argument(
+        "--end", default="1710857376", help="end time as UNIX Epoch seconds"
+    )
+    parser.add_argument(
+        "--url", default=ENDPOINT, help="Prometheus query_range endpoint"
+    )
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(OUTPUT_FORMATS),
+        help="output format",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        default=8,
+        type=int,
+        help="most queries to send to Prometheus at once",
+    )
+    parser.add_argument(
+        "--resolution",
+        type=parse_duration,
+        help="seconds between points, e.g. 300 or 5m. Prometheus reduces the points in each step with --aggregation",
+    )
+    parser.add_argument(
+        "--aggregation",
+        choices=list(AGGREGATIONS),
+        help="how points are reduced to one per --resolution, defaults to avg",
+    )
+    parser.add_argument(
+        "--by",
+        help="comma separated labels to aggregate series by with --aggregation, e.g. hostname",
+    )
+    parser.add_argument(
+        "--hostname-cache",
+        help="file to keep hostnames of node instances in for a day, so later runs don't look them up again. "
+        "Off by default",
+    )
+    parser.add_argument(
+        "--state-file",
+        help="file to keep the state of an incremental export in, to only fetch and append new points on each run",
+    )
+    parser.add_argument(
+        "--response-cache",
+        help="directory to keep responses for ranges which have ended in, so repeated exports read them from "
+        "disk rather than querying Prometheus. Holds up to 1 GiB, removing the least recently used responses "
+        "beyond that. Off by default",
+    )
+    parser.add_argument(
+        "--keep-last",
+        action="store_true",
+        help="keep the last point of each series, which is left out by default",
+    )
+    args = parser.parse_args(inp_args)
+    if args.resolution is None and (args.aggregation or args.by):
+        parser.error("--aggregation and --by need --resolution")
+    if args.max_in_flight < 1:
+        parser.error(f"--max-in-flight must be at least 1, got {args.max_in_flight}")
+    return args
+
+
+def main(inp_args: List[str]):
+    """
+    This function exports the queries given on the command line. With --resolution the queries are rewritten so
+    Prometheus reduces them to one point per resolution, and the step is set to match.
+    :param inp_args: The command line arguments
+    """
+    args = parse_args(inp_args)
+    queries, templates, step = args.metrics, {}, 60
+    if args.resolution:
+        queries = [
+            downsample_query(
+                metric, args.resolution, args.aggregation or "avg", args.by
+            )
+            for metric in args.metrics
+        ]
+        # Downsampled results have no metric name, so keep the hostname column of metrics which had one
+        templates = {
+            query: HOSTNAME_TEMPLATE
+            for metric, query in zip(args.metrics, queries)
+            if not args.by and metric.startswith(HOSTNAME_PREFIXES)
+        }
+        step = args.resolution
+    JsonToCSV(
+        queries,
+        HostnameCache(path=args.hostname_cache),
+        args.format,
+        ExportState(args.state_file) if args.state_file else None,
+        templates,
+    ).json_to_csv(
+        RawData(
+            queries,
+            args.start,
+            args.end,
+            args.url,
+            args.max_in_flight,
+            drop_last=not args.keep_last,
+            cache=ResponseCache(args.response_cache) if args.response_cache else None,
+            step=step,
+        )
+    )
 
 
 if __name__ == "__main__":
-    # Example metrics to query for
-    metrics_to_query = [
-        "openstack_nova_vcpus_used",
-        "openstack_nova_memory_used_bytes",
-        "node_hwmon_power_average_watt",
-    ]
-    # Prometheus host api endpoint
-    ENDPOINT = "http://172.16.102.82:9090/api/v1/query_range"
-    # Start and end time as posix seconds - this represents x date and y date
-    START_TIME = "1710770960"
-    END_TIME = "1710857376"
-    RawData(metrics_to_query, START_TIME, END_TIME, ENDPOINT).request_to_json_file()
-    JsonToCSV(metrics_to_query).json_to_csv()
+    main(sys.argv[1:])
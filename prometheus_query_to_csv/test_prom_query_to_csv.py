@@ -1,6 +1,30 @@
+# pylint: disable=too-many-lines
+from datetime import datetime, timezone
+import argparse
 from unittest.mock import patch, NonCallableMock
+import json
+import os
+import socket
+import threading
+import time
+import numpy as np
 import pytest
-from prom_query_to_csv import RawData, JsonToCSV
+from prom_query_to_csv import (
+    RawData,
+    JsonToCSV,
+    HostnameCache,
+    ExportState,
+    ResponseCache,
+    RowTemplate,
+    HOSTNAME_TEMPLATE,
+    import_pyarrow,
+    downsample_query,
+    parse_duration,
+    parse_args,
+    main,
+    CHUNK_SIZE,
+    MAX_POINTS,
+)
 
 
 @pytest.fixture(name="instance_raw_data")
@@ -25,37 +49,361 @@ def instance_json_to_csv_fixture():
 
 
 @patch("prom_query_to_csv.RawData.http_request")
-@patch("prom_query_to_csv.RawData.write_json_file")
-def test_request_to_json_file(
-    mock_write_json_file, mock_http_request, instance_raw_data
-):
+def test_fetch_window(mock_http_request, instance_raw_data):
     """
-    This test makes sure both methods involved are called correctly.
+    This test makes sure the response is downloaded to a file to be read from the start and closed afterwards.
     """
-    mock_http_request.return_value = "mock_http_return"
-    res = instance_raw_data.request_to_json_file()
-    mock_http_request.assert_any_call(
+    mock_http_request.return_value.iter_content.return_value = iter([b"ab", b"cd"])
+    with instance_raw_data.fetch_window("metric1", 123.0, 456.0) as spool:
+        assert spool.read() == b"abcd"
+    mock_http_request.assert_called_once_with(
         {
-            "query": "metric2",
+            "query": "metric1",
             "start": "123",
             "end": "456",
             "step": 60,
         }
     )
-    mock_http_request.assert_any_call(
+    mock_response = mock_http_request.return_value
+    mock_response.iter_content.assert_called_once_with(CHUNK_SIZE)
+    mock_response.close.assert_called_once()
+
+
+@patch("prom_query_to_csv.SPOOL_SIZE", 16)
+@patch("prom_query_to_csv.CHUNK_SIZE", 16)
+def test_read_spool(instance_raw_data):
+    """
+    This test makes sure a downloaded response larger than SPOOL_SIZE is decoded and its file closed once read.
+    """
+    body = json.dumps(
         {
-            "query": "metric1",
-            "start": "123",
-            "end": "456",
-            "step": 60,
+            "data": {
+                "result": [{"metric": {"i": str(i)}, "values": []} for i in range(5)]
+            }
         }
+    ).encode()
+    mock_response = NonCallableMock()
+    mock_response.iter_content.return_value = iter([body[:20], body[20:]])
+    with patch.object(instance_raw_data, "http_request", return_value=mock_response):
+        spool = instance_raw_data.fetch_window("metric1", 123.0, 456.0)
+    res = list(instance_raw_data.read_spool(spool))
+    assert res == [{"metric": {"i": str(i)}, "values": []} for i in range(5)]
+    assert spool.closed
+
+
+def read_window(raw_data, metric, start, end):
+    """
+    This function downloads and decodes the series of a metric in a time window.
+    """
+    return list(raw_data.read_spool(raw_data.fetch_window(metric, start, end)))
+
+
+def cached_raw_data(tmp_path, body):
+    """
+    This function makes RawData with a response cache and a mock response with the given body.
+    """
+    raw_data = RawData(
+        ["metric1"],
+        "0",
+        "600",
+        "http://mock.url.com",
+        cache=ResponseCache(str(tmp_path / "cache")),
     )
-    mock_write_json_file.assert_any_call("metric1", "mock_http_return")
-    mock_write_json_file.assert_any_call("metric2", "mock_http_return")
-    assert not res
+    mock_response = NonCallableMock()
+    mock_response.iter_content.side_effect = lambda size: iter(
+        body[i : i + 7] for i in range(0, len(body), 7)
+    )
+    return raw_data, mock_response
+
+
+@patch("prom_query_to_csv.RawData.http_request")
+def test_fetch_window_cache(mock_http_request, tmp_path):
+    """
+    This test makes sure a window is cached once it has been fully read and later requests are read from the cache.
+    """
+    body = b'{"status":"success","data":{"result":[{"metric":{},"values":[[0,"1"]]}]}}'
+    raw_data, mock_http_request.return_value = cached_raw_data(tmp_path, body)
+    first = read_window(raw_data, "metric1", 0, 600)
+    second = read_window(raw_data, "metric1", 0, 600)
+    assert first == second == [{"metric": {}, "values": [[0, "1"]]}]
+    mock_http_request.assert_called_once()
+    files = list((tmp_path / "cache").iterdir())
+    assert len(files) == 1 and files[0].name.endswith(".json.gz")
+
+
+@patch("prom_query_to_csv.RawData.http_request")
+def test_fetch_window_cache_recent(mock_http_request, tmp_path):
+    """
+    This test makes sure windows ending too recently for their points to be final are never cached.
+    """
+    body = b'{"status":"success","data":{"result":[]}}'
+    raw_data, mock_http_request.return_value = cached_raw_data(tmp_path, body)
+    end = time.time() - 60
+    read_window(raw_data, "metric1", 0, end)
+    read_window(raw_data, "metric1", 0, end)
+    assert mock_http_request.call_count == 2
+    assert not (tmp_path / "cache").exists()
+
+
+def test_response_cache_interrupted(tmp_path):
+    """
+    This test makes sure a partly read response is not cached and its temporary file is removed.
+    """
+    cache = ResponseCache(str(tmp_path))
+    path = cache.file_path("http://mock.url.com", {"query": "metric1"})
+    chunks = cache.write(path, iter([b"1", b"2"]))
+    assert next(chunks) == b"1"
+    chunks.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_response_cache_evict(tmp_path):
+    """
+    This test makes sure the least recently used bodies are removed once the cache is too large,
+    and that reading a body marks it as used.
+    """
+    cache = ResponseCache(str(tmp_path))
+    paths = [cache.file_path("http://mock.url.com", {"query": q}) for q in "abc"]
+    for i, path in enumerate(paths):
+        list(cache.write(path, [bytes([i]) * 1000]))
+        os.utime(path, (i, i))
+    assert b"".join(cache.read(paths[0])) == bytes(1000)
+    cache.max_bytes = sum(os.path.getsize(path) for path in paths[:2])
+    cache.evict()
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    assert cache.read(paths[1]) is None
+
+
+@pytest.mark.parametrize(
+    "start, end, expected",
+    [
+        ("0", "0", [(0, 0)]),
+        ("0", "600", [(0, 600)]),
+        ("0", "660", [(0, 600), (660, 660)]),
+        ("0", "1500", [(0, 600), (660, 1260), (1320, 1500)]),
+        ("100", "50", []),
+    ],
+)
+def test_time_windows(start, end, expected, instance_raw_data):
+    """
+    This test makes sure windows stay under the points limit without overlapping or leaving gaps.
+    """
+    instance_raw_data.start = start
+    instance_raw_data.end = end
+    instance_raw_data.max_points = 11
+    assert instance_raw_data.time_windows() == expected
+
+
+def test_time_windows_limit(instance_raw_data):
+    """
+    This test makes sure a year at the default step is split into windows under the Prometheus limit.
+    """
+    instance_raw_data.start = "0"
+    instance_raw_data.end = str(365 * 24 * 60 * 60)
+    windows = instance_raw_data.time_windows()
+    assert len(windows) == 48
+    assert all((end - start) / 60 + 1 <= MAX_POINTS for start, end in windows)
+    assert windows[-1][1] == 365 * 24 * 60 * 60
+
+
+@pytest.mark.parametrize(
+    "timestamp, expected",
+    [(1710770960.0, "1710770960"), (1710770960.5, "1710770960.5")],
+)
+def test_format_time(timestamp, expected):
+    """
+    This test makes sure whole seconds are formatted without a decimal point.
+    """
+    assert RawData.format_time(timestamp) == expected
+
+
+def test_stitch_series():
+    """
+    This test makes sure series are stitched together across windows with repeated points removed
+    and the last point of each series left out.
+    """
+    host1, host2 = {"hostname": "hv1"}, {"hostname": "hv2"}
+    windows = [
+        [
+            {"metric": host1, "values": [[0, "1"], [60, "2"]]},
+            {"metric": host2, "values": [[60, "5"]]},
+        ],
+        [
+            {"metric": host1, "values": [[60, "2"], [120, "3"]]},
+            {"metric": host2, "values": [[120, "6"], [180, "7"]]},
+        ],
+        [{"metric": host1, "values": [[240, "4"]]}],
+    ]
+    res = list(RawData.stitch_series(iter(windows)))
+    assert res == [
+        {"metric": host1, "values": [[0, "1"]]},
+        {"metric": host1, "values": [[60, "2"]]},
+        {"metric": host2, "values": [[60, "5"], [120, "6"]]},
+        {"metric": host1, "values": [[120, "3"]]},
+    ]
+
+
+def test_stitch_series_keep_last():
+    """
+    This test makes sure the last point of each series is kept when drop_last is False,
+    in the order the series were first seen.
+    """
+    host1, host2 = {"hostname": "hv1"}, {"hostname": "hv2"}
+    windows = [
+        [
+            {"metric": host1, "values": [[0, "1"], [60, "2"]]},
+            {"metric": host2, "values": [[60, "5"]]},
+        ],
+        [{"metric": host1, "values": [[60, "2"], [120, "3"]]}],
+    ]
+    res = list(RawData.stitch_series(iter(windows), drop_last=False))
+    assert res == [
+        {"metric": host1, "values": [[0, "1"]]},
+        {"metric": host1, "values": [[60, "2"]]},
+        {"metric": host1, "values": [[120, "3"]]},
+        {"metric": host2, "values": [[60, "5"]]},
+    ]
+
+
+def test_init_max_in_flight():
+    """
+    This test makes sure at least one query must be allowed in flight.
+    """
+    with pytest.raises(ValueError):
+        RawData(["metric1"], "123", "456", "http://mock.url.com", max_in_flight=0)
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 3])
+@patch("prom_query_to_csv.RawData.time_windows")
+def test_fetch_windows(mock_time_windows, max_in_flight):
+    """
+    This test makes sure windows are fetched concurrently, never with more than max_in_flight at once,
+    and are yielded in order of metric then time.
+    """
+    raw_data = RawData(
+        ["metric1", "metric2"], "0", "0", "http://mock.url.com", max_in_flight
+    )
+    mock_time_windows.return_value = [(0, 60), (120, 180), (240, 300)]
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def fake_window_body(metric, start, end):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        # later windows finish first
+        time.sleep(0.01 * (3 - start / 120))
+        with lock:
+            in_flight[0] -= 1
+        yield json.dumps({"data": {"result": [f"{metric} {start}-{end}"]}}).encode()
 
+    with patch.object(raw_data, "window_body", side_effect=fake_window_body):
+        res = [
+            (metric, list(series))
+            for metric, series in raw_data.fetch_windows(["metric1", "metric2"])
+        ]
+    assert res == [
+        (metric, [f"{metric} {start}-{end}"])
+        for metric in ["metric1", "metric2"]
+        for start, end in mock_time_windows.return_value
+    ]
+    assert in_flight[1] == max_in_flight
 
-@patch("prom_query_to_csv.requests.get")
+
+@patch("prom_query_to_csv.RawData.time_windows")
+def test_fetch_windows_closed_early(mock_time_windows):
+    """
+    This test makes sure windows downloaded but not yet read are closed when the iterator is closed early.
+    """
+    raw_data = RawData(["metric1"], "0", "0", "http://mock.url.com", max_in_flight=2)
+    mock_time_windows.return_value = [(0, 60), (120, 180), (240, 300)]
+    spools = []
+
+    def fake_fetch_window(*_):
+        spools.append(NonCallableMock())
+        return spools[-1]
+
+    with patch.object(raw_data, "fetch_window", side_effect=fake_fetch_window):
+        windows = raw_data.fetch_windows(["metric1"])
+        next(windows)
+        windows.close()
+    # The first window was yielded so is left to its reader, the second was cancelled or downloaded and
+    # the third never queried
+    assert len(spools) <= 2
+    spools[0].close.assert_not_called()
+    for spool in spools[1:]:
+        spool.close.assert_called_once()
+
+
+@patch("prom_query_to_csv.RawData.fetch_windows")
+def test_request_all(mock_fetch_windows, instance_raw_data):
+    """
+    This test makes sure windows are grouped by metric and stitched together.
+    """
+    host1 = {"hostname": "hv1"}
+    mock_fetch_windows.return_value = iter(
+        [
+            ("metric1", [{"metric": host1, "values": [[0, "1"], [60, "2"]]}]),
+            ("metric1", [{"metric": host1, "values": [[120, "3"]]}]),
+            ("metric2", [{"metric": host1, "values": [[0, "4"], [60, "5"]]}]),
+        ]
+    )
+    res = [
+        (metric, list(series))
+        for metric, series in instance_raw_data.request_all(["metric1", "metric2"])
+    ]
+    mock_fetch_windows.assert_called_once_with(["metric1", "metric2"], None)
+    assert res == [
+        (
+            "metric1",
+            [
+                {"metric": host1, "values": [[0, "1"]]},
+                {"metric": host1, "values": [[60, "2"]]},
+            ],
+        ),
+        ("metric2", [{"metric": host1, "values": [[0, "4"]]}]),
+    ]
+
+
+@patch("prom_query_to_csv.RawData.fetch_windows")
+def test_request_all_keep_last(mock_fetch_windows):
+    """
+    This test makes sure the last point of each series is kept when RawData is made with drop_last False.
+    """
+    host1 = {"hostname": "hv1"}
+    mock_fetch_windows.return_value = iter(
+        [("metric1", [{"metric": host1, "values": [[0, "1"], [60, "2"]]}])]
+    )
+    raw_data = RawData(["metric1"], "0", "60", "http://mock.url.com", drop_last=False)
+    res = [
+        (metric, list(series)) for metric, series in raw_data.request_all(["metric1"])
+    ]
+    assert res == [
+        (
+            "metric1",
+            [
+                {"metric": host1, "values": [[0, "1"]]},
+                {"metric": host1, "values": [[60, "2"]]},
+            ],
+        )
+    ]
+
+
+@patch("prom_query_to_csv.RawData.fetch_windows")
+def test_request_series(mock_fetch_windows, instance_raw_data):
+    """
+    This test makes sure a single metric's windows are stitched together.
+    """
+    host1 = {"hostname": "hv1"}
+    mock_fetch_windows.return_value = iter(
+        [("metric1", [{"metric": host1, "values": [[0, "1"], [60, "2"]]}])]
+    )
+    res = list(instance_raw_data.request_series("metric1"))
+    mock_fetch_windows.assert_called_once_with(["metric1"])
+    assert res == [{"metric": host1, "values": [[0, "1"]]}]
+
+
+@patch("prom_query_to_csv.requests.Session.get")
 def test_http_request_success(mock_get, instance_raw_data):
     """
     This test ensures the requests.get method is called with the correct parameters.
@@ -63,12 +411,12 @@ def test_http_request_success(mock_get, instance_raw_data):
     mock_get.return_value.status_code = 200
     res = instance_raw_data.http_request("mock_metric")
     mock_get.assert_called_once_with(
-        "http://mock.url.com", params="mock_metric", timeout=300
+        "http://mock.url.com", params="mock_metric", timeout=300, stream=True
     )
     assert res == mock_get.return_value
 
 
-@patch("prom_query_to_csv.requests.get")
+@patch("prom_query_to_csv.requests.Session.get")
 def test_http_request_fail(mock_get, instance_raw_data):
     """
     This test ensures the requests.get method is called with the correct parameters.
@@ -82,87 +430,803 @@ def test_http_request_fail(mock_get, instance_raw_data):
         assert res == mock_get.return_value
 
 
-@patch("prom_query_to_csv.open")
-def test_write_json_file(mock_open, instance_raw_data):
+def to_chunks(data: bytes, size: int):
     """
-    This test ensures the open method is called and the data should be written.
+    This splits the data into chunks as if it were streamed from a response.
     """
-    mock_response = NonCallableMock()
-    mock_response.json.return_value = "mock_data"
-    res = instance_raw_data.write_json_file("mock_name", mock_response)
-    mock_open.assert_called_once_with("mock_name.csv", "w", encoding="utf-8")
-    mock_response.json.assert_called_once()
-    mock_open.return_value.__enter__.return_value.write.assert_called_once_with(
-        "mock_data"
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_stream_series(chunk_size):
+    """
+    This test makes sure each series is decoded from the body however it is split into chunks,
+    including characters split across chunks.
+    """
+    series = [
+        {
+            "metric": {"__name__": "node", "instance": "h\u00f6st:9100"},
+            "values": [[1, "1"], [2, "2"]],
+        },
+        {
+            "metric": {"__name__": "node", "instance": "host2:9100"},
+            "values": [[1, "3"]],
+        },
+    ]
+    body = json.dumps(
+        {"status": "success", "data": {"resultType": "matrix", "result": series}},
+        ensure_ascii=False,
+        indent=1,
+    ).encode("utf-8")
+    res = list(RawData.stream_series(to_chunks(body, chunk_size)))
+    assert res == series
+
+
+@patch("prom_query_to_csv.CHUNK_SIZE", 16)
+def test_stream_series_yields_before_body_is_read():
+    """
+    This test makes sure a series is yielded before the rest of the body has been downloaded.
+    """
+    body = b'{"status":"success","data":{"resultType":"matrix","result":[{"metric":{},"values":[]},'
+    rest = [b" " * 16] * 10 + [b'{"metric":{},"values":[[1,"1"]]}]}}']
+    chunks = iter(to_chunks(body, 16) + rest)
+    res = RawData.stream_series(chunks)
+    assert next(res) == {"metric": {}, "values": []}
+    assert len(list(chunks)) > 1
+
+
+def test_stream_series_empty():
+    """
+    This test makes sure an empty result yields no series.
+    """
+    body = b'{"status":"success","data":{"resultType":"matrix","result":[]}}'
+    assert not list(RawData.stream_series([body]))
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"status":"error","error":"bad query"}',
+        b'{"status":"success","data":{"resultType":"matrix","result":[{"metric":{},"val',
+    ],
+)
+def test_stream_series_incomplete(body):
+    """
+    This test makes sure an error is raised when the body has no result or ends part way through it.
+    """
+    with pytest.raises(Exception):
+        list(RawData.stream_series([body]))
+
+
+@patch("prom_query_to_csv.HostnameCache.save")
+@patch("prom_query_to_csv.JsonToCSV.dict_to_csv")
+def test_json_to_csv(mock_dict_to_csv, mock_save, instance_json_to_csv):
+    """
+    This test checks that the series of each metric are written.
+    """
+    mock_raw_data = NonCallableMock()
+    mock_raw_data.request_all.return_value = iter(
+        [("metric1", "mock_series1"), ("metric2", "mock_series2")]
     )
+    res = instance_json_to_csv.json_to_csv(mock_raw_data)
+    mock_raw_data.request_all.assert_called_once_with(["metric1", "metric2"], None)
+    mock_dict_to_csv.assert_any_call("mock_series1", "metric1")
+    mock_dict_to_csv.assert_any_call("mock_series2", "metric2")
+    assert mock_dict_to_csv.call_count == 2
+    mock_save.assert_called_once()
     assert not res
 
 
-@patch("prom_query_to_csv.JsonToCSV.dict_to_csv")
-@patch("prom_query_to_csv.JsonToCSV.json_to_dict")
-@patch("prom_query_to_csv.JsonToCSV.read_json")
-def test_json_to_csv(
-    mock_read_json, mock_json_to_dict, mock_dict_to_csv, instance_json_to_csv
-):
+@pytest.mark.parametrize("name", ["openstack_nova_vcpus_used", "node_load1"])
+@patch("prom_query_to_csv.JsonToCSV.dict_to_rows")
+def test_dict_to_csv_hostname(mock_dict_to_rows, name, instance_json_to_csv):
     """
-    This test checks that the read methods are called.
+    This test makes sure openstack and node metrics are written with a hostname column.
     """
-    mock_read_json.return_value = "mock_data"
-    res = instance_json_to_csv.json_to_csv()
-    mock_read_json.assert_any_call("metric1")
-    mock_read_json.assert_any_call("metric2")
-    mock_json_to_dict.assert_any_call("mock_data")
-    mock_dict_to_csv.assert_any_call(mock_json_to_dict.return_value)
+    mock_data = [{"metric": {"__name__": name, "instance": "10.0.0.1:9100"}}]
+    res = instance_json_to_csv.dict_to_csv(iter(mock_data))
+    mock_dict_to_rows.assert_called_once()
+    res_name, data, template = mock_dict_to_rows.call_args.args
+    assert res_name == name
+    assert list(data) == mock_data
+    assert template is HOSTNAME_TEMPLATE
     assert not res
 
 
-@patch("prom_query_to_csv.open")
-def test_read_json(mock_open, instance_json_to_csv):
+@patch("prom_query_to_csv.JsonToCSV.dict_to_rows")
+def test_dict_to_csv_other_metric(mock_dict_to_rows, instance_json_to_csv):
     """
-    This test is testing that the open is called correctly.
+    This test makes sure other metrics are written with a column per label of the first series.
     """
-    res = instance_json_to_csv.read_json("mock_file")
-    mock_open.assert_called_once_with("mock_file.csv", "r", encoding="utf-8")
-    mock_open.return_value.__enter__.return_value.read.assert_called_once()
-    assert res == mock_open.return_value.__enter__.return_value.read.return_value
+    mock_data = [{"metric": {"__name__": "up", "job": "node", "instance": "host1"}}]
+    instance_json_to_csv.dict_to_csv(iter(mock_data))
+    name, _, template = mock_dict_to_rows.call_args.args
+    assert name == "up"
+    assert template.template == "{instance} {job}"
 
 
-def test_json_to_dict(instance_json_to_csv):
+@patch("prom_query_to_csv.JsonToCSV.dict_to_rows")
+def test_dict_to_csv_template(mock_dict_to_rows):
     """
-    This test is ensuring that json loads reads the data in correctly
+    This test makes sure a query's own template is used, and results without a metric name are named
+    after the query.
     """
-    mock_data = '{"mock_key":"mock_value"}'
-    res = instance_json_to_csv.json_to_dict(mock_data)
-    assert res == {"mock_key": "mock_value"}
+    query = "sum by (project) (openstack_nova_vcpus_used)"
+    json_to_csv = JsonToCSV([query], templates={query: "{project}"})
+    json_to_csv.dict_to_csv(iter([{"metric": {"project": "p1"}}]), query)
+    name, _, template = mock_dict_to_rows.call_args.args
+    assert name == "sum_by_project_openstack_nova_vcpus_used"
+    assert template.fields == ["project"]
 
 
-@patch("prom_query_to_csv.JsonToCSV.dict_to_csv_openstack")
-def test_dict_to_csv_openstack(mock_openstack, instance_json_to_csv):
+def test_template_for_row_template():
     """
-    This calls the openstack handling method when a openstack metric is found
+    This test makes sure a RowTemplate can be given as a query's template.
     """
-    mock_data = {"data": {"result": [{"metric": {"__name__": "openstack"}}]}}
-    res = instance_json_to_csv.dict_to_csv(mock_data)
-    mock_openstack.assert_called_once_with(mock_data["data"]["result"])
-    assert not res
+    query = "avg_over_time(openstack_nova_vcpus_used[300s])"
+    json_to_csv = JsonToCSV([query], templates={query: HOSTNAME_TEMPLATE})
+    assert json_to_csv.template_for("avg_over_time", {}, query) is HOSTNAME_TEMPLATE
 
 
-@patch("prom_query_to_csv.JsonToCSV.dict_to_csv_node")
-def test_dict_to_csv_node(mock_node, instance_json_to_csv):
+@pytest.mark.parametrize(
+    "labels, query, expected",
+    [
+        ({"__name__": "node_load1"}, "node_load1", "node_load1"),
+        (
+            {},
+            "sum(rate(node_cpu_seconds_total[5m]))",
+            "sum_rate_node_cpu_seconds_total_5m",
+        ),
+        ({}, "{}", "query"),
+        ({}, None, "query"),
+    ],
+)
+def test_output_name(labels, query, expected):
     """
-    This calls the node handling method when a node metric is found
+    This test makes sure files are named after the metric, or a safe version of the query without one.
     """
-    mock_data = {"data": {"result": [{"metric": {"__name__": "node"}}]}}
-    res = instance_json_to_csv.dict_to_csv(mock_data)
-    mock_node.assert_called_once_with(mock_data["data"]["result"])
-    assert not res
+    assert JsonToCSV.output_name(labels, query) == expected
 
 
-def test_dict_to_csv_neither(instance_json_to_csv):
+def test_dict_to_csv_no_data(instance_json_to_csv):
     """
-    This test case ensures an error is raised when a metric is found that is neither of the supported metrics.
+    This test case ensures an error is raised when the query returned no series.
     """
-    mock_data = {"data": {"result": [{"metric": {"__name__": "error"}}]}}
     with pytest.raises(Exception):
-        res = instance_json_to_csv.dict_to_csv(mock_data)
-        assert not res
+        instance_json_to_csv.dict_to_csv(iter([]))
+
+
+def test_dict_to_rows_openstack(instance_json_to_csv, tmp_path, monkeypatch):
+    """
+    This test makes sure the openstack rows are written in the expected format.
+    """
+    monkeypatch.chdir(tmp_path)
+    data = [
+        {
+            "metric": {"hostname": "hv1"},
+            "values": [[1710770960, "4"], [1710771020, "5"], [1710771080, "6"]],
+        }
+    ]
+    instance_json_to_csv.dict_to_rows(
+        "openstack_nova_vcpus_used", iter(data), HOSTNAME_TEMPLATE
+    )
+    lines = (tmp_path / "openstack_nova_vcpus_used.csv").read_text().splitlines()
+    assert lines == [
+        "Date Time Hostname openstack_nova_vcpus_used",
+        f"{datetime.fromtimestamp(1710770960)} hv1 4",
+        f"{datetime.fromtimestamp(1710771020)} hv1 5",
+        f"{datetime.fromtimestamp(1710771080)} hv1 6",
+    ]
+
+
+@pytest.mark.parametrize(
+    "timezone_name",
+    ["UTC", "Europe/London", "America/St_Johns", "Australia/Lord_Howe"],
+)
+def test_format_times(timezone_name, monkeypatch):
+    """
+    This test makes sure times are formatted the same as datetime in the local timezone,
+    including either side of clocks changing and times with fractions of a second.
+    """
+    monkeypatch.setenv("TZ", timezone_name)
+    time.tzset()
+    try:
+        # 2024-03-31 01:00 UTC, when clocks went forward in the UK
+        timestamps = [1711846800 + offset for offset in range(-7200, 7200, 599)]
+        timestamps += [0, 1710770960.5, 1710770960.25, 4102444800]
+        res = JsonToCSV.format_times(np.array(timestamps, dtype=float))
+        assert [row.decode() for row in res] == [
+            str(datetime.fromtimestamp(timestamp)) for timestamp in timestamps
+        ]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_runs():
+    """
+    This test makes sure runs of repeated keys are found along with the run each key belongs to.
+    """
+    keys, index = JsonToCSV.runs(np.array([3, 3, 1, 1, 1, 3]))
+    assert keys.tolist() == [3, 1, 3]
+    assert index.tolist() == [0, 0, 1, 1, 1, 2]
+
+
+@patch("prom_query_to_csv.socket.gethostbyaddr")
+def test_dict_to_rows_node(
+    mock_gethostbyaddr, instance_json_to_csv, tmp_path, monkeypatch
+):
+    """
+    This test makes sure the node rows are written with each instance resolved to a hostname only once.
+    """
+    monkeypatch.chdir(tmp_path)
+    mock_gethostbyaddr.return_value = ("hv1.example.com", [], ["10.0.0.1"])
+    data = [
+        {
+            "metric": {"instance": "10.0.0.1:9100"},
+            "values": [[1710770960, "250"], [1710771020, "260"]],
+        },
+        {
+            "metric": {"instance": "10.0.0.1:9100"},
+            "values": [[1710771080, "270"]],
+        },
+    ]
+    instance_json_to_csv.dict_to_rows(
+        "node_hwmon_power_average_watt", iter(data), HOSTNAME_TEMPLATE
+    )
+    lines = (tmp_path / "node_hwmon_power_average_watt.csv").read_text().splitlines()
+    assert lines == [
+        "Date Time Hostname node_hwmon_power_average_watt",
+        f"{datetime.fromtimestamp(1710770960)} hv1.example.com 250",
+        f"{datetime.fromtimestamp(1710771020)} hv1.example.com 260",
+        f"{datetime.fromtimestamp(1710771080)} hv1.example.com 270",
+    ]
+    mock_gethostbyaddr.assert_called_once_with("10.0.0.1")
+
+
+@pytest.mark.parametrize("hostnames", [True, False])
+def test_dict_to_rows_streamed(hostnames, tmp_path, monkeypatch):
+    """
+    This test makes sure each series is written as it arrives, and that series waiting for their instance
+    to be resolved are written in order with no more than max_workers of them held back.
+    """
+    monkeypatch.chdir(tmp_path)
+    json_to_csv = JsonToCSV(["query"], hostnames=HostnameCache(max_workers=2))
+    written = []
+    held = []
+
+    def series():
+        for i in range(8):
+            held.append(i - len(written))
+            labels = (
+                {"hostname": f"hv{i}"} if hostnames else {"instance": f"10.0.0.{i}"}
+            )
+            yield {"metric": labels, "values": [[i, "1"]]}
+
+    with patch.object(
+        json_to_csv, "write_series", side_effect=lambda *args: written.append(args[1])
+    ), patch.object(HostnameCache, "lookup", side_effect=lambda address: address):
+        json_to_csv.dict_to_rows("node_load1", series(), HOSTNAME_TEMPLATE)
+    assert [metric["values"][0][0] for metric in written] == list(range(8))
+    assert max(held) <= (0 if hostnames else 2)
+
+
+@pytest.mark.parametrize(
+    "template, header, row",
+    [
+        ("{project} {region}", "Date Time project region query", "p{1}  "),
+        ("", "Date Time query", ""),
+    ],
+)
+def test_dict_to_rows_template(template, header, row, tmp_path, monkeypatch):
+    """
+    This test makes sure rows are written with the template's label columns, empty for labels a series
+    doesn't have, including labels with braces in them.
+    """
+    monkeypatch.chdir(tmp_path)
+    data = [{"metric": {"project": "p{1}"}, "values": [[0, "7"]]}]
+    JsonToCSV(["query"]).dict_to_rows("query", iter(data), RowTemplate(template))
+    assert (tmp_path / "query.csv").read_text().splitlines() == [
+        header,
+        f"{datetime.fromtimestamp(0)} {row}7",
+    ]
+
+
+def test_row_template():
+    """
+    This test makes sure the header and columns come from the template's labels.
+    """
+    template = RowTemplate("{project}/{hostname}")
+    assert template.fields == ["project", "hostname"]
+    assert template.header == "project hostname"
+    assert template.format({"hostname": "hv1"}) == "/hv1"
+    assert RowTemplate("{hostname}", "Hostname").header == "Hostname"
+    assert (
+        RowTemplate("{project} {hostname}").format(
+            {"project": "My Project", "hostname": "hv1"}
+        )
+        == "My_Project hv1"
+    )
+    assert RowTemplate.from_labels(
+        {"__name__": "up", "job": "a", "instance": "b"}
+    ).fields == [
+        "instance",
+        "job",
+    ]
+
+
+@patch("prom_query_to_csv.HostnameCache.lookup")
+def test_hostname_cache_resolve_all(mock_lookup):
+    """
+    This test makes sure each distinct address is only looked up once.
+    """
+    mock_lookup.side_effect = lambda address: f"host-{address}"
+    cache = HostnameCache()
+    cache.resolve_all(["10.0.0.1", "10.0.0.2", "10.0.0.1"])
+    cache.resolve_all(["10.0.0.2"])
+    assert mock_lookup.call_count == 2
+    assert cache.hostname("10.0.0.1") == "host-10.0.0.1"
+    assert cache.hostname("10.0.0.2") == "host-10.0.0.2"
+    assert mock_lookup.call_count == 2
+
+
+@patch("prom_query_to_csv.HostnameCache.lookup")
+def test_hostname_cache_ttl(mock_lookup):
+    """
+    This test makes sure lookups are repeated once they have expired.
+    """
+    mock_lookup.return_value = "host1"
+    cache = HostnameCache(ttl=60)
+    cache.entries["10.0.0.1"] = ("old-host1", time.time() - 61)
+    assert cache.hostname("10.0.0.1") == "host1"
+    mock_lookup.assert_called_once_with("10.0.0.1")
+
+
+@patch("prom_query_to_csv.HostnameCache.lookup")
+def test_hostname_cache_save_load(mock_lookup, tmp_path):
+    """
+    This test makes sure lookups are reused by later runs until they expire.
+    """
+    path = str(tmp_path / "hostnames.json")
+    cache = HostnameCache(path=path)
+    cache.entries["10.0.0.2"] = ("expired-host2", time.time() - 25 * 60 * 60)
+    mock_lookup.return_value = "host1"
+    cache.hostname("10.0.0.1")
+    cache.save()
+    assert not (tmp_path / "hostnames.json.tmp").exists()
+
+    loaded = HostnameCache(path=path)
+    assert loaded.hostname("10.0.0.1") == "host1"
+    assert "10.0.0.2" not in loaded.entries
+    mock_lookup.assert_called_once_with("10.0.0.1")
+
+
+def test_hostname_cache_save_in_memory(tmp_path, monkeypatch):
+    """
+    This test makes sure nothing is written when there is no cache file.
+    """
+    monkeypatch.chdir(tmp_path)
+    HostnameCache().save()
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize(
+    "side_effect, expected",
+    [(None, "host1.example.com"), (socket.herror("unknown host"), "10.0.0.1")],
+)
+@patch("prom_query_to_csv.socket.gethostbyaddr")
+def test_hostname_cache_lookup(mock_gethostbyaddr, side_effect, expected):
+    """
+    This test makes sure the address is used as the hostname when it has none.
+    """
+    mock_gethostbyaddr.return_value = ("host1.example.com", [], ["10.0.0.1"])
+    mock_gethostbyaddr.side_effect = side_effect
+    assert HostnameCache.lookup("10.0.0.1") == expected
+
+
+def test_init_output_format():
+    """
+    This test makes sure an unsupported output format is refused.
+    """
+    with pytest.raises(ValueError):
+        JsonToCSV(["metric1"], output_format="xlsx")
+
+
+@pytest.mark.parametrize("output_format", ["wide-csv", "parquet", "arrow"])
+@patch("prom_query_to_csv.JsonToCSV.dict_to_wide")
+@patch("prom_query_to_csv.JsonToCSV.dict_to_rows")
+def test_dict_to_csv_wide(mock_dict_to_rows, mock_dict_to_wide, output_format):
+    """
+    This test makes sure the wide writer is used for wide output formats.
+    """
+    json_to_csv = JsonToCSV(["metric1"], output_format=output_format)
+    mock_data = [{"metric": {"__name__": "openstack"}}]
+    json_to_csv.dict_to_csv(iter(mock_data))
+    mock_dict_to_rows.assert_not_called()
+    mock_dict_to_wide.assert_called_once_with("openstack", mock_data, HOSTNAME_TEMPLATE)
+
+
+@patch("prom_query_to_csv.HostnameCache.resolve_all")
+@patch("prom_query_to_csv.JsonToCSV.dict_to_wide")
+def test_dict_to_csv_wide_node(mock_dict_to_wide, mock_resolve_all):
+    """
+    This test makes sure all node instances are resolved together before being pivoted.
+    """
+    json_to_csv = JsonToCSV(["metric1"], output_format="wide-csv")
+    mock_data = [
+        {"metric": {"__name__": "node", "instance": "10.0.0.1:9100"}},
+        {"metric": {"__name__": "node", "instance": "10.0.0.2:9100"}},
+    ]
+    json_to_csv.dict_to_csv(iter(mock_data))
+    assert list(mock_resolve_all.call_args.args[0]) == ["10.0.0.1", "10.0.0.2"]
+    assert mock_dict_to_wide.call_args.args[1] == mock_data
+
+
+def test_pivot():
+    """
+    This test makes sure series are pivoted to a column per host, with the labels of each series added to
+    the names of hosts with more than one series.
+    """
+    data = [
+        {
+            "metric": {"hostname": "hv1", "sensor": "power1"},
+            "values": [[0, "1"], [60, "2"]],
+        },
+        {"metric": {"hostname": "hv1", "sensor": "power 2"}, "values": [[0, "3"]]},
+        {"metric": {"hostname": "hv2", "sensor": "power1"}, "values": [[120, "4"]]},
+        {
+            "metric": {"hostname": "hv2", "sensor": "power1"},
+            "values": [[180, "5"]],
+        },
+    ]
+    timestamps, columns = JsonToCSV.pivot(data, lambda labels: labels["hostname"])
+    assert timestamps == [0, 60, 120, 180]
+    assert columns == {
+        'hv1{sensor="power1"}': {0: "1", 60: "2"},
+        'hv1{sensor="power_2"}': {0: "3"},
+        "hv2": {120: "4", 180: "5"},
+    }
+
+
+def test_write_wide_csv(tmp_path):
+    """
+    This test makes sure the wide CSV has a row per time with NaN where a host has no point.
+    """
+    file_name = tmp_path / "metric.csv"
+    JsonToCSV.write_wide_csv(
+        str(file_name), [0, 60], {"hv1": {0: "1", 60: "2"}, "hv2": {60: "3"}}
+    )
+    assert file_name.read_text().splitlines() == [
+        "Date Time hv1 hv2",
+        f"{datetime.fromtimestamp(0)} 1 NaN",
+        f"{datetime.fromtimestamp(60)} 2 3",
+    ]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_dict_to_wide_columnar(output_format, tmp_path, monkeypatch):
+    """
+    This test makes sure columnar files are written with a UTC time column and a float column per host.
+    """
+    pyarrow = pytest.importorskip("pyarrow")
+    monkeypatch.chdir(tmp_path)
+    data = [
+        {"metric": {"hostname": "hv1"}, "values": [[0, "1.5"], [60, "2"]]},
+        {"metric": {"hostname": "hv2"}, "values": [[60, "3"]]},
+    ]
+    json_to_csv = JsonToCSV(["metric1"], output_format=output_format)
+    json_to_csv.dict_to_wide("openstack", iter(data), HOSTNAME_TEMPLATE)
+    if output_format == "parquet":
+        table = pyarrow.parquet.read_table(tmp_path / "openstack.parquet")
+    else:
+        table = pyarrow.ipc.open_file(str(tmp_path / "openstack.arrow")).read_all()
+    assert table.schema.field("time").type == pyarrow.timestamp("ms", tz="UTC")
+    assert table.to_pydict() == {
+        "time": [
+            datetime.fromtimestamp(0, timezone.utc),
+            datetime.fromtimestamp(60, timezone.utc),
+        ],
+        "hv1": [1.5, 2.0],
+        "hv2": [None, 3.0],
+    }
+
+
+def test_import_pyarrow_missing():
+    """
+    This test makes sure a helpful error is raised when pyarrow isn't installed.
+    """
+    with patch.dict("sys.modules", {"pyarrow": None}):
+        with pytest.raises(ImportError, match="pyarrow is required"):
+            import_pyarrow()
+
+
+def test_time_windows_start(instance_raw_data):
+    """
+    This test makes sure a later start is used but an earlier one is ignored.
+    """
+    instance_raw_data.start = "0"
+    instance_raw_data.end = "600"
+    assert instance_raw_data.time_windows(300.0) == [(300, 600)]
+    assert instance_raw_data.time_windows(-300.0) == [(0, 600)]
+
+
+def test_init_incremental_output_format(tmp_path):
+    """
+    This test makes sure incremental export is refused for formats which can't be appended to.
+    """
+    with pytest.raises(ValueError):
+        JsonToCSV(
+            ["metric1"],
+            output_format="parquet",
+            state=ExportState(str(tmp_path / "state.json")),
+        )
+
+
+def export_run(tmp_path, windows):
+    """
+    This runs an incremental export of the openstack series in windows, returning the lines written.
+    """
+    state = ExportState(str(tmp_path / "state.json"))
+    mock_raw_data = NonCallableMock()
+    mock_raw_data.step = 60
+    mock_raw_data.request_all.side_effect = lambda metrics, starts: iter(
+        [("query1", RawData.stitch_series(iter(windows)))]
+    )
+    JsonToCSV(["query1"], state=state).json_to_csv(mock_raw_data)
+    return (
+        mock_raw_data.request_all.call_args.args[1],
+        (tmp_path / "openstack.csv").read_text().splitlines(),
+    )
+
+
+def test_incremental_export(tmp_path, monkeypatch):
+    """
+    This test makes sure later runs start after the last point written and only append new points,
+    and that rows written by an interrupted run are rolled back.
+    """
+    monkeypatch.chdir(tmp_path)
+    labels = {"__name__": "openstack", "hostname": "hv1"}
+    starts, lines = export_run(
+        tmp_path, [[{"metric": labels, "values": [[0, "1"], [60, "2"], [120, "3"]]}]]
+    )
+    assert starts == {}
+    assert lines == [
+        "Date Time Hostname openstack",
+        f"{datetime.fromtimestamp(0)} hv1 1",
+        f"{datetime.fromtimestamp(60)} hv1 2",
+    ]
+
+    # an interrupted run wrote a row without saving the state
+    with open(tmp_path / "openstack.csv", "a", encoding="utf-8") as csv_file:
+        csv_file.write("partial row")
+    starts, lines = export_run(
+        tmp_path, [[{"metric": labels, "values": [[60, "2"], [120, "3"], [180, "4"]]}]]
+    )
+    assert starts == {"query1": 120}
+    assert lines == [
+        "Date Time Hostname openstack",
+        f"{datetime.fromtimestamp(0)} hv1 1",
+        f"{datetime.fromtimestamp(60)} hv1 2",
+        f"{datetime.fromtimestamp(120)} hv1 3",
+    ]
+
+    # nothing new
+    starts, lines = export_run(tmp_path, [])
+    assert starts == {"query1": 180}
+    assert len(lines) == 4
+    assert not (tmp_path / "state.json.tmp").exists()
+
+
+def test_export_state_starts_invalid_file(tmp_path, monkeypatch):
+    """
+    This test makes sure queries whose file is missing or has shrunk are exported again from the start.
+    """
+    monkeypatch.chdir(tmp_path)
+    state = ExportState(str(tmp_path / "state.json"))
+    state.queries = {
+        "query1": {"file": "missing.csv", "size": 10, "series": {"{}": 60}},
+        "query2": {"file": "shrunk.csv", "size": 10, "series": {"{}": 60}},
+        "query3": {"file": "ok.csv", "size": 2, "series": {"{}": 60, '{"a": 1}': 0}},
+    }
+    (tmp_path / "shrunk.csv").write_text("1")
+    (tmp_path / "ok.csv").write_text("123")
+    assert state.starts(["query1", "query2", "query3", "query4"], 60) == {"query3": 60}
+    assert list(state.queries) == ["query3"]
+
+
+def test_export_state_prepare(tmp_path, monkeypatch):
+    """
+    This test makes sure files are rolled back to their saved size, or emptied if they have no state.
+    """
+    monkeypatch.chdir(tmp_path)
+    state = ExportState(str(tmp_path / "state.json"))
+    state.queries = {"query1": {"file": "a.csv", "size": 2, "series": {}}}
+    (tmp_path / "a.csv").write_text("1234")
+    (tmp_path / "b.csv").write_text("1234")
+    state.prepare("query1", "a.csv")
+    state.prepare("query2", "b.csv")
+    state.prepare("query3", "c.csv")
+    assert (tmp_path / "a.csv").read_text() == "12"
+    assert (tmp_path / "b.csv").read_text() == ""
+    assert not (tmp_path / "c.csv").exists()
+
+
+def test_export_state_new_points(tmp_path):
+    """
+    This test makes sure points already written are left out and only series seen in this run are kept.
+    """
+    state = ExportState(str(tmp_path / "state.json"))
+    state.queries = {
+        "query1": {
+            "file": "a.csv",
+            "size": 0,
+            "series": {
+                '{"host": "hv1"}': 60,
+                '{"host": "hv2"}': 60,
+                '{"host": "old"}': 0,
+            },
+        }
+    }
+    data = [
+        {"metric": {"host": "hv1"}, "values": [[60, "1"], [120, "2"]]},
+        {"metric": {"host": "hv2"}, "values": [[0, "3"], [60, "4"]]},
+        {"metric": {"host": "hv3"}, "values": [[120, "5"]]},
+    ]
+    res = list(state.new_points("query1", iter(data)))
+    assert [series["values"] for series in res] == [[[120, "2"]], [], [[120, "5"]]]
+    assert state.pending["query1"] == {
+        '{"host": "hv1"}': 120,
+        '{"host": "hv2"}': 60,
+        '{"host": "hv3"}': 120,
+    }
+
+
+@pytest.mark.parametrize(
+    "metric, aggregation, by, expected",
+    [
+        ("node_load1", "avg", None, "avg_over_time(node_load1[300s])"),
+        (
+            'node_load1{job="node"}',
+            "max",
+            None,
+            'max_over_time(node_load1{job="node"}[300s])',
+        ),
+        ("node_load1", "p95", None, "quantile_over_time(0.95, node_load1[300s])"),
+        (
+            "openstack_nova_vcpus_used",
+            "avg",
+            "project, hostname",
+            "avg by (project, hostname) (avg_over_time(openstack_nova_vcpus_used[300s]))",
+        ),
+        (
+            "node_load1",
+            "p95",
+            "hostname",
+            "quantile by (hostname) (0.95, quantile_over_time(0.95, node_load1[300s]))",
+        ),
+        (
+            "rate(node_cpu_seconds_total[5m])",
+            "sum",
+            None,
+            "sum_over_time((rate(node_cpu_seconds_total[5m]))[300s:])",
+        ),
+        (
+            'foo{a="b"} or bar{c="d"}',
+            "avg",
+            None,
+            'avg_over_time((foo{a="b"} or bar{c="d"})[300s:])',
+        ),
+        (
+            'node_load1{job=~"a}|b"}',
+            "avg",
+            None,
+            'avg_over_time(node_load1{job=~"a}|b"}[300s])',
+        ),
+    ],
+)
+def test_downsample_query(metric, aggregation, by, expected):
+    """
+    This test makes sure queries are rewritten to reduce their points over each step, using a subquery for
+    queries which aren't a plain metric.
+    """
+    assert downsample_query(metric, 300, aggregation, by) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected", [("300", 300), ("5m", 300), ("1h30m", 5400), ("1d", 86400)]
+)
+def test_parse_duration(text, expected):
+    """
+    This test makes sure durations are parsed as seconds or in Prometheus' format.
+    """
+    assert parse_duration(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "0", "5x", "m5", "5m 1s", "1.5h"])
+def test_parse_duration_invalid(text):
+    """
+    This test makes sure invalid or zero durations are refused.
+    """
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_duration(text)
+
+
+@pytest.mark.parametrize(
+    "inp_args",
+    [["--aggregation", "max"], ["--by", "hostname"], ["--max-in-flight", "0"]],
+)
+def test_parse_args_invalid(inp_args):
+    """
+    This test makes sure an aggregation can't be given without a resolution and at least one query is in flight.
+    """
+    with pytest.raises(SystemExit):
+        parse_args(inp_args)
+
+
+@patch("prom_query_to_csv.RawData")
+@patch("prom_query_to_csv.JsonToCSV")
+def test_main_downsample(mock_json_to_csv, mock_raw_data):
+    """
+    This test makes sure queries are rewritten and the step set to the resolution, keeping the hostname
+    column of openstack and node metrics.
+    """
+    main(
+        [
+            "openstack_nova_vcpus_used",
+            "up",
+            "--resolution",
+            "1h",
+            "--aggregation",
+            "p95",
+        ]
+    )
+    queries = [
+        "quantile_over_time(0.95, openstack_nova_vcpus_used[3600s])",
+        "quantile_over_time(0.95, up[3600s])",
+    ]
+    args, kwargs = mock_raw_data.call_args
+    assert args[0] == queries
+    assert kwargs["step"] == 3600
+    assert kwargs["cache"] is None
+    args = mock_json_to_csv.call_args.args
+    assert args[0] == queries
+    assert args[4] == {queries[0]: HOSTNAME_TEMPLATE}
+    mock_json_to_csv.return_value.json_to_csv.assert_called_once_with(
+        mock_raw_data.return_value
+    )
+
+
+@patch("prom_query_to_csv.RawData")
+@patch("prom_query_to_csv.JsonToCSV")
+def test_main_raw(mock_json_to_csv, mock_raw_data):
+    """
+    This test makes sure queries are exported unchanged at the default step without a resolution.
+    """
+    main(["node_load1", "--keep-last"])
+    args, kwargs = mock_raw_data.call_args
+    assert args[0] == ["node_load1"]
+    assert kwargs["step"] == 60
+    assert kwargs["drop_last"] is False
+    assert mock_json_to_csv.call_args.args[4] == {}
+
+
+@patch("prom_query_to_csv.RawData")
+@patch("prom_query_to_csv.JsonToCSV")
+def test_main_caches(mock_json_to_csv, mock_raw_data, tmp_path):
+    """
+    This test makes sure nothing is cached on disk unless a cache is asked for.
+    """
+    main(["node_load1"])
+    assert mock_raw_data.call_args.kwargs["cache"] is None
+    assert mock_json_to_csv.call_args.args[1].path is None
+    main(
+        [
+            "node_load1",
+            "--response-cache",
+            str(tmp_path / "responses"),
+            "--hostname-cache",
+            str(tmp_path / "hostnames.json"),
+        ]
+    )
+    assert mock_raw_data.call_args.kwargs["cache"].path == str(tmp_path / "responses")
+    assert mock_json_to_csv.call_args.args[1].path == str(tmp_path / "hostnames.json")